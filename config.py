@@ -1,5 +1,10 @@
 import os
 
+# process pool size. If not set - number of CPUs
+WORKERS = int(os.environ.get('WORKERS', 0)) or os.cpu_count()
+# in bytes, max upload for sync mode
+SYNC_MAX_SIZE = int(os.environ.get('SYNC_MAX_SIZE', 10 * 1024 * 1024))
+
 CONFIG = {
     'redis': {
         'host': os.environ.get('REDIS_HOST', 'localhost'),
@@ -17,9 +22,114 @@ CONFIG = {
         "aws_secret_access": os.environ.get('AWS_SECRET_ACCESS'),
         "region": os.environ.get("AWS_REGION", 'eu-central-1'),
         "ssl": os.environ.get('AWS_SSL', False),
+        # upload default images straight to S3, workers on any node can resize it
+        "store_default": os.environ.get('AWS_STORE_DEFAULT', False),
+        # for S3 compatible storages, MinIO for example
+        "endpoint_url": os.environ.get('AWS_ENDPOINT_URL'),
+        "max_pool_connections": int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50)),
+        # in bytes. Bigger results uploaded by parts while encoding
+        "multipart_threshold": int(os.environ.get('AWS_MULTIPART_THRESHOLD', 8 * 1024 * 1024)),
+        # in bytes, S3 minimum is 5 MiB
+        "multipart_part_size": int(os.environ.get('AWS_MULTIPART_PART_SIZE', 8 * 1024 * 1024)),
+        # parts uploaded at once
+        "multipart_concurrency": int(os.environ.get('AWS_MULTIPART_CONCURRENCY', 4)),
+    },
+    'workers': WORKERS,
+    'queue': {
+        # local - in-process queue, redis - redis stream shared by all nodes
+        'backend': os.environ.get('QUEUE_BACKEND', 'local'),
+        # max jobs waiting for free worker (for redis - waiting and in progress). 0 - unbounded
+        'max_size': int(os.environ.get('QUEUE_MAX_SIZE', 100)),
+        # max jobs sent to process pool at once. If not set - pool size
+        'max_in_flight': int(os.environ.get('QUEUE_MAX_IN_FLIGHT', 0)) or WORKERS,
+        # in secs, sent in Retry-After header when queue is full
+        'retry_after': int(os.environ.get('QUEUE_RETRY_AFTER', 5)),
+        'stream': os.environ.get('QUEUE_STREAM', 'resize_jobs'),
+        'group': os.environ.get('QUEUE_GROUP', 'resize_workers'),
+        # in secs, not acked job given to other worker after it
+        'visibility_timeout': int(os.environ.get('QUEUE_VISIBILITY_TIMEOUT', 300)),
+        # deliveries before job moved to dead letter stream
+        'max_retries': int(os.environ.get('QUEUE_MAX_RETRIES', 3)),
+    },
+    'executor': {
+        # process, thread (Pillow releases GIL in decode, resize and encode) or hybrid (by source size).
+        # Pool size is WORKERS
+        'backend': os.environ.get('EXECUTOR', 'process'),
+        # hybrid: in bytes, sources up to it resized in threads, bigger in processes
+        'threshold': int(os.environ.get('EXECUTOR_THRESHOLD', 512 * 1024)),
+        # hybrid: thread pool size, if not set - WORKERS
+        'threads': int(os.environ.get('EXECUTOR_THREADS', 0)) or WORKERS,
+    },
+    'worker': {
+        # jobs done by worker process before it is replaced by new one, 0 - never (Python 3.11+)
+        'max_tasks_per_child': int(os.environ.get('WORKER_MAX_TASKS', 0)),
+        # Pillow formats loaded in every worker before first job, empty - loaded on first use
+        'preload': [name for name in os.environ.get('WORKER_PRELOAD', 'JPEG,PNG,WEBP').split(',') if name],
+    },
+    # all - api and workers, api - only http (needs redis queue), worker - only resize jobs
+    'role': os.environ.get('ROLE', 'all'),
+    'sync': {
+        # in bytes, uploads up to it resized in same request without ?sync. 0 - only with ?sync
+        'auto_size': int(os.environ.get('SYNC_AUTO_SIZE', 0)),
+        'max_size': SYNC_MAX_SIZE,
+    },
+    'shared_memory': {
+        # shared memory segments for sync mode handoff to workers, 0 - image sent through pool pipe.
+        # Every segment holds upload and encoded result, needs enough /dev/shm (docker --shm-size)
+        'segments': int(os.environ.get('SHM_SEGMENTS', 0)),
+        # in bytes, if not set - 2 * SYNC_MAX_SIZE
+        'segment_size': int(os.environ.get('SHM_SEGMENT_SIZE', 0)) or 2 * SYNC_MAX_SIZE,
+    },
+    'batch': {
+        'max_files': int(os.environ.get('BATCH_MAX_FILES', 20)),
+        # target sizes per file
+        'max_sizes': int(os.environ.get('BATCH_MAX_SIZES', 10)),
+    },
+    'status': {
+        # max job ids in one bulk status check
+        'max_ids': int(os.environ.get('STATUS_MAX_IDS', 1000)),
+    },
+    'notify': {
+        # redis pub/sub channel for job status changes
+        'channel': os.environ.get('NOTIFY_CHANNEL', 'resize_status'),
+        # in secs, max ?wait= for long polling
+        'max_wait': int(os.environ.get('NOTIFY_MAX_WAIT', 30)),
+        # in secs, comment sent to events stream if status not changed
+        'keepalive': int(os.environ.get('NOTIFY_KEEPALIVE', 15)),
+    },
+    'resize': {
+        # decode JPEG at reduced scale. Set RESIZE_NO_DRAFT to disable
+        'draft': not os.environ.get('RESIZE_NO_DRAFT'),
+        # default filter: nearest, box, bilinear, hamming, bicubic, lanczos or
+        # auto - lanczos if image reduced in 2 times and more, else bicubic
+        'filter': os.environ.get('RESIZE_FILTER', 'auto'),
+        # reduce() by integer factor while image bigger than target in so many times. 0 - disabled
+        'reducing_gap': float(os.environ.get('RESIZE_REDUCING_GAP', 2.0)),
+    },
+    'cache': {
+        # reuse result for same image bytes and resize params. Always disabled with FILES_CLEAR
+        'enabled': not os.environ.get('CACHE_DISABLE'),
+        # in secs
+        'ttl': int(os.environ.get('CACHE_TTL', 24 * 60 * 60)),
+        'max_entries': int(os.environ.get('CACHE_MAX_ENTRIES', 10000)),
+    },
+    'repository_cache': {
+        # finished jobs kept in memory of every node, changes published to channel by all nodes.
+        # Set REPOSITORY_CACHE_DISABLE to disable
+        'enabled': not os.environ.get('REPOSITORY_CACHE_DISABLE'),
+        # in secs
+        'ttl': int(os.environ.get('REPOSITORY_CACHE_TTL', 60)),
+        'max_entries': int(os.environ.get('REPOSITORY_CACHE_MAX_ENTRIES', 10000)),
+        'channel': os.environ.get('REPOSITORY_CACHE_CHANNEL', 'repository_changes'),
     },
+    # JSON of repository records, status messages and responses: auto (orjson if installed), orjson or json
+    'serializer': os.environ.get('SERIALIZER', 'auto'),
+    # in bytes, chunk size for sending resized image if sendfile is not available
+    'download_chunk_size': int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 256 * 1024)),
     'host': os.environ.get('HOST', 'localhost'),
     'port': int(os.environ.get('PORT', 8080)),
+    # ROLE=worker serves only /metrics on it, 0 - disabled
+    'metrics_port': int(os.environ.get('METRICS_PORT', 8081)),
     'files_path': os.environ.get('TEMP_FILES_PATH', os.getcwd()),
     'debug': os.environ.get('DEBUG')
 }
@@ -1,73 +1,215 @@
 import asyncio
 import logging
+import multiprocessing
 import signal
-import time
+import sys
+from concurrent.futures import Executor
 from concurrent.futures.process import ProcessPoolExecutor
+from concurrent.futures.thread import ThreadPoolExecutor
 from contextlib import suppress
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from aiohttp import web
 from aiohttp.web_app import Application
 from aiohttp_apispec import validation_middleware, setup_aiohttp_apispec
 
 from config import CONFIG
-from service import LocalFileStorage, AmazonFileStorage, ImageResizer, RedisRepository
-from views import load_image, get_image, check_status
+from service import LocalFileStorage, AmazonFileStorage, RedisRepository, ResizeScheduler, ResultCache, \
+    LocalJobQueue, RedisJobQueue, StatusNotifier, CachedRepository
+from service.file_storage import ImageNotFoundError, PathNotFoundError, FileStorage, ConnectionStorageError
+from service.executor import HybridExecutor
+from service.job_queue import JobQueue
+from service.metrics import JOBS, ERRORS
+from service.shared_memory import SharedBufferPool
+from service.worker import run_in_pool, init_worker as init_worker_state
+from service.notifier import FINAL_STATUSES
+from models.Image import ImageData
+from views import load_image, get_image, check_status, check_queue, status_events, load_batch, check_batch, \
+    get_batch_image, get_metrics, check_statuses
 
 logger = logging.getLogger('app_logger')
 
+# job is resized only from these statuses, resizing - worker died before finish it
+STARTABLE_STATUSES = ('loaded', 'resizing')
+
 
 def register_signal_handler() -> None:
     signal.signal(signal.SIGINT, lambda _, __: None)
 
 
+def init_worker(files_storage: FileStorage, preload: List[str]) -> None:
+    register_signal_handler()
+    init_worker_state(files_storage, preload)
+
+
+def create_process_pool(files_storage: FileStorage) -> ProcessPoolExecutor:
+    # storage pickled once per worker process, not per job
+    kwargs = {}
+    max_tasks = CONFIG['worker']['max_tasks_per_child']
+    if max_tasks and sys.version_info >= (3, 11):
+        # recycled workers protect from memory fragmentation, fork not allowed with it
+        kwargs.update(max_tasks_per_child=max_tasks, mp_context=multiprocessing.get_context('spawn'))
+    elif max_tasks:
+        logger.warning('WORKER_MAX_TASKS needs Python 3.11+, workers are not recycled')
+    return ProcessPoolExecutor(
+        max_workers=CONFIG['workers'],
+        initializer=init_worker,
+        initargs=(files_storage, CONFIG['worker']['preload']),
+        **kwargs,
+    )
+
+
+def create_thread_pool(files_storage: FileStorage, max_workers: int) -> ThreadPoolExecutor:
+    # resizer per thread, no signal handler: it can be set only in main thread
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        thread_name_prefix='resize',
+        initializer=init_worker_state,
+        initargs=(files_storage, CONFIG['worker']['preload']),
+    )
+
+
+def create_executor(files_storage: FileStorage) -> Executor:
+    backend = CONFIG['executor']['backend']
+    if backend == 'thread':
+        return create_thread_pool(files_storage, CONFIG['workers'])
+    if backend == 'hybrid':
+        return HybridExecutor(
+            create_process_pool(files_storage),
+            create_thread_pool(files_storage, CONFIG['executor']['threads']),
+            threshold=CONFIG['executor']['threshold'],
+        )
+    if backend != 'process':
+        raise RuntimeError(f"Unknown executor {backend}")
+    return create_process_pool(files_storage)
+
+
+async def get_cached_result(app: Application, data: Dict) -> Tuple[Optional[str], Optional[str]]:
+    if not app.result_cache or not data.get('source_hash'):
+        return None, None
+    cache_key = app.result_cache.make_result_key(
+        data.get('source_hash'), data.get('file_name'), data.get('width'), data.get('height'), data.get('scale'),
+        data.get('output'), data.get('resample'),
+    )
+    cached_path = await app.result_cache.get(cache_key)
+    return cache_key, cached_path
+
+
+async def update_status(
+        app: Application,
+        file_id: str,
+        data: Dict,
+        status_from: Optional[Sequence[str]] = None,
+) -> bool:
+    # only changed fields written. False if job not found or its status not in status_from
+    if not await app.repository.update(file_id, data, status_from=status_from):
+        return False
+    await app.notifier.publish(file_id, data.get('status'))
+    if data.get('status') in FINAL_STATUSES:
+        JOBS.inc(data.get('status'))
+    return True
+
+
 async def resize_task(app: Application, file_id: str) -> None:
     loop = asyncio.get_event_loop()
     data = await app.repository.get(file_id)
-    image_resizer = ImageResizer(app.files_storage)
-    data.update({
-        "status": "resizing"
-    })
-    await app.repository.update(file_id, data)
-    start_time = time.time()
-    start_time_formatted = time.strftime("%H:%M:%S", time.localtime(start_time))
-
-    new_image_path, error = await loop.run_in_executor(
+    if not data:
+        logger.error(f"Job {file_id} not found")
+        return
+    try:
+        job = ImageData.from_json(data)
+    except ValueError as e:
+        logger.error(f"Job {file_id} is broken: {e}")
+        await update_status(app, file_id, {"status": "error"}, status_from=STARTABLE_STATUSES)
+        return
+    if job.outputs:
+        await resize_batch_task(app, file_id, data)
+        return
+    cache_key, cached_path = await get_cached_result(app, data)
+    if cached_path:
+        logger.debug(f'Cache hit for {file_id}: {cached_path}')
+        try:
+            # may be S3 request, don't block loop
+            await loop.run_in_executor(None, app.files_storage.delete_default, job.file_name)
+        except (PathNotFoundError, ImageNotFoundError, ConnectionStorageError) as e:
+            logger.error(f"Delete default img err: {e}")
+        await update_status(app, file_id, {
+            "status": "done",
+            "updated_file_path": cached_path
+        }, status_from=STARTABLE_STATUSES)
+        return
+    # atomic: job redelivered by queue after it was finished is not resized again
+    if not await update_status(app, file_id, {"status": "resizing"}, status_from=STARTABLE_STATUSES):
+        logger.warning(f"Job {file_id} already finished")
+        return
+    new_image_path, error = await run_in_pool(
         app.process_pool,
-        image_resizer.resize_img,
-        data.get('file_name'), data.get('width'), data.get('height'), data.get('scale')
+        'resize_img',
+        job.file_name, job.width, job.height, job.scale, job.output, job.resample,
+        size=job.source_size,
     )
     if error:
         logger.error(f"{error}")
-        if not new_image_path:
-            data.update({
-                "status": "error",
-                "updated_file_path": None,
-            })
-    if new_image_path:
-        end_time = time.time()
-        end_time_formatted = time.strftime("%H:%M:%S", time.localtime(end_time))
-        logger.debug(
-            f'Start time: {start_time_formatted} End time: {end_time_formatted} Elapsed: {end_time-start_time}')
-        data.update({
-            "status": "done",
-            "updated_file_path": new_image_path
-        })
-    await app.repository.update(file_id, data)
+    changes = {
+        "status": "done" if new_image_path else "error",
+        "updated_file_path": new_image_path,
+    }
+    if new_image_path and cache_key:
+        await app.result_cache.set(cache_key, new_image_path)
+    await update_status(app, file_id, changes)
 
 
-async def input_queue_listener(app: Application) -> None:
-    logger.debug('listen input data..')
-    loop = asyncio.get_event_loop()
-    while True:
-        file_id = await app.input_images_queue.get()
-        loop.create_task(resize_task(app, file_id))
-        app.input_images_queue.task_done()
+async def resize_batch_task(app: Application, file_id: str, data: Dict) -> None:
+    # one file of batch, all outputs resized from one decode
+    outputs = data.get('outputs')
+    for output in outputs:
+        output['status'] = 'resizing'
+    started = await update_status(
+        app, file_id, {'status': 'resizing', 'outputs': outputs}, status_from=STARTABLE_STATUSES,
+    )
+    if not started:
+        logger.warning(f"Job {file_id} already finished")
+        return
+    results = await run_in_pool(
+        app.process_pool,
+        'resize_many',
+        data.get('file_name'),
+        [(output.get('width'), output.get('height'), output.get('scale')) for output in outputs],
+        data.get('output'),
+        data.get('resample'),
+        size=data.get('source_size'),
+    )
+    for output, (new_image_path, error) in zip(outputs, results):
+        if error:
+            logger.error(f"{error}")
+        output.update({
+            "status": "done" if new_image_path else "error",
+            "updated_file_path": new_image_path,
+        })
+    status = 'done' if any(output['status'] == 'done' for output in outputs) else 'error'
+    await update_status(app, file_id, {'status': status, 'outputs': outputs})
 
 
 async def repository_process(app: Application) -> None:
     repository = RedisRepository()
+    if CONFIG['repository_cache']['enabled']:
+        repository = CachedRepository(
+            repository,
+            channel=CONFIG['repository_cache']['channel'],
+            ttl=CONFIG['repository_cache']['ttl'],
+            max_entries=CONFIG['repository_cache']['max_entries'],
+        )
     await repository.connect()
     app.repository = repository
+    app.result_cache = None
+    # cached result can't be shared between jobs if it deleted after sending
+    if CONFIG['cache']['enabled'] and not CONFIG.get('clear'):
+        app.result_cache = ResultCache(
+            repository,
+            ttl=CONFIG['cache']['ttl'],
+            max_entries=CONFIG['cache']['max_entries'],
+        )
     logger.info("Repository started")
     yield
     await app.repository.disconnect()
@@ -83,21 +225,97 @@ async def files_storage_process(app: Application) -> None:
         files_storage = LocalFileStorage(
             images_path=CONFIG['files_path']
         )
+    await files_storage.connect()
     app.files_storage = files_storage
     logger.info("Files storage started")
     yield
+    await app.files_storage.disconnect()
     logger.info("Files storage stopped")
 
 
+async def notifier_process(app: Application) -> None:
+    notifier = StatusNotifier(app.repository.pool, CONFIG['notify']['channel'])
+    # worker only publishes status changes
+    if CONFIG['role'] != 'worker':
+        await notifier.connect()
+    app.notifier = notifier
+    logger.info("Notifier started")
+    yield
+    await app.notifier.disconnect()
+    logger.info("Notifier stopped")
+
+
+async def shared_buffers_process(app: Application) -> None:
+    app.shared_buffers = None
+    count = CONFIG['shared_memory']['segments']
+    # thread workers read upload from memory of process
+    if not count or CONFIG['role'] != 'all' or CONFIG['executor']['backend'] == 'thread':
+        yield
+        return
+    if not SharedBufferPool.is_available():
+        logger.warning('SHM_SEGMENTS needs Python 3.8+, sync mode sends images through pool pipe')
+        yield
+        return
+    shared_buffers = SharedBufferPool(count, CONFIG['shared_memory']['segment_size'])
+    await shared_buffers.open()
+    app.shared_buffers = shared_buffers
+    logger.info("Shared memory started")
+    yield
+    # after process pool shutdown, no worker uses segments
+    shared_buffers.close()
+    logger.info("Shared memory stopped")
+
+
+async def mark_failed(app: Application, file_id: str) -> None:
+    ERRORS.inc('dead_letter')
+    data = await app.repository.get(file_id)
+    if not data:
+        return
+    changes = {
+        "status": "error",
+        "updated_file_path": None,
+    }
+    if data.get('outputs'):
+        changes['outputs'] = [
+            dict(output, status='error', updated_file_path=None) for output in data['outputs']
+        ]
+    await update_status(app, file_id, changes, status_from=STARTABLE_STATUSES)
+
+
+async def create_job_queue(app: Application) -> JobQueue:
+    if CONFIG['queue']['backend'] == 'redis':
+        job_queue = RedisJobQueue(
+            app.repository.pool,
+            stream=CONFIG['queue']['stream'],
+            group=CONFIG['queue']['group'],
+            max_size=CONFIG['queue']['max_size'],
+            visibility_timeout=CONFIG['queue']['visibility_timeout'],
+            max_retries=CONFIG['queue']['max_retries'],
+            on_dead_letter=partial(mark_failed, app),
+        )
+        await job_queue.create_group()
+        return job_queue
+    if CONFIG['role'] != 'all':
+        raise RuntimeError(f"Role {CONFIG['role']} needs redis queue backend")
+    return LocalJobQueue(max_size=CONFIG['queue']['max_size'])
+
+
 async def queue_listener_process(app: Application) -> None:
-    input_images_queue = asyncio.Queue()
-    app.input_images_queue = input_images_queue
-    process_pool = ProcessPoolExecutor(
-        initializer=register_signal_handler
+    scheduler = ResizeScheduler(
+        await create_job_queue(app),
+        max_in_flight=CONFIG['queue']['max_in_flight'],
     )
+    app.scheduler = scheduler
+    if CONFIG['role'] == 'api':
+        # only put jobs to queue, workers on other nodes resize it
+        logger.info('Services started')
+        yield
+        logger.info('Services stopped')
+        return
+    process_pool = create_executor(app.files_storage)
     loop = asyncio.get_event_loop()
     input_queue_listener_task = loop.create_task(
-        input_queue_listener(app)
+        scheduler.listen(partial(resize_task, app))
     )
     app.process_pool = process_pool
     logger.info('Services started')
@@ -107,6 +325,49 @@ async def queue_listener_process(app: Application) -> None:
     logger.info('Services stopped')
 
 
+def run_worker(app: Application) -> None:
+    # app startup without http server
+    loop = asyncio.get_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    if CONFIG['metrics_port']:
+        # worker stages are measured here, api nodes don't see them
+        site = web.TCPSite(runner, host=CONFIG.get('host'), port=CONFIG['metrics_port'])
+        loop.run_until_complete(site.start())
+    logger.info('Worker started')
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+
+def create_app() -> Application:
+    app = web.Application()
+    app.cleanup_ctx.append(repository_process)
+    app.cleanup_ctx.append(files_storage_process)
+    app.cleanup_ctx.append(notifier_process)
+    app.cleanup_ctx.append(shared_buffers_process)
+    app.cleanup_ctx.append(queue_listener_process)
+    if CONFIG['role'] == 'worker':
+        app.add_routes([web.get('/metrics', get_metrics)])
+        return app
+    setup_aiohttp_apispec(app)
+    app.middlewares.append(validation_middleware)
+    app.add_routes([
+        web.post('/api/v1/image', load_image),
+        web.get('/api/v1/image/{image_id}', get_image),
+        web.get('/api/v1/image/{image_id}/check', check_status),
+        web.post('/api/v1/images/status', check_statuses),
+        web.get('/api/v1/image/{image_id}/events', status_events),
+        web.get('/api/v1/queue', check_queue),
+        web.get('/metrics', get_metrics),
+        web.post('/api/v1/batch', load_batch),
+        web.get('/api/v1/batch/{batch_id}', check_batch),
+        web.get('/api/v1/batch/{batch_id}/{file_index}/{output_index}', get_batch_image),
+    ])
+    return app
+
+
 if __name__ == '__main__':
     with suppress(KeyboardInterrupt):
         handler = logging.StreamHandler()
@@ -115,19 +376,12 @@ if __name__ == '__main__':
         handler.setFormatter(formatter)
         if CONFIG.get('debug'):
             logger.setLevel(logging.DEBUG)
-        app = web.Application()
-        app.cleanup_ctx.append(repository_process)
-        app.cleanup_ctx.append(files_storage_process)
-        app.cleanup_ctx.append(queue_listener_process)
-        setup_aiohttp_apispec(app)
-        app.middlewares.append(validation_middleware)
-        app.add_routes([
-            web.post('/api/v1/image', load_image),
-            web.get('/api/v1/image/{image_id}', get_image),
-            web.get('/api/v1/image/{image_id}/check', check_status),
-        ])
-        web.run_app(
-            app,
-            host=CONFIG.get('host'),
-            port=CONFIG.get('port'),
-        )
+        app = create_app()
+        if CONFIG['role'] == 'worker':
+            run_worker(app)
+        else:
+            web.run_app(
+                app,
+                host=CONFIG.get('host'),
+                port=CONFIG.get('port'),
+            )
@@ -1,17 +1,96 @@
-from dataclasses import dataclass
-from typing import Dict
+from typing import Any, Dict, List, Tuple
+
+# version of job record in repository. 1 - long field names, JSON values (and JSON string before it)
+SCHEMA_VERSION = 2
+# field: short key in repository and type of value. Keys are not field names, so old records
+# with long names are told apart
+RECORD_FIELDS: Dict[str, Tuple[str, type]] = {
+    'id': ('i', str),
+    'status': ('s', str),
+    'default_image_path': ('d', str),
+    'file_name': ('f', str),
+    'width': ('w', int),
+    'height': ('h', int),
+    'scale': ('c', int),
+    'updated_file_path': ('u', str),
+    'source_hash': ('x', str),
+    'source_size': ('z', int),
+    'output': ('o', dict),
+    'resample': ('r', dict),
+    'batch_id': ('b', str),
+    'outputs': ('l', list),
+}
+REQUIRED_FIELDS = ('id', 'status', 'default_image_path', 'file_name', 'width', 'height', 'scale')
 
 
-@dataclass
 class ImageData:
-    id: str
-    status: str
-    default_image_path: str
-    file_name: str
-    width: int
-    height: int
-    scale: int
-    updated_file_path: str = None
+    # job record. Slots - no instance dict, millions of jobs pass through api and workers
+    __slots__ = tuple(RECORD_FIELDS)
+
+    def __init__(
+            self,
+            id: str,
+            status: str,
+            default_image_path: str,
+            file_name: str,
+            width: int,
+            height: int,
+            scale: int,
+            updated_file_path: str = None,
+            # sha256 of default image, for result cache
+            source_hash: str = None,
+            # in bytes, selects thread or process pool in hybrid executor
+            source_size: int = None,
+            # output format and encoder options, see OutputSchema
+            output: Dict = None,
+            # filter and reducing_gap, see ResampleSchema
+            resample: Dict = None,
+            # batch file: id of batch and list of outputs {width, height, scale, status, updated_file_path}
+            batch_id: str = None,
+            outputs: List[Dict] = None,
+    ) -> None:
+        self.id = id
+        self.status = status
+        self.default_image_path = default_image_path
+        self.file_name = file_name
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.updated_file_path = updated_file_path
+        self.source_hash = source_hash
+        self.source_size = source_size
+        self.output = output
+        self.resample = resample
+        self.batch_id = batch_id
+        self.outputs = outputs
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, ImageData):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
 
     def to_json(self) -> Dict:
-        return self.__dict__
+        # not set fields are not stored
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'ImageData':
+        # record read from repository, any version. ValueError if it is not a job
+        missing = [name for name in REQUIRED_FIELDS if data.get(name) is None]
+        if missing:
+            raise ValueError(f'Job record has no {", ".join(missing)}')
+        for name, value in data.items():
+            if name in RECORD_FIELDS and value is not None:
+                check_type(name, value)
+        return cls(**{name: value for name, value in data.items() if name in RECORD_FIELDS})
+
+
+def check_type(name: str, value: Any) -> None:
+    _, value_type = RECORD_FIELDS[name]
+    # bool is int, but not valid size
+    if not isinstance(value, value_type) or (value_type is int and isinstance(value, bool)):
+        raise ValueError(f'Job field {name} must be {value_type.__name__}, got {value!r}')
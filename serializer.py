@@ -1,7 +1,63 @@
+from typing import Dict, List, Mapping
+
 from marshmallow import Schema, fields, validate, post_load, validates, validates_schema, ValidationError
 
+from service.image_resizer import OUTPUT_FORMATS, MAX_SPEED, FILTERS, AUTO_FILTER
+
+OUTPUT_FIELDS = ('format', 'quality', 'progressive', 'optimize', 'compress_level', 'speed')
+RESAMPLE_FIELDS = ('filter', 'reducing_gap')
+
+
+class ResampleSchema(Schema):
+    # resize quality/speed trade-off. Not given - RESIZE_FILTER and RESIZE_REDUCING_GAP
+    filter = fields.Str(
+        validate=validate.OneOf([AUTO_FILTER, *FILTERS]),
+        required=False,
+    )
+    # 0 - disabled, else min 1.0 (Pillow limit)
+    reducing_gap = fields.Float(
+        validate=validate.Range(min=0, max=100),
+        required=False,
+    )
+
+    @validates('reducing_gap')
+    def validate_reducing_gap(self, value, **kwargs):
+        if 0 < value < 1:
+            raise ValidationError('Must be 0 or greater than or equal to 1.')
+
+
+class OutputSchema(Schema):
+    # format and encoder options of resized image. Not given - input format and Pillow defaults
+    format = fields.Str(
+        validate=validate.OneOf(list(OUTPUT_FORMATS)),
+        required=False,
+    )
+    # JPEG, WebP, AVIF
+    quality = fields.Int(
+        validate=validate.Range(min=1, max=100),
+        required=False,
+    )
+    # JPEG
+    progressive = fields.Bool(
+        required=False,
+    )
+    # JPEG, PNG
+    optimize = fields.Bool(
+        required=False,
+    )
+    # PNG, 0 - no compression, 9 - smallest
+    compress_level = fields.Int(
+        validate=validate.Range(min=0, max=9),
+        required=False,
+    )
+    # WebP, AVIF. 0 - smallest, 10 - fastest
+    speed = fields.Int(
+        validate=validate.Range(min=0, max=MAX_SPEED),
+        required=False,
+    )
+
 
-class ImageSchema(Schema):
+class ImageSchema(OutputSchema, ResampleSchema):
     scale = fields.Int(
         validate=validate.Range(min=1, max=100),
         required=False,
@@ -12,6 +68,14 @@ class ImageSchema(Schema):
     height = fields.Int(
         required=False,
     )
+    # resize in same request and return image
+    sync = fields.Bool(
+        required=False,
+    )
+    # with sync - reuse and store result in result cache
+    cache = fields.Bool(
+        required=False,
+    )
 
     @validates_schema
     def validates_schema(self, data, **kwargs):
@@ -24,3 +88,49 @@ class ImageSchema(Schema):
         if ((width and scale) or
                 (height and scale)):
             raise ValidationError(err_msg, field_name="error")
+
+
+class StatusRequestSchema(Schema):
+    # job ids for bulk status check
+    ids = fields.List(
+        fields.Str(),
+        validate=validate.Length(min=1),
+        required=True,
+    )
+
+
+def parse_sizes(value: str) -> List[Dict]:
+    # "800x600,200x,x100,s4" -> [{width, height, scale}, ...]. Empty side - keep aspect ratio, sN - scale
+    sizes = []
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        try:
+            if item.startswith('s'):
+                size = {'scale': int(item[1:])}
+            else:
+                width, height = item.split('x')
+                size = {'width': int(width or 0), 'height': int(height or 0)}
+        except ValueError:
+            raise ValidationError(f'Wrong size {item}', field_name='sizes')
+        size = ImageSchema(only=('width', 'height', 'scale')).load(size)
+        sizes.append({
+            'width': size.get('width', 0),
+            'height': size.get('height', 0),
+            'scale': size.get('scale', 0),
+        })
+    if not sizes:
+        raise ValidationError('No sizes', field_name='sizes')
+    return sizes
+
+
+def parse_output(query: Mapping) -> Dict:
+    # output options given in query, validated
+    return OutputSchema(only=OUTPUT_FIELDS).load(
+        {name: query[name] for name in OUTPUT_FIELDS if name in query}
+    )
+
+
+def parse_resample(query: Mapping) -> Dict:
+    # filter and reducing_gap given in query, validated
+    return ResampleSchema(only=RESAMPLE_FIELDS).load(
+        {name: query[name] for name in RESAMPLE_FIELDS if name in query}
+    )
@@ -1,12 +1,23 @@
 from .image_resizer import ImageResizer
 from .repository import RedisRepository
+from .repository_cache import CachedRepository
 from .file_storage import LocalFileStorage, AmazonFileStorage
 from .adapters import AiohttpAdapter
+from .scheduler import ResizeScheduler
+from .job_queue import LocalJobQueue, RedisJobQueue
+from .result_cache import ResultCache
+from .notifier import StatusNotifier
 
 __all__ = [
     'LocalFileStorage',
     'ImageResizer',
     'RedisRepository',
+    'CachedRepository',
     'AmazonFileStorage',
     'AiohttpAdapter',
+    'ResizeScheduler',
+    'LocalJobQueue',
+    'RedisJobQueue',
+    'ResultCache',
+    'StatusNotifier',
 ]
@@ -1,5 +1,11 @@
 import abc
-from typing import Any, Optional
+import os
+from typing import Any, Optional, Dict
+
+from aiofile import AIOFile, Reader
+from aiohttp import web
+
+from config import CONFIG
 
 
 class AdapterBase(metaclass=abc.ABCMeta):
@@ -12,21 +18,97 @@ class AdapterBase(metaclass=abc.ABCMeta):
     async def write(self, body: Any) -> Optional[Any]:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def prepare(
+            self,
+            content_length: Optional[int] = None,
+            status: int = 200,
+            headers: Optional[Dict] = None,
+    ) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_header(self, name: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def send_file(self, file_path: str) -> None:
+        # fallback with fixed size chunks, override it if framework can use sendfile
+        await self.prepare(content_length=os.path.getsize(file_path))
+        async with AIOFile(file_path, 'rb') as f:
+            async for chunk in Reader(f, chunk_size=CONFIG['download_chunk_size']):
+                await self.write(chunk)
+
+
+class SentFileResponse(web.FileResponse):
+    # adapter sends file before handler returns response, aiohttp must not send it again
+    # (newer aiohttp calls prepare() of returned response even if it is prepared)
+
+    async def prepare(self, request: Any) -> Any:
+        if self.prepared:
+            return None
+        return await super().prepare(request)
+
 
 class AiohttpAdapter(AdapterBase):
     # Todo think how to standardize this
-    def __init__(self, request: Any = None, response: Any = None) -> None:
+    def __init__(
+            self,
+            request: Any = None,
+            response: Any = None,
+            headers: Optional[Dict] = None,
+            field: Any = None,
+    ) -> None:
         self.request = request
         self.response = response
+        # headers for response created by adapter
+        self.headers = headers or {}
+        # multipart field to read, next field of request if not set
+        self.field = field
+        # size of read upload
+        self.bytes_read = 0
 
     async def read(self) -> Any:
-        reader = await self.request.multipart()
-        field = await reader.next()
+        field = self.field
+        if field is None:
+            reader = await self.request.multipart()
+            field = await reader.next()
         while True:
             chunk = await field.read_chunk()
             if not chunk:
                 break
+            self.bytes_read += len(chunk)
             yield chunk
 
+    def get_header(self, name: str) -> Optional[str]:
+        if not self.request:
+            return None
+        return self.request.headers.get(name)
+
+    async def prepare(
+            self,
+            content_length: Optional[int] = None,
+            status: int = 200,
+            headers: Optional[Dict] = None,
+    ) -> None:
+        if self.response is None:
+            self.response = web.StreamResponse(status=status, headers=self.headers)
+        if self.response.prepared:
+            return
+        self.response.headers.update(headers or {})
+        if content_length is not None:
+            self.response.content_length = content_length
+        await self.response.prepare(self.request)
+
     async def write(self, body: Any) -> None:
+        await self.prepare()
         await self.response.write(body)
+
+    async def send_file(self, file_path: str) -> None:
+        # sendfile(2) if loop supports it, Content-Length and Range handled by aiohttp
+        response = SentFileResponse(
+            file_path,
+            chunk_size=CONFIG['download_chunk_size'],
+            headers=self.headers,
+        )
+        await response.prepare(self.request)
+        self.response = response
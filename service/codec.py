@@ -0,0 +1,43 @@
+import json
+from typing import Any, Callable, Tuple, Union
+
+try:
+    # faster JSON, optional
+    import orjson
+except ImportError:
+    orjson = None
+
+from config import CONFIG
+
+BACKENDS = ('auto', 'orjson', 'json')
+
+
+# compact like orjson, so records are same with any backend. json.dumps with options
+# makes new encoder on every call
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+_decoder = json.JSONDecoder()
+
+
+def _json_dumps(data: Any) -> bytes:
+    return _encoder.encode(data).encode()
+
+
+def _json_loads(data: Union[bytes, str]) -> Any:
+    if isinstance(data, bytes):
+        data = data.decode()
+    return _decoder.decode(data)
+
+
+def get_backend(name: str) -> Tuple[str, Callable[[Any], bytes], Callable[[Union[bytes, str]], Any]]:
+    # name, dumps, loads. auto - orjson if installed, else json
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown serializer {name}, choose one of {BACKENDS}')
+    if name == 'orjson' or (name == 'auto' and orjson):
+        if orjson is None:
+            raise RuntimeError('Serializer orjson is not installed')
+        return 'orjson', orjson.dumps, orjson.loads
+    return 'json', _json_dumps, _json_loads
+
+
+# repository records, pub/sub messages and API responses
+BACKEND, dumps, loads = get_backend(CONFIG['serializer'])
@@ -0,0 +1,33 @@
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Optional
+
+
+class HybridExecutor(Executor):
+    # small images resized in threads: no pickling and IPC, Pillow releases GIL in decode,
+    # resize and encode. Big images in processes: Python parts run in parallel and worker
+    # memory is returned to OS with process recycling
+
+    def __init__(self, process_pool: Executor, thread_pool: Executor, threshold: int) -> None:
+        self.process_pool = process_pool
+        self.thread_pool = thread_pool
+        # source size in bytes, up to it image resized in thread
+        self.threshold = threshold
+
+    def select(self, size: Optional[int]) -> Executor:
+        if size is not None and size <= self.threshold:
+            return self.thread_pool
+        return self.process_pool
+
+    def submit(self, fn: Callable, *args: Any, **kwargs: Any) -> Future:
+        # size unknown
+        return self.process_pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, **kwargs: Any) -> None:
+        self.thread_pool.shutdown(wait=wait)
+        self.process_pool.shutdown(wait=wait)
+
+
+def select_executor(pool: Optional[Executor], size: Optional[int]) -> Optional[Executor]:
+    if isinstance(pool, HybridExecutor):
+        return pool.select(size)
+    return pool
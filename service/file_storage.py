@@ -1,17 +1,36 @@
 import abc
+import hashlib
 import os
+import tempfile
+from contextlib import AsyncExitStack, suppress
+from typing import BinaryIO, Callable, Optional, Union, Dict
 
-import aiobotocore
 import botocore.session
-from aiofile import Writer, AIOFile, LineReader
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from aiofile import Writer, AIOFile
 from aiofiles.os import remove
 from aiohttp import BodyPartReader
 from aiohttp.web import StreamResponse
 from botocore.client import BaseClient
+from botocore.config import Config
 from botocore.exceptions import EndpointConnectionError, ClientError
 
 from config import CONFIG
 from service.adapters import AdapterBase
+from service.s3_multipart import MultipartWriter
+
+
+# sync S3 client, one per worker process
+_sync_client = None
+# in bytes, default image loaded from S3 kept in memory up to this size, bigger - in temp file
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+AWS_ERRORS = (
+    EndpointConnectionError,
+    ConnectionError,
+    ClientError,
+)
 
 
 class ImageNotFoundError(BaseException):
@@ -28,21 +47,45 @@ class ConnectionStorageError(BaseException):
 
 class FileStorage(metaclass=abc.ABCMeta):
 
+    @abc.abstractmethod
+    # called in event loop process on app start
+    async def connect(self) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def disconnect(self) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    # called in process pool initializer
+    def init_worker(self) -> None:
+        raise NotImplementedError
+
     @abc.abstractmethod
     def get_default(self, image_name: str) -> bytes:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    # path or file object for Image.open, whole file is not read into memory
+    def open_default(self, image_name: str) -> Union[str, BinaryIO]:
+        raise NotImplementedError
+
     @abc.abstractmethod
     def save_result(self, image: bytes, image_name: str) -> str:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    # encoder writes image straight to result file object
+    def encode_result(self, image_name: str, encoder: Callable[[BinaryIO], None]) -> str:
+        raise NotImplementedError
+
     @abc.abstractmethod
     def delete_default(self, image_name: str) -> None:
         raise NotImplementedError
 
     @abc.abstractmethod
-    # async because used in handlers
-    async def save_default(self, filename: str, field: BodyPartReader) -> None:
+    # async because used in handlers. Returns sha256 hex digest of saved file
+    async def save_default(self, filename: str, field: BodyPartReader) -> str:
         raise NotImplementedError
 
     @abc.abstractmethod
@@ -61,6 +104,15 @@ class LocalFileStorage(FileStorage):
     def __init__(self, images_path: str) -> None:
         self.images_path = images_path
 
+    async def connect(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+    def init_worker(self) -> None:
+        pass
+
     def get_default(self, image_name: str) -> bytes:
         full_path = os.path.join(self.images_path, image_name)
         if not os.path.exists(full_path):
@@ -69,6 +121,13 @@ class LocalFileStorage(FileStorage):
             image = f.read()
         return image
 
+    def open_default(self, image_name: str) -> str:
+        full_path = os.path.join(self.images_path, image_name)
+        if not os.path.exists(full_path):
+            raise ImageNotFoundError(f"Not found {full_path}")
+        # Pillow reads file by itself and mmap it if possible
+        return full_path
+
     def save_result(self, image: bytes, image_name: str) -> str:
         if not os.path.exists(self.images_path,):
             raise PathNotFoundError(f"Not found {self.images_path}")
@@ -77,6 +136,18 @@ class LocalFileStorage(FileStorage):
             f.write(image)
         return full_path
 
+    def encode_result(self, image_name: str, encoder: Callable[[BinaryIO], None]) -> str:
+        if not os.path.exists(self.images_path):
+            raise PathNotFoundError(f"Not found {self.images_path}")
+        full_path = os.path.join(self.images_path, f'resized_{image_name}')
+        try:
+            with open(full_path, 'wb') as f:
+                encoder(f)
+        except BaseException:
+            os.remove(full_path)
+            raise
+        return full_path
+
     def delete_default(self, image_name: str) -> None:
         if not os.path.exists(self.images_path):
             raise PathNotFoundError(f"Not found {self.images_path}")
@@ -85,12 +156,15 @@ class LocalFileStorage(FileStorage):
             raise ImageNotFoundError(f"Not found {full_path}")
         os.remove(full_path)
 
-    async def save_default(self, filename: str, view_adapter: AdapterBase) -> None:
+    async def save_default(self, filename: str, view_adapter: AdapterBase) -> str:
+        hash_sum = hashlib.sha256()
         async with AIOFile(os.path.join(self.images_path, filename), 'wb') as f:
             writer = Writer(f)
             async for chunk in view_adapter.read():
+                hash_sum.update(chunk)
                 await writer(chunk)
             await f.fsync()
+        return hash_sum.hexdigest()
 
     async def delete_result(self, file_path: str) -> None:
         if not os.path.exists(file_path):
@@ -98,12 +172,12 @@ class LocalFileStorage(FileStorage):
         await remove(file_path)
 
     async def write_result(self, file_path: str, view_adapter: AdapterBase) -> None:
+        if not os.path.exists(file_path):
+            raise PathNotFoundError(f"Not found {file_path}")
         try:
-            async with AIOFile(file_path, 'rb') as f:
-                async for line in LineReader(f):
-                    await view_adapter.write(line)
+            await view_adapter.send_file(file_path)
         except FileNotFoundError:
-            raise PathNotFoundError(f"Not found {self.images_path}")
+            raise PathNotFoundError(f"Not found {file_path}")
 
 
 class AmazonFileStorage(FileStorage):
@@ -112,22 +186,82 @@ class AmazonFileStorage(FileStorage):
         self.images_path = images_path
         self.bucket = CONFIG['amazon'].get("bucket")
         self.folder = CONFIG['amazon'].get("folder")
+        # store default images in S3 instead of images_path, so any node can resize it
+        self.store_default = CONFIG['amazon'].get("store_default")
+        # async client, one per app lifecycle
+        self.client = None
+        self._exit_stack = None
+
+    def __getstate__(self) -> Dict:
+        # storage pickled to worker processes, async client can't leave event loop
+        state = self.__dict__.copy()
+        state['client'] = None
+        state['_exit_stack'] = None
+        return state
+
+    def _get_client_params(self) -> Dict:
+        return dict(
+            service_name='s3',
+            region_name=CONFIG['amazon'].get("region"),
+            aws_secret_access_key=CONFIG['amazon'].get('aws_secret_access'),
+            aws_access_key_id=CONFIG['amazon'].get('aws_access_key'),
+            use_ssl=CONFIG['amazon'].get('ssl'),
+            endpoint_url=CONFIG['amazon'].get('endpoint_url'),
+        )
+
+    async def connect(self) -> None:
+        session = get_session()
+        self._exit_stack = AsyncExitStack()
+        self.client = await self._exit_stack.enter_async_context(
+            session.create_client(
+                config=AioConfig(max_pool_connections=CONFIG['amazon'].get('max_pool_connections')),
+                **self._get_client_params(),
+            )
+        )
+
+    async def disconnect(self) -> None:
+        if self._exit_stack:
+            await self._exit_stack.aclose()
+        self.client = None
+        self._exit_stack = None
+
+    def init_worker(self) -> None:
+        global _sync_client
+        session = botocore.session.get_session()
+        _sync_client = session.create_client(
+            config=Config(max_pool_connections=CONFIG['amazon'].get('max_pool_connections')),
+            **self._get_client_params(),
+        )
 
     def _get_client(self, sync: bool = False) -> botocore.client:
         if sync:
-            session = botocore.session.get_session()
-        else:
-            session = aiobotocore.get_session()
-        client = session.create_client(
-             service_name='s3',
-             region_name=CONFIG['amazon'].get("region"),
-             aws_secret_access_key=CONFIG['amazon'].get('aws_secret_access'),
-             aws_access_key_id=CONFIG['amazon'].get('aws_access_key'),
-             use_ssl=CONFIG['amazon'].get('ssl'),
-        )
-        return client
+            if _sync_client is None:
+                self.init_worker()
+            return _sync_client
+        if self.client is None:
+            raise ConnectionStorageError("Connection error for AWS: client is not connected")
+        return self.client
+
+    def _get_default_key(self, image_name: str) -> str:
+        return f'{self.folder}/default/{image_name}'
+
+    def _get_default_object(self, image_name: str) -> Dict:
+        key = self._get_default_key(image_name)
+        try:
+            return self._get_client(sync=True).get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                raise ImageNotFoundError(f"Not found {key}")
+            raise ConnectionStorageError(f"Connection error for AWS: {e}")
+        except (
+                EndpointConnectionError,
+                ConnectionError,
+        ) as e:
+            raise ConnectionStorageError(f"Connection error for AWS: {e}")
 
     def get_default(self, image_name: str) -> bytes:
+        if self.store_default:
+            return self._get_default_object(image_name)['Body'].read()
         full_path = os.path.join(self.images_path, image_name)
         if not os.path.exists(full_path):
             raise ImageNotFoundError(f"Not found {full_path}")
@@ -135,7 +269,25 @@ class AmazonFileStorage(FileStorage):
             image = f.read()
         return image
 
-    def save_result(self, image: bytes, image_name: str) -> str:
+    def open_default(self, image_name: str) -> Union[str, BinaryIO]:
+        if self.store_default:
+            # Pillow needs seekable file, S3 body is stream
+            body = self._get_default_object(image_name)['Body']
+            image_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            try:
+                for chunk in body.iter_chunks(CONFIG['download_chunk_size']):
+                    image_file.write(chunk)
+            except AWS_ERRORS as e:
+                image_file.close()
+                raise ConnectionStorageError(f"Connection error for AWS: {e}")
+            image_file.seek(0)
+            return image_file
+        full_path = os.path.join(self.images_path, image_name)
+        if not os.path.exists(full_path):
+            raise ImageNotFoundError(f"Not found {full_path}")
+        return full_path
+
+    def save_result(self, image: Union[bytes, BinaryIO], image_name: str) -> str:
         key = f'{self.folder}/resized_{image_name}'
         client = self._get_client(sync=True)
         try:
@@ -152,7 +304,38 @@ class AmazonFileStorage(FileStorage):
             raise ConnectionStorageError(f"Connection error for AWS: {e}")
         return key
 
+    def encode_result(self, image_name: str, encoder: Callable[[BinaryIO], None]) -> str:
+        key = f'{self.folder}/resized_{image_name}'
+        writer = MultipartWriter(
+            client=self._get_client(sync=True),
+            bucket=self.bucket,
+            key=key,
+            threshold=CONFIG['amazon'].get('multipart_threshold'),
+            part_size=CONFIG['amazon'].get('multipart_part_size'),
+            concurrency=CONFIG['amazon'].get('multipart_concurrency'),
+        )
+        try:
+            encoder(writer)
+            writer.close()
+        except (
+                EndpointConnectionError,
+                ConnectionError,
+                ClientError,
+        ) as e:
+            writer.abort()
+            raise ConnectionStorageError(f"Connection error for AWS: {e}")
+        except BaseException:
+            writer.abort()
+            raise
+        return key
+
     def delete_default(self, image_name: str) -> None:
+        if self.store_default:
+            try:
+                self._get_client(sync=True).delete_object(Bucket=self.bucket, Key=self._get_default_key(image_name))
+            except AWS_ERRORS as e:
+                raise ConnectionStorageError(f"Connection error for AWS: {e}")
+            return
         if not os.path.exists(self.images_path):
             raise PathNotFoundError(f"Not found {self.images_path}")
         full_path = os.path.join(self.images_path, image_name)
@@ -160,35 +343,121 @@ class AmazonFileStorage(FileStorage):
             raise ImageNotFoundError(f"Not found {full_path}")
         os.remove(full_path)
 
-    async def save_default(self, filename: str, view_adapter: AdapterBase) -> None:
+    async def save_default(self, filename: str, view_adapter: AdapterBase) -> str:
+        if self.store_default:
+            return await self._upload_default(filename, view_adapter)
+        hash_sum = hashlib.sha256()
         async with AIOFile(os.path.join(self.images_path, filename), 'wb') as f:
             writer = Writer(f)
             async for chunk in view_adapter.read():
+                hash_sum.update(chunk)
                 await writer(chunk)
             await f.fsync()
+        return hash_sum.hexdigest()
+
+    async def _upload_default(self, filename: str, view_adapter: AdapterBase) -> str:
+        # upload streamed to S3 by parts as it arrives, only one part kept in memory
+        hash_sum = hashlib.sha256()
+        client = self._get_client()
+        key = self._get_default_key(filename)
+        part_size = CONFIG['amazon'].get('multipart_part_size')
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        try:
+            async for chunk in view_adapter.read():
+                hash_sum.update(chunk)
+                buffer += chunk
+                if len(buffer) < part_size:
+                    continue
+                if upload_id is None:
+                    response = await client.create_multipart_upload(Bucket=self.bucket, Key=key)
+                    upload_id = response['UploadId']
+                parts.append(await self._upload_default_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+                buffer = bytearray()
+            if upload_id is None:
+                await client.put_object(Bucket=self.bucket, Key=key, Body=bytes(buffer))
+                return hash_sum.hexdigest()
+            if buffer:
+                parts.append(await self._upload_default_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+            await client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except AWS_ERRORS as e:
+            await self._abort_upload_default(key, upload_id)
+            raise ConnectionStorageError(f"Connection error for AWS: {e}")
+        except BaseException:
+            # upload broken by client or cancelled, uploaded parts are kept and billed until aborted
+            await self._abort_upload_default(key, upload_id)
+            raise
+        return hash_sum.hexdigest()
+
+    async def _abort_upload_default(self, key: str, upload_id: Optional[str]) -> None:
+        if upload_id is None:
+            return
+        with suppress(*AWS_ERRORS):
+            await self._get_client().abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+    async def _upload_default_part(self, key: str, upload_id: str, part_number: int, data: bytes) -> Dict:
+        response = await self._get_client().upload_part(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
 
     async def delete_result(self, file_path: str) -> None:
-        async with self._get_client() as client:
-            try:
-                await client.delete_object(Bucket=self.bucket, Key=file_path)
-            except (
-                EndpointConnectionError,
-                ConnectionError,
-                ClientError,
-            ) as e:
-                raise ConnectionStorageError(f"Connection error for AWS: {e}")
+        client = self._get_client()
+        try:
+            await client.delete_object(Bucket=self.bucket, Key=file_path)
+        except (
+            EndpointConnectionError,
+            ConnectionError,
+            ClientError,
+        ) as e:
+            raise ConnectionStorageError(f"Connection error for AWS: {e}")
 
     async def write_result(self, file_path: str, view_adapter: AdapterBase) -> None:
         key = file_path
-        async with self._get_client() as client:
-            try:
-                response_aws = await client.get_object(Bucket=self.bucket, Key=key)
-            except (
-                EndpointConnectionError,
-                ConnectionError,
-                ClientError,
-            ) as e:
-                raise ConnectionStorageError(f"Connection error for AWS: {e}")
-            async with response_aws['Body'] as stream:
-                body = await stream.read()
-                await view_adapter.write(body)
+        client = self._get_client()
+        params = {'Bucket': self.bucket, 'Key': key}
+        range_header = view_adapter.get_header('Range')
+        if range_header:
+            # forwarded as ranged GET, S3 validates it
+            params['Range'] = range_header
+        try:
+            response_aws = await client.get_object(**params)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                await view_adapter.prepare(status=416)
+                return
+            raise ConnectionStorageError(f"Connection error for AWS: {e}")
+        except (
+            EndpointConnectionError,
+            ConnectionError,
+        ) as e:
+            raise ConnectionStorageError(f"Connection error for AWS: {e}")
+        headers = {'Accept-Ranges': 'bytes'}
+        if response_aws.get('ETag'):
+            headers['ETag'] = response_aws['ETag']
+        status = 200
+        if response_aws.get('ContentRange'):
+            status = 206
+            headers['Content-Range'] = response_aws['ContentRange']
+        await view_adapter.prepare(
+            content_length=response_aws.get('ContentLength'),
+            status=status,
+            headers=headers,
+        )
+        async with response_aws['Body'] as stream:
+            # one chunk in memory, write waits while client reads it
+            while True:
+                chunk = await stream.read(CONFIG['download_chunk_size'])
+                if not chunk:
+                    break
+                await view_adapter.write(chunk)
@@ -1,12 +1,101 @@
 import io
-from typing import Union, Optional, Tuple
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import Union, Optional, Tuple, List, Dict, Any, Callable, BinaryIO, Iterator
 
 from PIL import Image
 
+try:
+    # AVIF encoder for old Pillow, optional
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+from config import CONFIG
 from service.file_storage import ImageNotFoundError, PathNotFoundError, AmazonFileStorage, LocalFileStorage, \
     ConnectionStorageError, FileStorage
 
 
+# in auto filter mode and for JPEG draft: image reduced in REDUCING_GAP times and more is big reduce
+REDUCING_GAP = 2.0
+FILTERS = {
+    'nearest': Image.NEAREST,
+    'box': Image.BOX,
+    'bilinear': Image.BILINEAR,
+    'hamming': Image.HAMMING,
+    'bicubic': Image.BICUBIC,
+    'lanczos': Image.LANCZOS,
+}
+AUTO_FILTER = 'auto'
+
+Image.init()
+# output format param: Pillow format, only formats Pillow can save
+OUTPUT_FORMATS = {name.lower(): name for name in ('JPEG', 'PNG', 'WEBP', 'AVIF') if name in Image.SAVE}
+# modes Pillow saves in output format, other images converted to RGB (RGBA if image has alpha and format has it)
+SAVE_MODES = {
+    'JPEG': ('1', 'L', 'RGB', 'CMYK'),
+    'PNG': ('1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA'),
+    'WEBP': ('RGB', 'RGBA'),
+    'AVIF': ('RGB', 'RGBA'),
+}
+# WebP method is 0 (fast) - 6 (small), speed param is 0 (small) - 10 (fast) like AVIF speed
+WEBP_MAX_METHOD = 6
+MAX_SPEED = 10
+
+
+def get_output_format(image_name: str, output: Optional[Dict] = None) -> str:
+    if output and output.get('format'):
+        return OUTPUT_FORMATS[output['format']]
+    format_image = image_name.split('.')[-1:][0].upper()
+    return 'JPEG' if format_image == 'JPG' else format_image
+
+
+def get_output_name(image_name: str, output: Optional[Dict] = None) -> str:
+    # extension of result changed with format
+    if not output or not output.get('format'):
+        return image_name
+    return f"{image_name.rsplit('.', 1)[0]}.{output['format']}"
+
+
+def resolve_resample(resample: Optional[Dict] = None) -> Dict[str, Any]:
+    # filter and reducing_gap, server defaults for not given
+    resample = resample or {}
+    reducing_gap = resample.get('reducing_gap')
+    if reducing_gap is None:
+        reducing_gap = CONFIG['resize']['reducing_gap']
+    return {'filter': resample.get('filter') or CONFIG['resize']['filter'], 'reducing_gap': reducing_gap}
+
+
+def convert_for_format(image: Image.Image, format_image: str) -> Image.Image:
+    # CMYK source saved as PNG or WebP, alpha or palette as JPEG
+    modes = SAVE_MODES.get(format_image)
+    if modes is None or image.mode in modes:
+        return image
+    alpha = 'A' in image.mode or (image.mode == 'P' and 'transparency' in image.info)
+    return image.convert('RGBA' if alpha and 'RGBA' in modes else 'RGB')
+
+
+def get_save_params(format_image: str, output: Optional[Dict] = None) -> Dict[str, Any]:
+    # Pillow save() params for format, not given options - Pillow defaults
+    output = output or {}
+    params = {}
+    if format_image in ('JPEG', 'WEBP', 'AVIF') and output.get('quality') is not None:
+        params['quality'] = output['quality']
+    if format_image in ('JPEG', 'PNG') and output.get('optimize') is not None:
+        params['optimize'] = output['optimize']
+    if format_image == 'JPEG' and output.get('progressive') is not None:
+        params['progressive'] = output['progressive']
+    if format_image == 'PNG' and output.get('compress_level') is not None:
+        params['compress_level'] = output['compress_level']
+    if output.get('speed') is not None:
+        if format_image == 'WEBP':
+            params['method'] = round(WEBP_MAX_METHOD * (MAX_SPEED - output['speed']) / MAX_SPEED)
+        elif format_image == 'AVIF':
+            params['speed'] = output['speed']
+    return params
+
+
 class ImageResizerError(BaseException):
     pass
 
@@ -19,73 +108,262 @@ class ImageResizer:
         self.width = None
         self.height = None
         self.scale = None
+        # output format and encoder options, see get_save_params
+        self.output = None
+        # filter and reducing_gap, server defaults if not given
+        self.resample = None
+        self.draft = CONFIG['resize']['draft']
+        # secs by stage and error types of last call, sent to parent process for metrics
+        self.timings: Dict[str, float] = {}
+        self.error_types: List[str] = []
+
+    def _reset_metrics(self) -> None:
+        self.timings = {}
+        self.error_types = []
 
-    def _get_image(self) -> Image.Image:
+    @contextmanager
+    def _timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
         try:
-            image_data = self.file_storage.get_default(self.image_name)
-        except ImageNotFoundError:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    def _add_error(self, error: BaseException) -> None:
+        self.error_types.append(type(error).__name__)
+
+    @contextmanager
+    def _open_image(self) -> Iterator[Image.Image]:
+        # source file closed on exit, image must be loaded before it. S3 source is spooled temp file
+        try:
+            image_source = self.file_storage.open_default(self.image_name)
+        except (ImageNotFoundError, ConnectionStorageError):
             raise
-        image = Image.open(io.BytesIO(image_data))
-        return image
+        try:
+            # lazy open, data decoded on resize
+            with self._timed('storage_load'):
+                image = Image.open(image_source)
+            yield image
+        finally:
+            if not isinstance(image_source, str):
+                image_source.close()
+
+    def _get_encoder(self, image: Image.Image) -> Callable[[BinaryIO], None]:
+        format_image = get_output_format(self.image_name, self.output)
+        image = convert_for_format(image, format_image)
+        return partial(image.save, format=format_image, **get_save_params(format_image, self.output))
+
+    def _get_timed_encoder(self, image: Image.Image) -> Callable[[BinaryIO], None]:
+        encoder = self._get_encoder(image)
+
+        def encode(file: BinaryIO) -> None:
+            with self._timed('encode'):
+                encoder(file)
+        return encode
 
     def _save_image(self, image: Image.Image) -> str:
-        format_image = self.image_name.split('.')[-1:][0].upper()
-        bytes_data = io.BytesIO()
-        image.save(bytes_data, format=format_image)
+        encode_before = self.timings.get('encode', 0.0)
+        start = time.perf_counter()
         try:
-            saved = self.file_storage.save_result(bytes_data.getvalue(), self.image_name)
+            saved = self.file_storage.encode_result(
+                get_output_name(self.image_name, self.output),
+                self._get_timed_encoder(image),
+            )
         except PathNotFoundError:
             raise
+        finally:
+            # storage encodes into file or buffer, rest of time is write or upload
+            encode_time = self.timings.get('encode', 0.0) - encode_before
+            self.timings['storage_save'] = (
+                self.timings.get('storage_save', 0.0) + time.perf_counter() - start - encode_time
+            )
         return saved
 
     def _delete_default_image(self) -> None:
         try:
             self.file_storage.delete_default(self.image_name)
-        except (PathNotFoundError, ImageNotFoundError):
+        except (PathNotFoundError, ImageNotFoundError, ConnectionStorageError):
             raise
 
-    def _resize_image(self, image: Image.Image) -> Image.Image:
+    def _get_new_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
         new_width = self.width
         new_height = self.height
         if self.width and self.height:
-            return image.resize((new_width, new_height))
+            return new_width, new_height
         elif self.width:
-            new_height = int(image.size[1] / (image.size[0] / self.width))
+            new_height = int(size[1] / (size[0] / self.width))
         elif self.height:
-            new_width = int(image.size[0] / (image.size[1] / self.height))
+            new_width = int(size[0] / (size[1] / self.height))
         elif self.scale:
-            new_width = int(image.size[0] / self.scale)
-            new_height = int(image.size[1] / self.scale)
-        return image.resize((new_width, new_height))
+            new_width = int(size[0] / self.scale)
+            new_height = int(size[1] / self.scale)
+        return new_width, new_height
+
+    def _get_resample(self, size: Tuple[int, int], new_size: Tuple[int, int]) -> Tuple[int, Optional[float]]:
+        resample = resolve_resample(self.resample)
+        name, reducing_gap = resample['filter'], resample['reducing_gap']
+        if name == AUTO_FILTER:
+            too_small = (
+                size[0] < new_size[0] * REDUCING_GAP and
+                size[1] < new_size[1] * REDUCING_GAP
+            )
+            if too_small:
+                # nothing to skip in decode, LANCZOS only adds cost
+                return Image.BICUBIC, None
+            name = 'lanczos'
+        return FILTERS[name], reducing_gap or None
+
+    def _is_big_reduce(self, size: Tuple[int, int], new_size: Tuple[int, int]) -> bool:
+        return size[0] >= new_size[0] * REDUCING_GAP or size[1] >= new_size[1] * REDUCING_GAP
+
+    def _resize_image(self, image: Image.Image) -> Image.Image:
+        # size of lazy opened image is source size, draft() changes it
+        new_size = self._get_new_size(image.size)
+        if self.draft and image.format == 'JPEG' and self._is_big_reduce(image.size, new_size):
+            # decode only at nearest DCT scale (1/2, 1/4, 1/8) at or above new size.
+            # Works if image not loaded yet
+            image.draft(image.mode, new_size)
+        with self._timed('decode'):
+            image.load()
+        return self._resize_from(image, new_size)
+
+    def _resize_from(self, image: Image.Image, new_size: Tuple[int, int]) -> Image.Image:
+        resample, reducing_gap = self._get_resample(image.size, new_size)
+        with self._timed('resize'):
+            return image.resize(new_size, resample, reducing_gap=reducing_gap)
 
     def resize_img(
             self,
             image_name: str,
             width: Union[str, int],
             height: Union[str, int],
-            scale: Union[str, int]
+            scale: Union[str, int],
+            output: Optional[Dict] = None,
+            resample: Optional[Dict] = None,
     ) -> Tuple[Optional[str], Optional[str]]:
         self.image_name, self.width, self.height, self.scale = image_name, width, height, scale
+        self.output, self.resample = output, resample
+        self._reset_metrics()
         error = None
+        image_after_update = None
         try:
-            image_before_update = self._get_image()
-        except ImageNotFoundError as e:
+            with self._open_image() as image_before_update:
+                image_after_update = self._resize_image(image_before_update)
+        except (ImageNotFoundError, ConnectionStorageError) as e:
+            self._add_error(e)
             return None, str(e)
-        image_after_update = self._resize_image(image_before_update)
+        except (OSError, ValueError, KeyError) as e:
+            # not image or broken, default image deleted, it can't be resized
+            self._add_error(e)
+            error = f"Resize img err: {e}"
         try:
             self._delete_default_image()
-        except (PathNotFoundError, ImageNotFoundError) as e:
+        except (PathNotFoundError, ImageNotFoundError, ConnectionStorageError) as e:
             # not return because we can clear files later (by cron for example)
-            error = f"Delete default img err: {e}"
+            self._add_error(e)
+            error = f"{error}; Delete default img err: {e}" if error else f"Delete default img err: {e}"
+        if image_after_update is None:
+            return None, error
         try:
             saved = self._save_image(image_after_update)
         except (
                 PathNotFoundError,
                 ConnectionStorageError,
+                # encoder errors
+                OSError,
+                ValueError,
+                KeyError,
         ) as e:
+            self._add_error(e)
             if error:
                 error = f"{error}; Save new img err: {e}"
             else:
                 error = f"Save new img err: {e}"
             return None, str(error)
         return saved, error
+
+    def resize_many(
+            self,
+            image_name: str,
+            sizes: List[Tuple[int, int, int]],
+            output: Optional[Dict] = None,
+            resample: Optional[Dict] = None,
+    ) -> List[Tuple[Optional[str], Optional[str]]]:
+        # batch: source decoded once, outputs resized from largest to smallest,
+        # each one from previous output if it is not smaller. Results in order of sizes
+        self.image_name = image_name
+        self.output, self.resample = output, resample
+        self._reset_metrics()
+        try:
+            with self._open_image() as image:
+                new_sizes = []
+                for width, height, scale in sizes:
+                    self.width, self.height, self.scale = width, height, scale
+                    new_sizes.append(self._get_new_size(image.size))
+                largest = max(new_sizes, key=lambda size: size[0] * size[1])
+                if self.draft and image.format == 'JPEG' and self._is_big_reduce(image.size, largest):
+                    image.draft(image.mode, largest)
+                with self._timed('decode'):
+                    image.load()
+        except (ImageNotFoundError, ConnectionStorageError) as e:
+            self._add_error(e)
+            return [(None, str(e))] * len(sizes)
+        except (OSError, ValueError, KeyError) as e:
+            # not image or broken, it can't be resized later too
+            self._add_error(e)
+            return self._delete_default_batch([(None, f"Resize img err: {e}")] * len(sizes))
+        results = [None] * len(sizes)
+        previous = image
+        for index in sorted(range(len(sizes)), key=lambda i: new_sizes[i][0] * new_sizes[i][1], reverse=True):
+            new_size = new_sizes[index]
+            source = previous
+            if previous.size[0] < new_size[0] or previous.size[1] < new_size[1]:
+                source = image
+            self.image_name = f'{index}_{image_name}'
+            try:
+                resized = self._resize_from(source, new_size)
+                results[index] = (self._save_image(resized), None)
+            except (PathNotFoundError, ConnectionStorageError) as e:
+                self._add_error(e)
+                results[index] = (None, f"Save new img err: {e}")
+            except (OSError, ValueError, KeyError) as e:
+                self._add_error(e)
+                results[index] = (None, f"Resize img err: {e}")
+                continue
+            previous = resized
+        self.image_name = image_name
+        return self._delete_default_batch(results)
+
+    def _delete_default_batch(
+            self,
+            results: List[Tuple[Optional[str], Optional[str]]],
+    ) -> List[Tuple[Optional[str], Optional[str]]]:
+        try:
+            self._delete_default_image()
+        except (PathNotFoundError, ImageNotFoundError, ConnectionStorageError) as e:
+            self._add_error(e)
+            results = [(path, error or f"Delete default img err: {e}") for path, error in results]
+        return results
+
+    def resize_bytes(
+            self,
+            image: Union[bytes, memoryview],
+            image_name: str,
+            width: Union[str, int],
+            height: Union[str, int],
+            scale: Union[str, int],
+            output: Optional[Dict] = None,
+            resample: Optional[Dict] = None,
+    ) -> Tuple[Optional[bytes], Optional[str]]:
+        # sync mode, image not stored: decoded from and encoded to memory
+        self.image_name, self.width, self.height, self.scale = image_name, width, height, scale
+        self.output, self.resample = output, resample
+        self._reset_metrics()
+        try:
+            image_after_update = self._resize_image(Image.open(io.BytesIO(image)))
+            result = io.BytesIO()
+            self._get_timed_encoder(image_after_update)(result)
+        except (OSError, ValueError, KeyError) as e:
+            self._add_error(e)
+            return None, f"Resize img err: {e}"
+        return result.getvalue(), None
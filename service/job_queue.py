@@ -0,0 +1,238 @@
+import abc
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import NamedTuple, Optional, Any, Callable, Awaitable
+
+import aioredis
+
+logger = logging.getLogger('app_logger')
+
+
+class QueueFullError(BaseException):
+    pass
+
+
+class Job(NamedTuple):
+    job_id: str
+    # unix time, jobs can be put and taken on different nodes
+    put_time: float
+    # backend specific id of queue entry
+    message_id: Optional[str] = None
+    # failed attempts before job was put again
+    attempts: int = 0
+
+
+class JobQueue(metaclass=abc.ABCMeta):
+    # in secs, how often touch() must be called for job in progress. None - not needed
+    heartbeat_interval = None
+
+    @abc.abstractmethod
+    async def put(self, job_id: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get(self) -> Job:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def ack(self, job: Job) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    # job failed, backend decides to retry it or not
+    async def fail(self, job: Job) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    # job still in progress
+    async def touch(self, job: Job) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def depth(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def is_full(self) -> bool:
+        raise NotImplementedError
+
+
+class LocalJobQueue(JobQueue):
+    # in-process queue, jobs lost if process dies
+
+    def __init__(self, max_size: int) -> None:
+        # max_size = 0 means unbounded queue (asyncio.Queue semantic)
+        self.max_size = max_size
+        self.queue = asyncio.Queue(maxsize=max_size)
+
+    async def put(self, job_id: str) -> None:
+        try:
+            self.queue.put_nowait(Job(job_id=job_id, put_time=time.time()))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Queue is full: {self.max_size} jobs waiting")
+
+    async def get(self) -> Job:
+        job = await self.queue.get()
+        self.queue.task_done()
+        return job
+
+    async def ack(self, job: Job) -> None:
+        pass
+
+    async def fail(self, job: Job) -> None:
+        pass
+
+    async def touch(self, job: Job) -> None:
+        pass
+
+    async def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def is_full(self) -> bool:
+        return self.queue.full()
+
+
+class RedisJobQueue(JobQueue):
+    # Redis stream with consumer group, shared by all nodes.
+    # Failed job put again at once, not acked job (worker died) given to other consumer
+    # after visibility_timeout. After max_retries attempts it moved to dead letter stream.
+
+    def __init__(
+            self,
+            pool: Any,
+            stream: str,
+            group: str,
+            max_size: int,
+            visibility_timeout: int,
+            max_retries: int,
+            consumer: Optional[str] = None,
+            on_dead_letter: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> None:
+        self.pool = pool
+        self.stream = stream
+        self.dead_letter_stream = f'{stream}:dead'
+        self.group = group
+        # max entries in stream (waiting and in progress). 0 - unbounded
+        self.max_size = max_size
+        self.visibility_timeout = visibility_timeout
+        self.max_retries = max_retries
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        # called with job_id of job moved to dead letter stream
+        self.on_dead_letter = on_dead_letter
+        self.heartbeat_interval = visibility_timeout / 3
+        # in ms, XREADGROUP waits so long and then checks stale jobs
+        self.block_timeout = 1000
+        self._reclaim_time = 0.0
+
+    async def create_group(self) -> None:
+        try:
+            await self.pool.xgroup_create(self.stream, self.group, latest_id='0', mkstream=True)
+        except aioredis.ReplyError as e:
+            # group already created by other node
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    async def put(self, job_id: str) -> None:
+        if await self.is_full():
+            raise QueueFullError(f"Queue is full: {self.max_size} jobs in queue")
+        await self.pool.xadd(self.stream, {'job_id': job_id, 'put_time': str(time.time())})
+
+    async def get(self) -> Job:
+        while True:
+            try:
+                job = await self._reclaim_stale()
+                if job:
+                    return job
+                messages = await self.pool.xread_group(
+                    self.group,
+                    self.consumer,
+                    [self.stream],
+                    timeout=self.block_timeout,
+                    count=1,
+                    latest_ids=['>'],
+                )
+            except (aioredis.RedisError, OSError) as e:
+                logger.error(f'Queue read error: {e}. Retry in 1 sec')
+                await asyncio.sleep(1)
+                continue
+            if messages:
+                _, message_id, fields = messages[0]
+                return self._to_job(message_id, fields)
+
+    async def _reclaim_stale(self) -> Optional[Job]:
+        if time.monotonic() - self._reclaim_time < self.visibility_timeout / 2:
+            return None
+        self._reclaim_time = time.monotonic()
+        pending = await self.pool.xpending(self.stream, self.group, '-', '+', 100)
+        for message_id, _, idle_time, deliveries in pending:
+            if idle_time < self.visibility_timeout * 1000:
+                continue
+            claimed = await self.pool.xclaim(
+                self.stream, self.group, self.consumer, self.visibility_timeout * 1000, message_id,
+            )
+            if not claimed or not claimed[0]:
+                # claimed by other node
+                continue
+            _, fields = claimed[0]
+            job = self._to_job(message_id, fields)
+            # deliveries of this entry and failed attempts before it
+            if job.attempts + deliveries >= self.max_retries:
+                await self._dead_letter(job, job.attempts + deliveries)
+                continue
+            # check again soon, there can be more stale jobs
+            self._reclaim_time = 0.0
+            return job
+        return None
+
+    async def _dead_letter(self, job: Job, attempts: int) -> None:
+        logger.error(f'Job {job.job_id} failed {attempts} times, moved to {self.dead_letter_stream}')
+        await self.pool.xadd(self.dead_letter_stream, {'job_id': job.job_id, 'deliveries': str(attempts)})
+        await self._remove(job.message_id)
+        if self.on_dead_letter:
+            await self.on_dead_letter(job.job_id)
+
+    async def _remove(self, message_id: Any) -> None:
+        await self.pool.xack(self.stream, self.group, message_id)
+        # acked entries deleted, so stream length is queue depth
+        await self.pool.xdel(self.stream, message_id)
+
+    @staticmethod
+    def _to_job(message_id: Any, fields: dict) -> Job:
+        return Job(
+            job_id=fields[b'job_id'].decode(),
+            put_time=float(fields[b'put_time']),
+            message_id=message_id.decode() if isinstance(message_id, bytes) else message_id,
+            attempts=int(fields.get(b'attempts', 0)),
+        )
+
+    async def ack(self, job: Job) -> None:
+        await self._remove(job.message_id)
+
+    async def fail(self, job: Job) -> None:
+        # put again at once, not after visibility_timeout. New entry and removal of old one are atomic
+        attempts = job.attempts + 1
+        if attempts >= self.max_retries:
+            await self._dead_letter(job, attempts)
+            return
+        transaction = self.pool.multi_exec()
+        transaction.xadd(self.stream, {'job_id': job.job_id, 'put_time': str(time.time()), 'attempts': str(attempts)})
+        transaction.xack(self.stream, self.group, job.message_id)
+        transaction.xdel(self.stream, job.message_id)
+        await transaction.execute()
+
+    async def touch(self, job: Job) -> None:
+        # reset idle time, JUSTID doesn't increase deliveries counter
+        await self.pool.execute(
+            b'XCLAIM', self.stream, self.group, self.consumer, 0, job.message_id, b'JUSTID',
+        )
+
+    async def depth(self) -> int:
+        return await self.pool.xlen(self.stream)
+
+    async def is_full(self) -> bool:
+        if not self.max_size:
+            return False
+        return await self.depth() >= self.max_size
@@ -0,0 +1,188 @@
+import math
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# secs, from fast repository ops to decode of 100 MP images
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    # Prometheus text format metric, values by tuple of label values
+    type_name = 'untyped'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: Sequence[str] = (),
+            registry: Optional['MetricsRegistry'] = None,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        (registry or REGISTRY).register(self)
+
+    def _key(self, label_values: Sequence[Any]) -> Tuple[str, ...]:
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f'{self.name} needs labels {self.label_names}, got {label_values}')
+        return tuple(str(value) for value in label_values)
+
+    def _labels(self, key: Tuple[str, ...], extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name}{self._labels(key)} {_format_value(value)}' for key, value in sorted(self._values.items())]
+
+    def render(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ] + self._samples()
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, *label_values: Any, amount: float = 1.0) -> None:
+        if amount < 0:
+            raise ValueError('Counter can only increase')
+        key = self._key(label_values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, *label_values: Any) -> float:
+        return self._values.get(self._key(label_values), 0.0)
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value: float, *label_values: Any) -> None:
+        self._values[self._key(label_values)] = value
+
+    def inc(self, *label_values: Any, amount: float = 1.0) -> None:
+        key = self._key(label_values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, *label_values: Any, amount: float = 1.0) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def get(self, *label_values: Any) -> float:
+        return self._values.get(self._key(label_values), 0.0)
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+            registry: Optional['MetricsRegistry'] = None,
+    ) -> None:
+        super().__init__(name, documentation, label_names, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        key = self._key(label_values)
+        # not cumulative counts per bucket, sum, count
+        counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, *label_values: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def get(self, *label_values: Any) -> Tuple[int, float]:
+        # count and sum of observed values
+        _, total, count = self._values.get(self._key(label_values)) or (None, 0.0, 0)
+        return count, total
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = self._labels(key, [('le', _format_value(bound))])
+                samples.append(f'{self.name}_bucket{labels} {cumulative}')
+            samples.append(f'{self.name}_sum{self._labels(key)} {_format_value(total)}')
+            samples.append(f'{self.name}_count{self._labels(key)} {count}')
+        return samples
+
+
+class MetricsRegistry:
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} already registered')
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+# upload, queue_wait, pool_wait, storage_load, decode, resize, encode, storage_save, download
+STAGE_SECONDS = Histogram('resize_stage_seconds', 'Time of image processing stage', ['stage'])
+REPOSITORY_SECONDS = Histogram('resize_repository_seconds', 'Time of repository operation', ['operation'])
+REPOSITORY_CACHE = Counter('resize_repository_cache_total', 'Repository reads by local cache result', ['result'])
+JOBS = Counter('resize_jobs_total', 'Finished jobs by status', ['status'])
+ERRORS = Counter('resize_errors_total', 'Errors by type', ['type'])
+QUEUE_DEPTH = Gauge('resize_queue_depth', 'Jobs waiting in queue')
+IN_FLIGHT = Gauge('resize_jobs_in_flight', 'Jobs taken from queue and not finished')
+POOL_TASKS = Gauge('resize_pool_tasks', 'Tasks sent to process pool and not finished')
+POOL_UTILIZATION = Gauge('resize_pool_utilization', 'Part of busy process pool workers, 0 - 1')
+
+
+def run_timed(
+        submitted_at: float,
+        resizer: Any,
+        method_name: str,
+        *args: Any,
+) -> Tuple[Any, Dict[str, float], List[str]]:
+    # runs in pool worker. Metrics live in parent process, so stage timings and error types
+    # collected by resizer are returned with result of its method
+    pool_wait = max(time.time() - submitted_at, 0.0)
+    result = getattr(resizer, method_name)(*args)
+    timings = dict(getattr(resizer, 'timings', None) or {}, pool_wait=pool_wait)
+    return result, timings, list(getattr(resizer, 'error_types', None) or [])
+
+
+def record_worker_metrics(timings: Dict[str, float], error_types: List[str]) -> None:
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage)
+    for error_type in error_types:
+        ERRORS.inc(error_type)
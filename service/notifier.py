@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Set
+
+import aioredis
+from service.codec import dumps, loads
+from service.subscription import Subscription
+
+logger = logging.getLogger('app_logger')
+
+# job status not changed after it
+FINAL_STATUSES = ('done', 'error')
+
+
+class StatusNotifier:
+    # Status changes published to redis channel by node which resized image.
+    # Every api node keeps one subscription and fans messages out to local waiters.
+
+    def __init__(self, pool: Any, channel: str) -> None:
+        # pool for publish, subscription uses own connection
+        self.pool = pool
+        self.channel = channel
+        self.subscription = Subscription(channel, self._on_message, self._on_lost)
+        self._waiters: Dict[str, Set[asyncio.Queue]] = {}
+
+    async def connect(self) -> None:
+        await self.subscription.connect()
+
+    async def disconnect(self) -> None:
+        await self.subscription.disconnect()
+
+    async def publish(self, file_id: str, status: str) -> None:
+        try:
+            await self.pool.publish(self.channel, dumps({'id': file_id, 'status': status}))
+        except (aioredis.RedisError, OSError) as e:
+            # waiters get status from repository on timeout
+            logger.error(f'Publish status of {file_id} failed: {e}')
+
+    def _on_message(self, message: bytes) -> None:
+        try:
+            self._dispatch(loads(message))
+        except (ValueError, KeyError) as e:
+            logger.error(f'Wrong status message {message}: {e}')
+
+    def _on_lost(self) -> None:
+        # status changes published until subscribed again are not received, waiters read repository
+        for queues in self._waiters.values():
+            for queue in queues:
+                queue.put_nowait(None)
+
+    def _dispatch(self, message: Dict) -> None:
+        for queue in self._waiters.get(message['id'], ()):
+            queue.put_nowait(message['status'])
+
+    def subscribe(self, file_id: str) -> asyncio.Queue:
+        # subscribe before reading status from repository, so change between can't be lost
+        queue = asyncio.Queue()
+        self._waiters.setdefault(file_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, file_id: str, queue: asyncio.Queue) -> None:
+        waiters = self._waiters.get(file_id)
+        if waiters is None:
+            return
+        waiters.discard(queue)
+        if not waiters:
+            del self._waiters[file_id]
+
+    async def wait(self, queue: asyncio.Queue, timeout: float) -> Optional[str]:
+        # next status, None on timeout or if status changes could be lost
+        try:
+            return await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
@@ -1,15 +1,62 @@
 import abc
 import asyncio
-import json
+import hashlib
 import logging
-from typing import Union, Dict
+from typing import Union, Dict, List, Optional, Sequence
 
 import aioredis
 from config import CONFIG
+from service.codec import dumps, loads
+from service.metrics import REPOSITORY_SECONDS
+from models.Image import RECORD_FIELDS, SCHEMA_VERSION, check_type
 
 logger = logging.getLogger('app_logger')
 
 
+# partial update of existing job hash in one round trip, atomic with status check.
+# ARGV: count of expected statuses, expected statuses, count of deleted keys, deleted keys,
+# then key, value pairs. Returns 1 - updated, 0 - no record or status not expected,
+# -1 - record of old version (JSON string or hash without version), not changed
+UPDATE_SCRIPT = """
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'none' then
+    return 0
+end
+if kind == 'string' or redis.call('HEXISTS', KEYS[1], 'v') == 0 then
+    return -1
+end
+local expected = tonumber(ARGV[1])
+if expected > 0 then
+    local status = redis.call('HGET', KEYS[1], 's')
+    local allowed = false
+    for i = 2, expected + 1 do
+        if ARGV[i] == status then
+            allowed = true
+        end
+    end
+    if not allowed then
+        return 0
+    end
+end
+local deleted = tonumber(ARGV[expected + 2])
+for i = expected + 3, expected + 2 + deleted do
+    redis.call('HDEL', KEYS[1], ARGV[i])
+end
+for i = expected + 3 + deleted, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+# digest of script in redis script cache, script sent once by EVAL after redis restart or SCRIPT FLUSH
+UPDATE_SCRIPT_SHA = hashlib.sha1(UPDATE_SCRIPT.encode()).hexdigest()
+# hash key of record version
+VERSION_KEY = 'v'
+VERSION_KEY_BYTES = VERSION_KEY.encode()
+# short key by field name, field name and type by short key
+FIELD_KEYS = {name: key for name, (key, _) in RECORD_FIELDS.items()}
+KEY_FIELDS = {key.encode(): (name, value_type) for name, (key, value_type) in RECORD_FIELDS.items()}
+
+
 class Repository(metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
@@ -21,15 +68,31 @@ class Repository(metaclass=abc.ABCMeta):
         raise NotImplementedError
 
     @abc.abstractmethod
-    async def get(self, key: Union[str, bytes]) -> Union[Dict, str]:
+    async def get(self, key: Union[str, bytes], fields: Optional[Sequence[str]] = None) -> Union[Dict, str]:
+        # only given fields if set
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_many(
+            self,
+            keys: Sequence[Union[str, bytes]],
+            fields: Optional[Sequence[str]] = None,
+    ) -> List[Optional[Dict]]:
+        # records in order of keys in one request, None for not found
         raise NotImplementedError
 
     @abc.abstractmethod
-    async def insert(self, key: Union[str, bytes], data: Union[Dict, bytes]) -> bool:
+    async def insert(self, key: Union[str, bytes], data: Dict, expire: Optional[int] = None) -> bool:
         raise NotImplementedError
 
     @abc.abstractmethod
-    async def update(self, key: Union[str, bytes], data: Union[Dict, bytes]) -> bool:
+    async def update(
+            self,
+            key: Union[str, bytes],
+            data: Dict,
+            status_from: Optional[Sequence[str]] = None,
+    ) -> bool:
+        # changes only given fields of existing record, if its status is one of status_from (any if not set)
         raise NotImplementedError
 
     @abc.abstractmethod
@@ -64,44 +127,208 @@ class RedisRepository(Repository):
             self.pool.close()
             await self.pool.wait_closed()
 
-    async def _convert_key(self, key: Union[str, bytes]) -> str:
+    def _convert_key(self, key: Union[str, bytes]) -> str:
         if isinstance(key, bytes):
             key = str(key, encoding='UTF-8')
         return key
 
-    async def _convert_data(self, data: Union[bytes, str], action_type: str = 'set') -> Union[str, Dict]:
+    def _convert_data(self, data: Union[bytes, Dict], action_type: str = 'set') -> Union[bytes, Dict]:
         if isinstance(data, dict) and action_type == 'set':
-            return json.dumps(data)
+            return dumps(data)
         if isinstance(data, bytes) and action_type == 'get':
-            return json.loads(str(data, encoding='UTF-8'))
+            return loads(data)
         return data
 
-    async def insert(self, key: Union[str, bytes], data: Union[Dict, bytes]) -> bool:
-        key = await self._convert_key(key)
-        prepared_data = await self._convert_data(data)
-        result = await self.pool.set(key, prepared_data)
-        if self.save_timeout:
-            await self.pool.expire(key, 60 * self.save_timeout)
-        return result
+    def _encode_fields(self, data: Dict) -> Dict[str, bytes]:
+        # job fields under short keys, strings and ints as is, rest JSON. Not set fields not stored.
+        # Other fields (files of batch) under own name in JSON
+        fields = {VERSION_KEY: b'%d' % SCHEMA_VERSION}
+        for name, value in data.items():
+            if value is None:
+                continue
+            if name not in RECORD_FIELDS:
+                fields[name] = dumps(value)
+                continue
+            check_type(name, value)
+            key, value_type = RECORD_FIELDS[name]
+            if value_type is str:
+                fields[key] = value.encode()
+            elif value_type is int:
+                fields[key] = b'%d' % value
+            else:
+                fields[key] = dumps(value)
+        return fields
 
-    async def update(self, key: Union[str, bytes], data: Union[Dict, bytes]) -> bool:
-        result = await self.insert(key, data)
+    def _decode_fields(self, data: Dict[bytes, bytes]) -> Dict:
+        version = data.get(VERSION_KEY_BYTES)
+        if version is None:
+            return self._decode_fields_v1(data)
+        if int(version) > SCHEMA_VERSION:
+            raise ValueError(f'Record version {int(version)} is not supported')
+        result = {}
+        for key, value in data.items():
+            if value is None or key == VERSION_KEY_BYTES:
+                continue
+            name, value_type = KEY_FIELDS.get(key) or (str(key, encoding='UTF-8'), None)
+            if value_type is str:
+                result[name] = str(value, encoding='UTF-8')
+            elif value_type is int:
+                result[name] = int(value)
+            else:
+                result[name] = loads(value)
         return result
 
-    async def get(self, key: Union[str, bytes]) -> Union[Dict, str]:
-        key = await self._convert_key(key)
-        data = await self.pool.get(key)
-        prepared_data = await self._convert_data(
-            data, action_type='get'
-        )
-        return prepared_data
+    def _decode_fields_v1(self, data: Dict[bytes, bytes]) -> Dict:
+        # hash of version 1, long names and JSON values. Fields joined to one JSON object
+        # and parsed at once, names are plain identifiers
+        pairs = [b'"%s":%s' % (name, value) for name, value in data.items() if value is not None]
+        return loads(b'{' + b','.join(pairs) + b'}')
+
+    def _get_expire(self, expire: Optional[int] = None) -> Optional[int]:
+        if expire:
+            return expire
+        if self.save_timeout:
+            return 60 * int(self.save_timeout)
+        return None
+
+    async def insert(self, key: Union[str, bytes], data: Dict, expire: Optional[int] = None) -> bool:
+        # expire in secs, overrides save_timeout. Record replaced and TTL set in one transaction
+        key = self._convert_key(key)
+        expire = self._get_expire(expire)
+        fields = self._encode_fields(data)
+        transaction = self.pool.multi_exec()
+        transaction.delete(key)
+        transaction.hmset_dict(key, fields)
+        if expire:
+            transaction.expire(key, expire)
+        with REPOSITORY_SECONDS.time('insert'):
+            await transaction.execute()
+        return True
+
+    async def update(
+            self,
+            key: Union[str, bytes],
+            data: Dict,
+            status_from: Optional[Sequence[str]] = None,
+    ) -> bool:
+        key = self._convert_key(key)
+        fields = self._encode_fields(data)
+        del fields[VERSION_KEY]
+        deleted = [FIELD_KEYS.get(name, name) for name, value in data.items() if value is None]
+        args = [len(status_from or ()), *(status.encode() for status in status_from or ())]
+        args.extend((len(deleted), *deleted))
+        for field_key, value in fields.items():
+            args.extend((field_key, value))
+        with REPOSITORY_SECONDS.time('update'):
+            result = await self._run_update_script(key, args)
+        if result == -1:
+            return await self._update_legacy(key, data, status_from)
+        return result == 1
+
+    async def _run_update_script(self, key: str, args: List) -> int:
+        try:
+            return await self.pool.evalsha(UPDATE_SCRIPT_SHA, keys=[key], args=args)
+        except aioredis.ReplyError as e:
+            if 'NOSCRIPT' not in str(e):
+                raise
+            # EVAL adds script to cache
+            return await self.pool.eval(UPDATE_SCRIPT, keys=[key], args=args)
+
+    async def _update_legacy(self, key: str, data: Dict, status_from: Optional[Sequence[str]]) -> bool:
+        # record written by old version, rewritten in current version with same TTL
+        old_data = await self.get(key)
+        if not old_data:
+            return False
+        if status_from and old_data.get('status') not in status_from:
+            return False
+        ttl = await self.pool.ttl(key)
+        await self.insert(key, dict(old_data, **data), expire=ttl if ttl > 0 else None)
+        return True
+
+    async def _get_legacy(self, key: str, fields: Optional[Sequence[str]] = None) -> Optional[Dict]:
+        data = self._convert_data(await self.pool.get(key), action_type='get')
+        if data and fields:
+            return {name: data[name] for name in fields if name in data}
+        return data
+
+    def _get_keys(self, fields: Sequence[str]) -> List[str]:
+        # HMGET keys for fields, version last
+        return [FIELD_KEYS.get(name, name) for name in fields] + [VERSION_KEY]
+
+    def _decode_reply(self, reply: Union[Dict, List], fields: Optional[Sequence[str]] = None) -> Optional[Dict]:
+        # HGETALL or HMGET reply
+        if fields:
+            reply = dict(zip((key.encode() for key in self._get_keys(fields)), reply))
+        return self._decode_fields(reply) or None
+
+    def _decode_reply_v1(self, reply: List, fields: Sequence[str]) -> Optional[Dict]:
+        # HMGET reply of hash of version 1 by long names
+        return self._decode_fields_v1(dict(zip((name.encode() for name in fields), reply))) or None
+
+    async def get(self, key: Union[str, bytes], fields: Optional[Sequence[str]] = None) -> Union[Dict, str]:
+        key = self._convert_key(key)
+        try:
+            with REPOSITORY_SECONDS.time('get'):
+                if fields:
+                    reply = await self.pool.hmget(key, *self._get_keys(fields))
+                else:
+                    reply = await self.pool.hgetall(key)
+        except aioredis.ReplyError as e:
+            if 'WRONGTYPE' not in str(e):
+                raise
+            return await self._get_legacy(key, fields)
+        if fields and reply[-1] is None:
+            # no version: hash of version 1 or no record, read by long names
+            return self._decode_reply_v1(await self.pool.hmget(key, *fields), fields)
+        return self._decode_reply(reply, fields)
+
+    async def get_many(
+            self,
+            keys: Sequence[Union[str, bytes]],
+            fields: Optional[Sequence[str]] = None,
+    ) -> List[Optional[Dict]]:
+        # one pipeline for all keys, second one for records of version 1 and not found with fields
+        keys = [self._convert_key(key) for key in keys]
+        if not keys:
+            return []
+        pipeline = self.pool.pipeline()
+        for key in keys:
+            if fields:
+                pipeline.hmget(key, *self._get_keys(fields))
+            else:
+                pipeline.hgetall(key)
+        with REPOSITORY_SECONDS.time('get_many'):
+            replies = await pipeline.execute(return_exceptions=True)
+        old_keys = [
+            key for key, reply in zip(keys, replies)
+            if fields and isinstance(reply, list) and reply[-1] is None
+        ]
+        old_replies = {}
+        if old_keys:
+            pipeline = self.pool.pipeline()
+            for key in old_keys:
+                pipeline.hmget(key, *fields)
+            old_replies = dict(zip(old_keys, await pipeline.execute()))
+        result = []
+        for key, reply in zip(keys, replies):
+            if isinstance(reply, aioredis.ReplyError) and 'WRONGTYPE' in str(reply):
+                result.append(await self._get_legacy(key, fields))
+            elif isinstance(reply, Exception):
+                raise reply
+            elif key in old_replies:
+                result.append(self._decode_reply_v1(old_replies[key], fields))
+            else:
+                result.append(self._decode_reply(reply, fields))
+        return result
 
     async def is_exist(self, key: Union[str, bytes]) -> bool:
-        key = await self._convert_key(key)
-        result = await self.pool.exists(key)
+        key = self._convert_key(key)
+        with REPOSITORY_SECONDS.time('is_exist'):
+            result = await self.pool.exists(key)
         return result
 
     async def delete(self, key: Union[str, bytes]) -> bool:
-        key = await self._convert_key(key)
-        result = await self.pool.delete(key)
+        key = self._convert_key(key)
+        with REPOSITORY_SECONDS.time('delete'):
+            result = await self.pool.delete(key)
         return result
@@ -0,0 +1,164 @@
+import copy
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import aioredis
+from service.metrics import REPOSITORY_CACHE
+from service.notifier import FINAL_STATUSES
+from service.repository import Repository
+from service.subscription import Subscription
+
+logger = logging.getLogger('app_logger')
+
+
+class CachedRepository(Repository):
+    # Finished jobs kept in memory of every node in front of repository, status checks and downloads
+    # don't go to redis. Finished job changes only when deleted or finished again after redelivery,
+    # such writes published to channel and every node drops the key.
+
+    def __init__(self, repository: Repository, channel: str, ttl: float, max_entries: int) -> None:
+        self.repository = repository
+        self.channel = channel
+        # in secs, also bounds life of entry expired in redis
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.subscription = Subscription(channel, self._on_message, self._on_lost)
+        # key: (expires at, record, all fields read), LRU order, oldest first
+        self._entries = OrderedDict()
+        # changed by every invalidation, record read before it is not cached
+        self._version = 0
+
+    @property
+    def pool(self) -> Any:
+        return self.repository.pool
+
+    async def connect(self) -> None:
+        await self.repository.connect()
+        await self.subscription.connect()
+
+    async def disconnect(self) -> None:
+        await self.subscription.disconnect()
+        await self.repository.disconnect()
+
+    def _on_message(self, message: bytes) -> None:
+        self._drop(str(message, encoding='UTF-8'))
+
+    def _on_lost(self) -> None:
+        # changes published while not subscribed are not seen, nothing cached until subscribed again
+        self._version += 1
+        self._entries.clear()
+
+    def _read_version(self) -> Optional[int]:
+        # None if record read now can't be cached
+        return self._version if self.subscription.subscribed else None
+
+    def _drop(self, key: str) -> None:
+        self._version += 1
+        self._entries.pop(key, None)
+
+    async def _invalidate(self, key: str) -> None:
+        self._drop(key)
+        try:
+            await self.pool.publish(self.channel, key)
+        except (aioredis.RedisError, OSError) as e:
+            # other nodes drop it after ttl
+            logger.error(f'Publish change of {key} failed: {e}')
+
+    async def _changed(self, key: str, data: Dict) -> None:
+        if data.get('status') in FINAL_STATUSES:
+            # job can be finished again by other worker after redelivery
+            await self._invalidate(key)
+        else:
+            # not finished record is not cached on any node, publish not needed
+            self._drop(key)
+
+    def _get_cached(self, key: str, fields: Optional[Sequence[str]]) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        expires_at, data, complete = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        if fields:
+            if not complete and any(name not in data for name in fields):
+                return None
+            data = {name: data[name] for name in fields if name in data}
+        elif not complete:
+            return None
+        self._entries.move_to_end(key)
+        # callers change records they got
+        return copy.deepcopy(data)
+
+    def _store(self, key: str, data: Dict, complete: bool) -> None:
+        entry = self._entries.get(key)
+        if entry and not complete and entry[0] > time.monotonic():
+            # more fields of same finished record
+            _, old_data, complete = entry
+            data = dict(old_data, **data)
+        self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(data), complete)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: Union[str, bytes], fields: Optional[Sequence[str]] = None) -> Union[Dict, str]:
+        key = self._convert_key(key)
+        data = self._get_cached(key, fields)
+        if data is not None:
+            REPOSITORY_CACHE.inc('hit')
+            return data
+        REPOSITORY_CACHE.inc('miss')
+        version = self._read_version()
+        data = await self.repository.get(key, fields)
+        if isinstance(data, dict) and data.get('status') in FINAL_STATUSES and version == self._version:
+            self._store(key, data, complete=not fields)
+        return data
+
+    async def get_many(
+            self,
+            keys: Sequence[Union[str, bytes]],
+            fields: Optional[Sequence[str]] = None,
+    ) -> List[Optional[Dict]]:
+        keys = [self._convert_key(key) for key in keys]
+        result = [self._get_cached(key, fields) for key in keys]
+        missed = [key for key, data in zip(keys, result) if data is None]
+        REPOSITORY_CACHE.inc('hit', amount=len(keys) - len(missed))
+        if not missed:
+            return result
+        REPOSITORY_CACHE.inc('miss', amount=len(missed))
+        version = self._read_version()
+        read = dict(zip(missed, await self.repository.get_many(missed, fields)))
+        for key, data in read.items():
+            if isinstance(data, dict) and data.get('status') in FINAL_STATUSES and version == self._version:
+                self._store(key, data, complete=not fields)
+        return [read[key] if data is None else data for key, data in zip(keys, result)]
+
+    async def insert(self, key: Union[str, bytes], data: Dict, expire: Optional[int] = None) -> bool:
+        result = await self.repository.insert(key, data, expire=expire)
+        await self._changed(self._convert_key(key), data)
+        return result
+
+    async def update(
+            self,
+            key: Union[str, bytes],
+            data: Dict,
+            status_from: Optional[Sequence[str]] = None,
+    ) -> bool:
+        result = await self.repository.update(key, data, status_from=status_from)
+        await self._changed(self._convert_key(key), data)
+        return result
+
+    async def is_exist(self, key: Union[str, bytes]) -> bool:
+        return await self.repository.is_exist(key)
+
+    async def delete(self, key: Union[str, bytes]) -> bool:
+        result = await self.repository.delete(key)
+        await self._invalidate(self._convert_key(key))
+        return result
+
+    def _convert_key(self, key: Union[str, bytes]) -> str:
+        if isinstance(key, bytes):
+            key = str(key, encoding='UTF-8')
+        return key
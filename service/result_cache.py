@@ -0,0 +1,77 @@
+import time
+from typing import Any, Dict, Optional
+
+from config import CONFIG
+from service.image_resizer import get_output_format, resolve_resample
+from service.repository import Repository
+
+KEY_PREFIX = 'result_cache'
+# sorted set of cache keys scored by last access time, LRU order shared by all nodes
+LRU_KEY = f'{KEY_PREFIX}:lru'
+
+
+class ResultCache:
+
+    def __init__(self, repository: Repository, ttl: int, max_entries: int) -> None:
+        self.repository = repository
+        # in secs, entries expire in repository
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    @staticmethod
+    def _param_key(param: Any) -> str:
+        if isinstance(param, dict):
+            # output options, same key for any order
+            return ','.join(f'{name}={value}' for name, value in sorted(param.items())) or '0'
+        return str(param or 0)
+
+    @classmethod
+    def make_key(cls, source_hash: str, *params: Any) -> str:
+        params_key = ':'.join(cls._param_key(param) for param in params)
+        return f'{KEY_PREFIX}:{source_hash}:{params_key}'
+
+    @classmethod
+    def make_result_key(
+            cls,
+            source_hash: str,
+            image_name: str,
+            width: int,
+            height: int,
+            scale: int,
+            output: Optional[Dict] = None,
+            resample: Optional[Dict] = None,
+    ) -> str:
+        # resolved params: format by file extension, server default filter and draft change result too
+        output = dict(output or {}, format=get_output_format(image_name, output))
+        return cls.make_key(
+            source_hash, width, height, scale, output, resolve_resample(resample), CONFIG['resize']['draft'],
+        )
+
+    @property
+    def pool(self) -> Any:
+        return self.repository.pool
+
+    async def get(self, key: str) -> Optional[str]:
+        data = await self.repository.get(key)
+        if not data:
+            await self.pool.zrem(LRU_KEY, key)
+            return None
+        await self.pool.zadd(LRU_KEY, time.time(), key)
+        return data.get('updated_file_path')
+
+    async def set(self, key: str, file_path: str) -> None:
+        await self.repository.insert(key, {'updated_file_path': file_path}, expire=self.ttl)
+        transaction = self.pool.multi_exec()
+        transaction.zadd(LRU_KEY, time.time(), key)
+        transaction.zcard(LRU_KEY)
+        _, size = await transaction.execute()
+        if size <= self.max_entries:
+            return
+        # popped atomically, every entry evicted by one node
+        evicted = await self.pool.zpopmin(LRU_KEY, size - self.max_entries)
+        for old_key in evicted[::2]:
+            await self.repository.delete(old_key)
+
+    async def delete(self, key: str) -> None:
+        await self.pool.zrem(LRU_KEY, key)
+        await self.repository.delete(key)
@@ -0,0 +1,123 @@
+import io
+import threading
+from concurrent.futures import Future
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextlib import suppress
+from typing import Any, Dict, List, Union
+
+
+class MultipartWriter(io.RawIOBase):
+    # Writable file object for encoders. Small results sent with one put_object on close,
+    # bigger are uploaded by parts in threads while encoder writes next part.
+    # At most (concurrency + 1) parts held in memory.
+
+    def __init__(
+            self,
+            client: Any,
+            bucket: str,
+            key: str,
+            threshold: int,
+            part_size: int,
+            concurrency: int,
+    ) -> None:
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.threshold = threshold
+        self.part_size = part_size
+        self.upload_id = None
+        self._buffer = bytearray()
+        self._written = 0
+        self._parts: List[Future] = []
+        self._slots = threading.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._written
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> int:
+        self._buffer += data
+        self._written += len(data)
+        if self._written > self.threshold:
+            self._upload_buffer()
+        return len(data)
+
+    def _upload_buffer(self, final: bool = False) -> None:
+        while len(self._buffer) >= self.part_size or (final and self._buffer):
+            data = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit_part(data)
+
+    def _submit_part(self, data: bytes) -> None:
+        for part in self._parts:
+            # stop encoding if some part already failed
+            if part.done() and part.exception():
+                raise part.exception()
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = response['UploadId']
+        part_number = len(self._parts) + 1
+        # wait while all upload threads busy, so encoder can't run far ahead
+        self._slots.acquire()
+        self._parts.append(self._executor.submit(self._upload_part, part_number, data))
+
+    def _upload_part(self, part_number: int, data: bytes) -> Dict:
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+        finally:
+            self._slots.release()
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self) -> None:
+        # completes upload, call abort() instead if encoder failed
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                self._upload_buffer(final=True)
+                parts = [part.result() for part in self._parts]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={'Parts': parts},
+                )
+        except BaseException:
+            with suppress(Exception):
+                self._abort_upload()
+            raise
+        finally:
+            self._release()
+
+    def abort(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._abort_upload()
+        finally:
+            self._release()
+
+    def _abort_upload(self) -> None:
+        if self.upload_id is None:
+            return
+        for part in self._parts:
+            part.cancel()
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def _release(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._buffer = bytearray()
+        self._parts = []
+        super().close()
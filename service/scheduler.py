@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Set
+
+from service.job_queue import Job, JobQueue
+from service.metrics import STAGE_SECONDS, ERRORS
+
+logger = logging.getLogger('app_logger')
+
+
+class ResizeScheduler:
+
+    def __init__(self, job_queue: JobQueue, max_in_flight: int) -> None:
+        self.job_queue = job_queue
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.processed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_last = 0.0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def is_full(self) -> bool:
+        return await self.job_queue.is_full()
+
+    async def put(self, file_id: str) -> None:
+        await self.job_queue.put(file_id)
+
+    async def listen(self, handler: Callable[[str], Awaitable[None]]) -> None:
+        logger.debug('listen input data..')
+        loop = asyncio.get_event_loop()
+        while True:
+            # take job from queue only when pool has free slot,
+            # so waiting jobs stay in queue and load_image can see it is full
+            await self._slots.acquire()
+            try:
+                job = await self.job_queue.get()
+            except BaseException:
+                self._slots.release()
+                raise
+            self.wait_time_last = max(time.time() - job.put_time, 0.0)
+            self.wait_time_total += self.wait_time_last
+            STAGE_SECONDS.observe(self.wait_time_last, 'queue_wait')
+            self.processed += 1
+            task = loop.create_task(self._run(handler, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _heartbeat(self, job: Job) -> None:
+        while True:
+            await asyncio.sleep(self.job_queue.heartbeat_interval)
+            try:
+                await self.job_queue.touch(job)
+            except Exception as e:
+                logger.error(f"Heartbeat for {job.job_id} failed: {e}")
+
+    async def _run(self, handler: Callable[[str], Awaitable[None]], job: Job) -> None:
+        self.in_flight += 1
+        heartbeat = None
+        if self.job_queue.heartbeat_interval:
+            heartbeat = asyncio.get_event_loop().create_task(self._heartbeat(job))
+        try:
+            await handler(job.job_id)
+        except Exception as e:
+            logger.error(f"Resize task {job.job_id} failed: {e}")
+            ERRORS.inc(type(e).__name__)
+            await self._finish(self.job_queue.fail, job)
+        else:
+            await self._finish(self.job_queue.ack, job)
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def _finish(self, method: Callable[[Job], Awaitable[None]], job: Job) -> None:
+        try:
+            await method(job)
+        except Exception as e:
+            # not acked job will be redelivered
+            logger.error(f"Finish {job.job_id} in queue failed: {e}")
+
+    async def stats(self) -> Dict:
+        wait_time_avg = self.wait_time_total / self.processed if self.processed else 0.0
+        return {
+            'depth': await self.job_queue.depth(),
+            'max_size': self.job_queue.max_size,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'processed': self.processed,
+            'wait_time_last': round(self.wait_time_last, 4),
+            'wait_time_avg': round(wait_time_avg, 4),
+        }
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    # Python < 3.8, sync mode sends images through pool pipe
+    SharedMemory = None
+
+logger = logging.getLogger('app_logger')
+
+# segments attached by this worker process, by name
+_attached: Dict[str, 'SharedMemory'] = {}
+# segments created by pool of this process, thread workers use them as is
+_owned: Dict[str, 'SharedMemory'] = {}
+
+
+def _attach_untracked(name: str) -> 'SharedMemory':
+    # only owner tracks segment, else tracker of worker warns about leak and unlinks it on worker exit
+    try:
+        # Python 3.13+
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # unregister after attach would drop registration of owner too when worker shares its tracker,
+    # so segment is not registered at all. Worker runs one job at a time
+    register = resource_tracker.register
+    resource_tracker.register = lambda *_: None
+    try:
+        return SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach(name: str) -> 'SharedMemory':
+    # worker side: segment opened once per process and kept until it exits
+    segment = _owned.get(name) or _attached.get(name)
+    if segment is None:
+        segment = _attach_untracked(name)
+        _attached[name] = segment
+    return segment
+
+
+class SharedBufferPool:
+    # ring of shared memory segments for image handoff between api process and pool workers.
+    # Api process owns segments: creates on start and unlinks on stop, workers only attach,
+    # so crashed worker leaks nothing (and resource tracker unlinks it if api process crashed).
+    # Segment used by job returns to ring only when job is finished, even if request was cancelled
+
+    def __init__(self, count: int, segment_size: int) -> None:
+        self.count = count
+        self.segment_size = segment_size
+        self._segments: List['SharedMemory'] = []
+        self._free: Optional[asyncio.Queue] = None
+        self._leased: Set[str] = set()
+        self._held: Set[str] = set()
+
+    @staticmethod
+    def is_available() -> bool:
+        return SharedMemory is not None
+
+    async def open(self) -> None:
+        self._free = asyncio.Queue()
+        for _ in range(self.count):
+            segment = SharedMemory(create=True, size=self.segment_size)
+            self._segments.append(segment)
+            _owned[segment.name] = segment
+            self._free.put_nowait(segment)
+
+    def close(self) -> None:
+        for segment in self._segments:
+            _owned.pop(segment.name, None)
+            try:
+                segment.close()
+                segment.unlink()
+            except (BufferError, FileNotFoundError) as e:
+                logger.error(f'Release shared memory {segment.name} err: {e}')
+        self._segments = []
+        self._leased.clear()
+        self._held.clear()
+
+    async def acquire(self) -> 'SharedMemory':
+        # waits for free segment
+        segment = await self._free.get()
+        self._leased.add(segment.name)
+        return segment
+
+    def release(self, segment: 'SharedMemory') -> None:
+        # no-op for segment already released or held by running job
+        if segment.name in self._held or segment.name not in self._leased:
+            return
+        self._leased.discard(segment.name)
+        self._free.put_nowait(segment)
+
+    def hold(self, segment: 'SharedMemory', future: asyncio.Future) -> None:
+        # segment not released until job finished, worker may still write to it
+        self._held.add(segment.name)
+
+        def done(_: asyncio.Future) -> None:
+            self._held.discard(segment.name)
+            self.release(segment)
+        future.add_done_callback(done)
+
+    def free_count(self) -> int:
+        return self._free.qsize() if self._free else 0
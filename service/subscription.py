@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Any, Callable
+
+import aioredis
+from config import CONFIG
+
+logger = logging.getLogger('app_logger')
+
+# in secs, doubled after every failed try to subscribe
+RESUBSCRIBE_DELAY = 1
+MAX_RESUBSCRIBE_DELAY = 30
+
+
+class Subscription:
+    # Redis pub/sub channel listened by own connection, every message passed to on_message.
+    # Lost subscription is restored with backoff. Messages published while node is not
+    # subscribed are lost, on_lost called first so subscriber doesn't rely on them.
+
+    def __init__(self, channel: str, on_message: Callable[[bytes], None], on_lost: Callable[[], None]) -> None:
+        self.channel = channel
+        self.on_message = on_message
+        self.on_lost = on_lost
+        self.subscriber = None
+        self.subscribed = False
+        self._listener = None
+
+    async def connect(self) -> None:
+        channel = await self._subscribe()
+        self._listener = asyncio.get_event_loop().create_task(self._keep_listening(channel))
+
+    async def disconnect(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+        self.subscribed = False
+        if self.subscriber:
+            self.subscriber.close()
+            await self.subscriber.wait_closed()
+
+    async def _subscribe(self) -> Any:
+        delay = RESUBSCRIBE_DELAY
+        while True:
+            try:
+                if not self.subscriber or self.subscriber.closed:
+                    self.subscriber = await aioredis.create_redis(
+                        f"redis://{CONFIG['redis']['host']}:{CONFIG['redis']['port']}",
+                        password=CONFIG['redis']['password'],
+                        db=0,
+                    )
+                channel, = await self.subscriber.subscribe(self.channel)
+                self.subscribed = True
+                return channel
+            except (aioredis.RedisError, OSError) as e:
+                logger.error(f'Subscribe to {self.channel} failed: {e}. Retry in {delay} sec')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RESUBSCRIBE_DELAY)
+
+    async def _keep_listening(self, channel: Any) -> None:
+        while True:
+            try:
+                await self.listen(channel)
+            except (aioredis.RedisError, OSError) as e:
+                logger.error(f'Read from {self.channel} failed: {e}')
+            logger.error(f'Subscription to {self.channel} lost, resubscribe')
+            self.subscribed = False
+            self.on_lost()
+            channel = await self._subscribe()
+
+    async def listen(self, channel: Any) -> None:
+        # until channel closed
+        while await channel.wait_message():
+            self.on_message(await channel.get())
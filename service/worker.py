@@ -0,0 +1,106 @@
+import asyncio
+import io
+import logging
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from service.executor import select_executor
+from service.file_storage import FileStorage
+from service.image_resizer import ImageResizer
+from service.metrics import POOL_TASKS, run_timed, record_worker_metrics
+from service.shared_memory import SharedBufferPool, attach
+
+logger = logging.getLogger('app_logger')
+
+# pool worker state, built once by init_worker: storage clients and resizer are reused by
+# all jobs of process (of thread for thread pool), job sends only method name and params
+_state = threading.local()
+
+
+def preload_formats(formats: List[str]) -> None:
+    # imports Pillow plugins and initializes codecs before first job
+    for format_image in formats:
+        buffer = io.BytesIO()
+        try:
+            Image.new('RGB', (8, 8)).save(buffer, format=format_image.upper())
+            buffer.seek(0)
+            Image.open(buffer).load()
+        except (KeyError, OSError, ValueError) as e:
+            logger.warning(f'Can not preload {format_image}: {e}')
+
+
+def init_worker(files_storage: FileStorage, preload: Optional[List[str]] = None) -> None:
+    files_storage.init_worker()
+    preload_formats(preload or [])
+    _state.resizer = ImageResizer(files_storage)
+
+
+def get_resizer() -> ImageResizer:
+    resizer = getattr(_state, 'resizer', None)
+    if resizer is None:
+        raise RuntimeError('Worker is not initialized, pool needs init_worker initializer')
+    return resizer
+
+
+def run_job(submitted_at: float, method_name: str, *args: Any) -> Tuple[Any, Dict[str, float], List[str]]:
+    return run_timed(submitted_at, get_resizer(), method_name, *args)
+
+
+def run_shared_job(
+        submitted_at: float,
+        segment_name: str,
+        size: int,
+        *args: Any,
+) -> Tuple[Tuple[Union[bytes, int, None], Optional[str]], Dict[str, float], List[str]]:
+    # resize_bytes for image in segment[:size]. Encoded image written to segment after source,
+    # its length returned instead of bytes. Returned as bytes if it doesn't fit
+    segment = attach(segment_name)
+    with segment.buf[:size] as image:
+        (result, error), timings, error_types = run_timed(submitted_at, get_resizer(), 'resize_bytes', image, *args)
+    if result is not None and size + len(result) <= segment.size:
+        segment.buf[size:size + len(result)] = result
+        result = len(result)
+    return (result, error), timings, error_types
+
+
+async def _run(pool: Optional[Executor], size: Optional[int], job: Callable, method_name: str, *args: Any) -> Any:
+    # records stage timings of worker. Size of source in bytes selects executor of hybrid pool
+    loop = asyncio.get_event_loop()
+    POOL_TASKS.inc()
+    try:
+        result, timings, error_types = await loop.run_in_executor(
+            select_executor(pool, size), job, time.time(), *args,
+        )
+    finally:
+        POOL_TASKS.dec()
+    record_worker_metrics(timings, error_types)
+    logger.debug(f'{method_name} timings: {timings}')
+    return result
+
+
+async def run_in_pool(pool: Optional[Executor], method_name: str, *args: Any, size: Optional[int] = None) -> Any:
+    # calls ImageResizer method in pool worker
+    return await _run(pool, size, run_job, method_name, method_name, *args)
+
+
+async def run_shared_in_pool(
+        pool: Optional[Executor],
+        buffers: SharedBufferPool,
+        segment: Any,
+        size: int,
+        *args: Any,
+) -> Tuple[Optional[bytes], Optional[str]]:
+    # resize_bytes for image in acquired segment. Segment released when job finished,
+    # request may be cancelled before it
+    async def job() -> Tuple[Optional[bytes], Optional[str]]:
+        result, error = await _run(pool, size, run_shared_job, 'resize_bytes', segment.name, size, *args)
+        if isinstance(result, int):
+            result = bytes(segment.buf[size:size + result])
+        return result, error
+    future = asyncio.ensure_future(job())
+    buffers.hold(segment, future)
+    return await asyncio.shield(future)
@@ -0,0 +1,47 @@
+"""CPU time per image with and without JPEG draft fast path.
+
+Run from project root: python3 -m tests.benchmarks.bench_draft
+"""
+import io
+import time
+from typing import Tuple
+
+from PIL import Image
+
+from service import ImageResizer
+
+SOURCE_SIZE = (6000, 4000)
+TARGET_WIDTHS = (64, 256, 1024, 2048, 4000)
+REPEATS = 5
+
+
+def make_jpeg(size: Tuple[int, int]) -> bytes:
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.radial_gradient('L').resize(size)
+    blue = Image.effect_mandelbrot(size, (-2.0, -1.0, 1.0, 1.0), 100)
+    bytes_data = io.BytesIO()
+    Image.merge('RGB', (red, green, blue)).save(bytes_data, format='JPEG', quality=90)
+    return bytes_data.getvalue()
+
+
+def measure(image_data: bytes, width: int, draft: bool) -> float:
+    resizer = ImageResizer(file_storage=None)
+    resizer.width, resizer.draft = width, draft
+    start = time.process_time()
+    for _ in range(REPEATS):
+        resizer._resize_image(Image.open(io.BytesIO(image_data)))
+    return (time.process_time() - start) / REPEATS * 1000
+
+
+def main() -> None:
+    image_data = make_jpeg(SOURCE_SIZE)
+    print(f'Source: {SOURCE_SIZE[0]}x{SOURCE_SIZE[1]} JPEG, {len(image_data)} bytes, {REPEATS} repeats')
+    print(f'{"width":>8} {"full ms":>10} {"draft ms":>10} {"speedup":>8}')
+    for width in TARGET_WIDTHS:
+        full = measure(image_data, width, draft=False)
+        fast = measure(image_data, width, draft=True)
+        print(f'{width:>8} {full:>10.1f} {fast:>10.1f} {full / fast:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Encode time vs output bytes for output formats and encoder options.
+
+Run from project root: python3 -m tests.benchmarks.bench_encode
+"""
+import io
+import time
+from typing import Dict, Tuple
+
+from PIL import Image
+
+from service.image_resizer import OUTPUT_FORMATS, get_save_params
+from tests.benchmarks.bench_draft import make_jpeg
+
+# typical resized image
+SIZE = (1024, 683)
+REPEATS = 5
+CASES = (
+    {'format': 'jpeg'},
+    {'format': 'jpeg', 'quality': 85},
+    {'format': 'jpeg', 'quality': 85, 'optimize': True},
+    {'format': 'jpeg', 'quality': 85, 'progressive': True, 'optimize': True},
+    {'format': 'jpeg', 'quality': 70, 'progressive': True, 'optimize': True},
+    {'format': 'png'},
+    {'format': 'png', 'compress_level': 1},
+    {'format': 'png', 'compress_level': 9, 'optimize': True},
+    {'format': 'webp'},
+    {'format': 'webp', 'quality': 80, 'speed': 10},
+    {'format': 'webp', 'quality': 80, 'speed': 4},
+    {'format': 'webp', 'quality': 80, 'speed': 0},
+    {'format': 'avif', 'quality': 60, 'speed': 10},
+    {'format': 'avif', 'quality': 60, 'speed': 6},
+)
+
+
+def measure(image: Image.Image, output: Dict) -> Tuple[float, int]:
+    format_image = OUTPUT_FORMATS[output['format']]
+    params = get_save_params(format_image, output)
+    start = time.process_time()
+    for _ in range(REPEATS):
+        result = io.BytesIO()
+        image.save(result, format=format_image, **params)
+    return (time.process_time() - start) / REPEATS * 1000, result.tell()
+
+
+def main() -> None:
+    image = Image.open(io.BytesIO(make_jpeg(SIZE)))
+    image.load()
+    print(f'Image: {SIZE[0]}x{SIZE[1]} RGB, {REPEATS} repeats')
+    print(f'{"options":<72} {"ms":>8} {"bytes":>9} {"vs jpeg":>8}')
+    baseline = None
+    for output in CASES:
+        if output['format'] not in OUTPUT_FORMATS:
+            print(f'{str(output):<72} {"not supported":>27}')
+            continue
+        elapsed, size = measure(image, output)
+        baseline = baseline or size
+        print(f'{str(output):<72} {elapsed:>8.1f} {size:>9} {size / baseline:>7.0%}')
+
+
+if __name__ == '__main__':
+    main()
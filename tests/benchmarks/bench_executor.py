@@ -0,0 +1,80 @@
+"""Throughput of process and thread resize executors by image size and worker count.
+
+Jobs are async mode resize_img of corpus images (read default from disk, write result file),
+all jobs of one image size sent at once. Images per second, higher is better.
+Run from project root: python3 -m tests.benchmarks.bench_executor [--sizes small,medium,large] [--workers 1,4]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Executor
+from concurrent.futures.process import ProcessPoolExecutor
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from service import LocalFileStorage
+from service.worker import init_worker, run_in_pool
+from tests.benchmarks.corpus import CorpusImage, get_corpus
+
+WIDTH = 512
+JOBS_PER_WORKER = 4
+EXECUTORS: Dict[str, Callable[..., Executor]] = {
+    'process': ProcessPoolExecutor,
+    'thread': ThreadPoolExecutor,
+}
+
+
+async def measure(executor: Executor, images_dir: str, images: List[CorpusImage], jobs: int) -> float:
+    names = []
+    for index in range(jobs):
+        image = images[index % len(images)]
+        name = f'{index}-{image.name}'
+        shutil.copyfile(image.path, os.path.join(images_dir, name))
+        names.append((name, os.path.getsize(image.path)))
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        run_in_pool(executor, 'resize_img', name, WIDTH, 0, 0, size=size) for name, size in names
+    ])
+    elapsed = time.perf_counter() - start
+    for path, _ in results:
+        if path:
+            os.remove(path)
+    return jobs / elapsed
+
+
+async def run(sizes: List[str], workers: List[int]) -> None:
+    corpus = get_corpus(sizes)
+    print(f'{os.cpu_count()} CPUs, width {WIDTH}, {JOBS_PER_WORKER} jobs per worker, images/s')
+    print(f'{"size":<8} {"workers":>7} ' + ' '.join(f'{name:>9}' for name in EXECUTORS))
+    with tempfile.TemporaryDirectory() as images_dir:
+        storage = LocalFileStorage(images_path=images_dir)
+        for size in sizes:
+            images = [image for image in corpus if image.name.startswith(f'{size}_')]
+            for count in workers:
+                row = []
+                for create in EXECUTORS.values():
+                    executor = create(max_workers=count, initializer=init_worker, initargs=(storage,))
+                    try:
+                        # warm up workers
+                        await measure(executor, images_dir, images, count)
+                        row.append(await measure(executor, images_dir, images, count * JOBS_PER_WORKER))
+                    finally:
+                        executor.shutdown()
+                print(f'{size:<8} {count:>7} ' + ' '.join(f'{value:>9.2f}' for value in row))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='small,medium,large')
+    parser.add_argument('--workers', default=','.join(sorted({'1', str(os.cpu_count())})))
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(
+        run(args.sizes.split(','), [int(count) for count in args.workers.split(',')]),
+    )
+
+
+if __name__ == '__main__':
+    main()
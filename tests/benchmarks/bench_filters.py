@@ -0,0 +1,76 @@
+"""Resize time and quality (PSNR against LANCZOS without reducing_gap) for every filter.
+
+Images decoded before measure, so only resample cost counted.
+Run from project root: python3 -m tests.benchmarks.bench_filters
+"""
+import io
+import math
+import time
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+from service.image_resizer import FILTERS
+from tests.benchmarks.bench_draft import make_jpeg
+
+SOURCE_SIZE = (3000, 2000)
+TARGET_WIDTHS = (256, 1024)
+REDUCING_GAPS = (None, 2.0, 3.0)
+REPEATS = 3
+
+
+def make_lines(size: Tuple[int, int]) -> Image.Image:
+    # sharp edges and thin lines, worst case for aliasing
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+    for x in range(0, size[0], 7):
+        draw.line((x, 0, x + size[1] // 3, size[1]), fill=(20, 20, 20), width=1)
+    for y in range(0, size[1], 50):
+        draw.rectangle((0, y, size[0], y + 10), fill=(200, 30, 30))
+    return image
+
+
+def get_corpus() -> Dict[str, Image.Image]:
+    photo = Image.open(io.BytesIO(make_jpeg(SOURCE_SIZE)))
+    photo.load()
+    return {
+        'photo': photo,
+        'lines': make_lines(SOURCE_SIZE),
+    }
+
+
+def psnr(image: Image.Image, reference: Image.Image) -> float:
+    squares = ImageStat.Stat(ImageChops.difference(image, reference)).sum2
+    mse = sum(squares) / (reference.size[0] * reference.size[1] * len(squares))
+    if not mse:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def measure(image: Image.Image, size: Tuple[int, int], resample: int, gap: Optional[float]) -> Tuple[float, Image.Image]:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        result = image.resize(size, resample, reducing_gap=gap)
+    return (time.perf_counter() - start) / REPEATS * 1000, result
+
+
+def main() -> None:
+    corpus = get_corpus()
+    print(f'Source: {SOURCE_SIZE[0]}x{SOURCE_SIZE[1]}, {REPEATS} repeats, PSNR against lanczos without reducing_gap')
+    print(f'{"image":<8} {"width":>6} {"filter":<10} {"gap":>5} {"ms":>8} {"PSNR dB":>8}')
+    for name, image in corpus.items():
+        for width in TARGET_WIDTHS:
+            size = (width, int(image.size[1] * width / image.size[0]))
+            reference = image.resize(size, Image.LANCZOS)
+            for filter_name, resample in FILTERS.items():
+                for gap in REDUCING_GAPS:
+                    if resample == Image.NEAREST and gap:
+                        # Pillow ignores reducing_gap for nearest
+                        continue
+                    elapsed, result = measure(image, size, resample, gap)
+                    print(f'{name:<8} {width:>6} {filter_name:<10} {str(gap or "-"):>5} '
+                          f'{elapsed:>8.1f} {psnr(result, reference):>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
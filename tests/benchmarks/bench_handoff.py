@@ -0,0 +1,97 @@
+"""Image handoff between api process and warm pool worker: pipe, shared memory and disk.
+
+pipe   - sync mode without SHM_SEGMENTS: upload and result pickled through pool pipe
+shm    - sync mode with SHM_SEGMENTS: upload and result in shared memory segment
+disk   - async mode: upload saved to file, worker reads it and writes result file, result read back
+Images from benchmark corpus, jobs sent one by one, ms per image with resize included.
+Run from project root: python3 -m tests.benchmarks.bench_handoff [--sizes medium,large]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures.process import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, List
+
+from service import LocalFileStorage
+from service.shared_memory import SharedBufferPool
+from service.worker import init_worker, run_in_pool, run_shared_in_pool
+from tests.benchmarks.corpus import CorpusImage, get_corpus
+
+REPEATS = 5
+WIDTH = 512
+
+
+async def handoff_pipe(pool: ProcessPoolExecutor, buffers: SharedBufferPool, images_dir: str, name: str,
+                       body: bytes) -> bytes:
+    result, _ = await run_in_pool(pool, 'resize_bytes', body, name, WIDTH, 0, 0)
+    return result
+
+
+async def handoff_shm(pool: ProcessPoolExecutor, buffers: SharedBufferPool, images_dir: str, name: str,
+                      body: bytes) -> bytes:
+    segment = await buffers.acquire()
+    try:
+        segment.buf[:len(body)] = body
+        result, _ = await run_shared_in_pool(pool, buffers, segment, len(body), name, WIDTH, 0, 0)
+    finally:
+        buffers.release(segment)
+    return result
+
+
+async def handoff_disk(pool: ProcessPoolExecutor, buffers: SharedBufferPool, images_dir: str, name: str,
+                       body: bytes) -> bytes:
+    with open(os.path.join(images_dir, name), 'wb') as f:
+        f.write(body)
+    path, _ = await run_in_pool(pool, 'resize_img', name, WIDTH, 0, 0)
+    with open(path, 'rb') as f:
+        result = f.read()
+    os.remove(path)
+    return result
+
+
+HANDOFFS: Dict[str, Callable[..., Awaitable[bytes]]] = {
+    'pipe': handoff_pipe,
+    'shm': handoff_shm,
+    'disk': handoff_disk,
+}
+
+
+async def measure(corpus: List[CorpusImage]) -> None:
+    with tempfile.TemporaryDirectory() as images_dir:
+        storage = LocalFileStorage(images_path=images_dir)
+        biggest = max(os.path.getsize(image.path) for image in corpus)
+        buffers = SharedBufferPool(1, 2 * biggest)
+        await buffers.open()
+        try:
+            with ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(storage,)) as pool:
+                print(f'{"image":<20} {"MB":>6} ' + ' '.join(f'{name + " ms":>9}' for name in HANDOFFS))
+                for image in corpus:
+                    with open(image.path, 'rb') as f:
+                        body = f.read()
+                    row = []
+                    for handoff in HANDOFFS.values():
+                        # first run warms worker and page cache
+                        await handoff(pool, buffers, images_dir, f'warm-{image.name}', body)
+                        timings = []
+                        for index in range(REPEATS):
+                            start = time.perf_counter()
+                            await handoff(pool, buffers, images_dir, f'{index}-{image.name}', body)
+                            timings.append((time.perf_counter() - start) * 1000)
+                        row.append(statistics.median(timings))
+                    print(f'{image.name:<20} {len(body) / 1024 / 1024:>6.1f} ' + ' '.join(f'{ms:>9.1f}' for ms in row))
+        finally:
+            buffers.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='medium,large')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(measure(get_corpus(args.sizes.split(','))))
+
+
+if __name__ == '__main__':
+    main()
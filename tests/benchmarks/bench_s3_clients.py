@@ -0,0 +1,104 @@
+"""Per request latency of S3 client per request vs long-lived pooled clients.
+
+Uses local moto server as S3 stand-in (pinned in test_requirements.txt),
+or any S3 compatible server from AWS_ENDPOINT_URL.
+Run from project root: python3 -m tests.benchmarks.bench_s3_clients
+"""
+import asyncio
+import logging
+import os
+import statistics
+import time
+from typing import Callable, List
+
+import botocore.session
+
+from config import CONFIG
+from service import AmazonFileStorage
+from service.file_storage import get_session
+
+REQUESTS = 50
+BODY = os.urandom(100 * 1024)
+BUCKET = 'bench-bucket'
+
+
+def start_s3_stand_in() -> None:
+    if CONFIG['amazon'].get('endpoint_url'):
+        return
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    CONFIG['amazon'].update({
+        'endpoint_url': f'http://{host}:{port}',
+        'aws_access_key': 'bench',
+        'aws_secret_access': 'bench',
+        'region': 'us-east-1',
+    })
+
+
+def report(name: str, timings: List[float]) -> None:
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f'{name:<32} {statistics.mean(timings) * 1000:>8.2f} {statistics.median(timings) * 1000:>8.2f} '
+          f'{p95 * 1000:>8.2f}')
+
+
+def measure_sync(put: Callable[[str], None]) -> List[float]:
+    timings = []
+    for i in range(REQUESTS):
+        start = time.perf_counter()
+        put(f'bench/sync_{i}')
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def measure_async(get: Callable) -> List[float]:
+    timings = []
+    for i in range(REQUESTS):
+        start = time.perf_counter()
+        await get(f'bench/sync_{i}')
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main() -> None:
+    start_s3_stand_in()
+    storage = AmazonFileStorage(images_path=os.getcwd())
+    params = storage._get_client_params()
+    storage._get_client(sync=True).create_bucket(Bucket=BUCKET)
+
+    def put_new_client(key: str) -> None:
+        client = botocore.session.get_session().create_client(**params)
+        client.put_object(Bucket=BUCKET, Key=key, Body=BODY)
+
+    def put_pooled_client(key: str) -> None:
+        storage._get_client(sync=True).put_object(Bucket=BUCKET, Key=key, Body=BODY)
+
+    async def get_new_client(key: str) -> None:
+        async with get_session().create_client(**params) as client:
+            response = await client.get_object(Bucket=BUCKET, Key=key)
+            async with response['Body'] as stream:
+                await stream.read()
+
+    async def get_pooled_client(key: str) -> None:
+        response = await storage._get_client().get_object(Bucket=BUCKET, Key=key)
+        async with response['Body'] as stream:
+            await stream.read()
+
+    async def run_async() -> None:
+        report('async get_object, new client', await measure_async(get_new_client))
+        await storage.connect()
+        report('async get_object, pooled client', await measure_async(get_pooled_client))
+        await storage.disconnect()
+
+    print(f'{REQUESTS} requests, {len(BODY) // 1024} KiB body, {CONFIG["amazon"]["endpoint_url"]}')
+    print(f'{"scenario":<32} {"mean ms":>8} {"p50 ms":>8} {"p95 ms":>8}')
+    report('sync put_object, new client', measure_sync(put_new_client))
+    report('sync put_object, pooled client', measure_sync(put_pooled_client))
+    asyncio.get_event_loop().run_until_complete(run_async())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""CPU time of JSON work per request: old async stdlib helpers against codec backends.
+
+before - async _convert_key/_convert_data with stdlib json, record stored as one JSON string
+json   - sync helpers, record stored as hash, stdlib json backend
+orjson - same with orjson backend (skipped if not installed)
+Microseconds of CPU per operation, lower is better. Redis round trips not included.
+Then bytes of one job record in redis: JSON string, hash of version 1 and current hash. Redis keeps
+small hashes with values up to hash-max-listpack-value (64 by default) in compact listpack.
+Run from project root: python3 -m tests.benchmarks.bench_serializer [--repeats 20000]
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Callable, Dict, List, Union
+
+from models.Image import RECORD_FIELDS, ImageData
+from service import RedisRepository, codec
+from service import repository as repository_module
+
+RECORD = ImageData(
+    id='01ec3385-47',
+    status='done',
+    default_image_path='/srv/images',
+    file_name='1602836452.123-holiday photo.jpg',
+    width=800,
+    height=0,
+    scale=0,
+    updated_file_path='/srv/images/resized-1602836452.123-holiday photo.jpg',
+    source_hash='9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08',
+    source_size=2457600,
+    output={'format': 'WEBP', 'quality': 80},
+    resample={'filter': 'auto', 'reducing_gap': 2.0},
+).to_json()
+STATUS = {'id': '01ec3385-47', 'status': 'done'}
+STATUS_FIELDS = ('id', 'status')
+BULK = {'images': [{'id': f'01ec3385-{index}', 'status': 'done'} for index in range(100)]}
+
+
+class OldHelpers:
+    # repository helpers before the change
+
+    async def _convert_key(self, key: Union[str, bytes]) -> str:
+        if isinstance(key, bytes):
+            key = str(key, encoding='UTF-8')
+        return key
+
+    async def _convert_data(self, data: Union[bytes, str, Dict], action_type: str = 'set') -> Union[str, Dict]:
+        if isinstance(data, dict) and action_type == 'set':
+            return json.dumps(data)
+        if isinstance(data, bytes) and action_type == 'get':
+            return json.loads(str(data, encoding='UTF-8'))
+        return data
+
+
+def old_operations(repeats: int) -> Dict[str, Callable[[], None]]:
+    helpers = OldHelpers()
+    stored = json.dumps(RECORD).encode()
+    loop = asyncio.new_event_loop()
+
+    def run(coro_function: Callable[[], Any]) -> Callable[[], None]:
+        async def repeat() -> None:
+            for _ in range(repeats):
+                await coro_function()
+        return lambda: loop.run_until_complete(repeat())
+
+    async def record_write() -> None:
+        await helpers._convert_key(b'01ec3385-47')
+        await helpers._convert_data(RECORD, action_type='set')
+
+    async def record_read() -> None:
+        await helpers._convert_key(b'01ec3385-47')
+        await helpers._convert_data(stored, action_type='get')
+
+    async def status_read() -> None:
+        # whole record read for status check
+        await record_read()
+
+    async def status_response() -> None:
+        json.dumps(STATUS).encode()
+
+    async def bulk_response() -> None:
+        json.dumps(BULK).encode()
+
+    return {
+        'record write': run(record_write),
+        'record read': run(record_read),
+        'status read': run(status_read),
+        'status response': run(status_response),
+        'bulk response': run(bulk_response),
+    }
+
+
+def new_operations(repeats: int, backend: str) -> Dict[str, Callable[[], None]]:
+    _, dumps, loads = codec.get_backend(backend)
+    repository = RedisRepository()
+    # repository module uses backend selected on import
+    repository_module.dumps, repository_module.loads = dumps, loads
+    stored = {name.encode(): value for name, value in repository._encode_fields(RECORD).items()}
+    # HMGET reply
+    status_stored = [stored.get(key.encode()) for key in repository._get_keys(STATUS_FIELDS)]
+
+    def run(function: Callable[[], Any]) -> Callable[[], None]:
+        def repeat() -> None:
+            repository_module.dumps, repository_module.loads = dumps, loads
+            for _ in range(repeats):
+                function()
+        return repeat
+
+    return {
+        'record write': run(lambda: (repository._convert_key(b'01ec3385-47'), repository._encode_fields(RECORD))),
+        'record read': run(lambda: (repository._convert_key(b'01ec3385-47'), repository._decode_fields(stored))),
+        # only id and status read for status check
+        'status read': run(lambda: (
+            repository._convert_key(b'01ec3385-47'),
+            repository._decode_reply(status_stored, STATUS_FIELDS),
+        )),
+        'status response': run(lambda: dumps(STATUS)),
+        'bulk response': run(lambda: dumps(BULK)),
+    }
+
+
+def record_sizes() -> Dict[str, Dict[str, int]]:
+    # payload bytes and longest value. Old model stored not set fields as null
+    old_record = {name: RECORD.get(name) for name in RECORD_FIELDS}
+    hash_v1 = {name: json.dumps(value).encode() for name, value in old_record.items()}
+    hash_v2 = RedisRepository()._encode_fields(RECORD)
+    return {
+        'string': {'bytes': len(json.dumps(old_record)), 'longest': len(json.dumps(old_record))},
+        'hash v1': {
+            'bytes': sum(len(name) + len(value) for name, value in hash_v1.items()),
+            'longest': max(len(value) for value in hash_v1.values()),
+        },
+        'hash v2': {
+            'bytes': sum(len(name) + len(value) for name, value in hash_v2.items()),
+            'longest': max(len(value) for value in hash_v2.values()),
+        },
+    }
+
+
+def measure(operation: Callable[[], None], repeats: int) -> float:
+    start = time.process_time()
+    operation()
+    return (time.process_time() - start) / repeats * 1000000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=20000)
+    args = parser.parse_args()
+    columns: Dict[str, Dict[str, Callable[[], None]]] = {'before': old_operations(args.repeats)}
+    for backend in ('json', 'orjson'):
+        if backend == 'orjson' and codec.orjson is None:
+            continue
+        columns[backend] = new_operations(args.repeats, backend)
+    names: List[str] = list(columns['before'])
+    print(f'{args.repeats} repeats, us of CPU per operation')
+    print(f'{"operation":<16} ' + ' '.join(f'{column:>8}' for column in columns))
+    for name in names:
+        row = [measure(operations[name], args.repeats) for operations in columns.values()]
+        print(f'{name:<16} ' + ' '.join(f'{value:>8.2f}' for value in row))
+    print(f'\n{"record":<16} {"bytes":>8} {"longest":>8}')
+    for name, size in record_sizes().items():
+        print(f'{name:<16} {size["bytes"]:>8} {size["longest"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
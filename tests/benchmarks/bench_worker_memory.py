@@ -0,0 +1,81 @@
+"""Peak RSS of resize worker: bytes copies vs direct file I/O.
+
+Every run made in fresh spawned process, so ru_maxrss is peak of single resize.
+Run from project root: python3 -m tests.benchmarks.bench_worker_memory
+"""
+import io
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+from concurrent.futures.process import ProcessPoolExecutor
+from typing import Tuple
+
+from PIL import Image
+
+from service import ImageResizer, LocalFileStorage
+
+SOURCE_SIZE = (9000, 6000)
+FORMATS = ('JPEG', 'PNG')
+SCALE = 2
+
+
+def make_image(images_path: str, image_format: str, size: Tuple[int, int]) -> str:
+    noise = Image.effect_noise(size, 40)
+    gradient = Image.linear_gradient('L').resize(size)
+    image_name = f'source.{image_format.lower()}'
+    Image.merge('RGB', (noise, gradient, gradient)).save(
+        os.path.join(images_path, image_name), format=image_format,
+    )
+    return image_name
+
+
+def resize_bytes_copy(images_path: str, image_name: str) -> int:
+    # old worker path: whole file read in bytes and encoded result copied with getvalue()
+    storage = LocalFileStorage(images_path=images_path)
+    resizer = ImageResizer(storage)
+    resizer.image_name, resizer.scale = image_name, SCALE
+    image = Image.open(io.BytesIO(storage.get_default(image_name)))
+    resized = resizer._resize_image(image)
+    bytes_data = io.BytesIO()
+    resized.save(bytes_data, format=image.format)
+    storage.save_result(bytes_data.getvalue(), image_name)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def resize_direct(images_path: str, image_name: str) -> int:
+    storage = LocalFileStorage(images_path=images_path)
+    resizer = ImageResizer(storage)
+    resizer.image_name, resizer.scale = image_name, SCALE
+    with resizer._open_image() as image:
+        resized = resizer._resize_image(image)
+    resizer._save_image(resized)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_rss_mb(func, images_path: str, image_name: str) -> float:
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        # ru_maxrss in kilobytes on linux
+        return pool.submit(func, images_path, image_name).result() / 1024
+
+
+def main() -> None:
+    images_path = tempfile.mkdtemp()
+    try:
+        print(f'Source: {SOURCE_SIZE[0]}x{SOURCE_SIZE[1]} ({SOURCE_SIZE[0] * SOURCE_SIZE[1] / 10 ** 6:.0f} MP), '
+              f'scale {SCALE}')
+        print(f'{"format":>8} {"file MB":>8} {"bytes MB":>9} {"direct MB":>10} {"saved MB":>9}')
+        for image_format in FORMATS:
+            image_name = make_image(images_path, image_format, SOURCE_SIZE)
+            file_size = os.path.getsize(os.path.join(images_path, image_name)) / 2 ** 20
+            bytes_copy = peak_rss_mb(resize_bytes_copy, images_path, image_name)
+            direct = peak_rss_mb(resize_direct, images_path, image_name)
+            print(f'{image_format:>8} {file_size:>8.1f} {bytes_copy:>9.1f} {direct:>10.1f} {bytes_copy - direct:>9.1f}')
+    finally:
+        shutil.rmtree(images_path)
+
+
+if __name__ == '__main__':
+    main()
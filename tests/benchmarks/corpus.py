@@ -0,0 +1,115 @@
+"""Deterministic image corpus for benchmarks.
+
+Same content for same Pillow version: no random noise, only gradients, fractal and shapes
+from seeded random. Generated images cached in corpus dir, sha256 of every file saved in results,
+so results of different commits are comparable only if sums are equal.
+Run from project root to generate: python3 -m tests.benchmarks.corpus [--sizes small,medium]
+"""
+import argparse
+import hashlib
+import os
+import random
+import tempfile
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+CORPUS_DIR = os.path.join(tempfile.gettempdir(), 'aio_image_resizer_corpus')
+SIZES = {
+    'small': (640, 480),
+    'medium': (1920, 1280),
+    'large': (4000, 3000),
+    # 100 MP
+    'huge': (12000, 8400),
+}
+# format: extension, alpha variant made
+FORMATS = {
+    'JPEG': ('jpg', False),
+    'PNG': ('png', True),
+    'WEBP': ('webp', True),
+}
+# content drawn at most at this width and scaled up, big images are cheap to make
+BASE_WIDTH = 2000
+SEED = 42
+
+
+class CorpusImage(NamedTuple):
+    name: str
+    path: str
+    size: Tuple[int, int]
+    format: str
+    alpha: bool
+
+    @property
+    def megapixels(self) -> float:
+        return self.size[0] * self.size[1] / 1000000
+
+
+def make_image(size: Tuple[int, int], alpha: bool) -> Image.Image:
+    base_size = (min(size[0], BASE_WIDTH), int(size[1] * min(size[0], BASE_WIDTH) / size[0]))
+    red = Image.linear_gradient('L').resize(base_size)
+    green = Image.radial_gradient('L').resize(base_size)
+    blue = Image.effect_mandelbrot(base_size, (-2.0, -1.0, 1.0, 1.0), 50)
+    image = Image.merge('RGB', (red, green, blue))
+    draw = ImageDraw.Draw(image)
+    rand = random.Random(SEED)
+    for _ in range(200):
+        x, y = rand.randrange(base_size[0]), rand.randrange(base_size[1])
+        radius = rand.randrange(2, max(base_size[0] // 20, 3))
+        color = tuple(rand.randrange(256) for _ in range(3))
+        if rand.random() < 0.5:
+            draw.ellipse((x, y, x + radius, y + radius), fill=color)
+        else:
+            draw.line((x, y, x + radius * 3, y + radius), fill=color, width=rand.randrange(1, 4))
+    if alpha:
+        image.putalpha(Image.radial_gradient('L').resize(base_size))
+    if base_size != size:
+        image = image.resize(size, Image.BICUBIC)
+    return image
+
+
+def get_corpus(sizes: Optional[List[str]] = None, corpus_dir: str = CORPUS_DIR) -> List[CorpusImage]:
+    # generates missing images, returns all images of given sizes
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = []
+    for size_name in sizes or SIZES:
+        size = SIZES[size_name]
+        for format_image, (extension, with_alpha) in FORMATS.items():
+            for alpha in (False, True) if with_alpha else (False,):
+                name = f'{size_name}_{"alpha" if alpha else "opaque"}.{extension}'
+                path = os.path.join(corpus_dir, name)
+                if not os.path.exists(path):
+                    tmp_path = f'{path}.tmp'
+                    make_image(size, alpha).save(tmp_path, format=format_image)
+                    os.replace(tmp_path, path)
+                corpus.append(CorpusImage(name, path, size, format_image, alpha))
+    return corpus
+
+
+def describe(corpus: List[CorpusImage]) -> Dict[str, Dict]:
+    result = {}
+    for image in corpus:
+        with open(image.path, 'rb') as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        result[image.name] = {
+            'size': list(image.size),
+            'format': image.format,
+            'alpha': image.alpha,
+            'bytes': os.path.getsize(image.path),
+            'sha256': sha256,
+        }
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default=','.join(SIZES), help=f'comma separated: {", ".join(SIZES)}')
+    parser.add_argument('--dir', default=CORPUS_DIR)
+    args = parser.parse_args()
+    corpus = get_corpus(args.sizes.split(','), args.dir)
+    for name, info in describe(corpus).items():
+        print(f'{name:<20} {info["size"][0]:>6}x{info["size"][1]:<6} {info["bytes"]:>10} {info["sha256"][:16]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+"""Resize throughput benchmark on deterministic corpus (see corpus.py).
+
+Scenarios:
+  resizer - ImageResizer.resize_img alone in process pool, LocalFileStorage
+  e2e     - upload, wait for status, download through aiohttp app, fakeredis and LocalFileStorage
+  s3      - same as e2e with AmazonFileStorage and AWS_STORE_DEFAULT on local S3 stand-in
+Reports p50/p95/p99 latency, images/sec and peak RSS of every worker, saves results to JSON.
+Needs fakeredis and redis for e2e and s3, moto for s3 (or AWS_ENDPOINT_URL), see test_requirements.txt.
+
+Run from project root:
+  python3 -m tests.benchmarks.harness --scenarios resizer,e2e --sizes small,medium
+  python3 -m tests.benchmarks.harness --compare bench_results/old.json bench_results/new.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+from concurrent.futures.process import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import aioredis
+import PIL
+from aiohttp import ClientSession, FormData
+from aiohttp.test_utils import TestServer
+
+from config import CONFIG
+from service import ImageResizer, LocalFileStorage, AmazonFileStorage
+from tests.benchmarks.corpus import CorpusImage, SIZES, describe, get_corpus
+
+SCENARIOS = ('resizer', 'e2e', 's3')
+RESULTS_DIR = 'bench_results'
+S3_BUCKET = 'bench-bucket'
+# in secs, long polling of job status
+WAIT = 30
+
+# image name, latency in secs, error
+Timing = Tuple[str, float, Optional[str]]
+
+
+def percentile(values: List[float], percent: float) -> float:
+    # nearest rank
+    values = sorted(values)
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+def get_peak_rss(pid: int) -> Optional[int]:
+    # in bytes, Linux only
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def get_pool_peak_rss(pool: ProcessPoolExecutor) -> Dict[str, Optional[int]]:
+    # call before pool shutdown
+    return {str(pid): get_peak_rss(pid) for pid in list(pool._processes or {})}
+
+
+def summarize(timings: List[Timing], wall_time: float, peak_rss: Dict[str, Optional[int]]) -> Dict:
+    latencies = [elapsed for _, elapsed, error in timings if not error]
+    per_image = {}
+    for name in dict.fromkeys(name for name, _, _ in timings):
+        image_latencies = [elapsed for image, elapsed, error in timings if image == name and not error]
+        if image_latencies:
+            per_image[name] = {'p50_ms': round(percentile(image_latencies, 50) * 1000, 2)}
+    result = {
+        'images': len(timings),
+        'errors': len(timings) - len(latencies),
+        'wall_s': round(wall_time, 3),
+        'images_per_sec': round(len(latencies) / wall_time, 2) if wall_time else 0.0,
+        'latency_ms': {},
+        'per_image': per_image,
+        'peak_rss_mb': {pid: round(rss / 1024 / 1024, 1) if rss else None for pid, rss in peak_rss.items()},
+    }
+    if latencies:
+        result['latency_ms'] = {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+            'p50': round(percentile(latencies, 50) * 1000, 2),
+            'p95': round(percentile(latencies, 95) * 1000, 2),
+            'p99': round(percentile(latencies, 99) * 1000, 2),
+        }
+    errors = sorted({error for _, _, error in timings if error})
+    if errors:
+        result['error_messages'] = errors[:10]
+    return result
+
+
+def start_worker(_: int) -> int:
+    return os.getpid()
+
+
+def resize_job(path: str, images_dir: str, width: int) -> Tuple[float, Optional[str]]:
+    # default image deleted by resizer, so every job resizes own copy. Copy not timed
+    name = f'{uuid.uuid4().hex}-{os.path.basename(path)}'
+    shutil.copyfile(path, os.path.join(images_dir, name))
+    resizer = ImageResizer(LocalFileStorage(images_path=images_dir))
+    start = time.perf_counter()
+    result, error = resizer.resize_img(name, width, 0, 0)
+    elapsed = time.perf_counter() - start
+    if result:
+        os.remove(result)
+    return elapsed, None if result else error
+
+
+def run_resizer(corpus: List[CorpusImage], args: argparse.Namespace) -> Dict:
+    jobs = [image for image in corpus for _ in range(args.repeats)]
+    with tempfile.TemporaryDirectory() as images_dir, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        # start workers before measure
+        list(pool.map(start_worker, range(args.workers)))
+        start = time.perf_counter()
+        futures = [(image.name, pool.submit(resize_job, image.path, images_dir, args.width)) for image in jobs]
+        timings = [(name, *future.result()) for name, future in futures]
+        wall_time = time.perf_counter() - start
+        peak_rss = get_pool_peak_rss(pool)
+    return summarize(timings, wall_time, peak_rss)
+
+
+def use_fake_redis() -> None:
+    # one fake server for repository pool and notifier subscription
+    from fakeredis import FakeServer
+    import fakeredis.aioredis as fake_aioredis
+    server = FakeServer()
+
+    # fake server has no password
+    async def create_redis_pool(address: str, **kwargs) -> aioredis.Redis:
+        return await fake_aioredis.create_redis_pool(server, db=kwargs.get('db'))
+
+    async def create_redis(address: str, **kwargs) -> aioredis.Redis:
+        return await fake_aioredis.create_redis(server, db=kwargs.get('db'))
+
+    aioredis.create_redis_pool = create_redis_pool
+    aioredis.create_redis = create_redis
+
+
+def configure_app(args: argparse.Namespace, images_dir: str) -> None:
+    CONFIG.update({
+        'files_path': images_dir,
+        'workers': args.workers,
+        'role': 'all',
+        # delete results after download, disk stays clean
+        'clear': True,
+        'debug': None,
+    })
+    CONFIG['queue'].update({'backend': 'local', 'max_size': 0, 'max_in_flight': args.workers})
+    # every request must be resized
+    CONFIG['cache']['enabled'] = False
+    CONFIG['sync']['auto_size'] = 0
+
+
+async def e2e_request(session: ClientSession, base_url: str, image: CorpusImage, width: int) -> Timing:
+    form = FormData()
+    # first field - file name, second - file
+    form.add_field('name', image.name)
+    with open(image.path, 'rb') as f:
+        form.add_field('file', f.read(), filename=image.name)
+    start = time.perf_counter()
+    async with session.post(f'{base_url}/api/v1/image', params={'width': width}, data=form) as resp:
+        if resp.status != 202:
+            return image.name, time.perf_counter() - start, f'upload status {resp.status}'
+        image_id = (await resp.json())['id']
+    status = 'loaded'
+    while status not in ('done', 'error'):
+        async with session.get(f'{base_url}/api/v1/image/{image_id}/check', params={'wait': WAIT}) as resp:
+            status = (await resp.json())['status']
+    if status == 'error':
+        return image.name, time.perf_counter() - start, 'resize error'
+    async with session.get(f'{base_url}/api/v1/image/{image_id}') as resp:
+        await resp.read()
+        if resp.status != 200:
+            return image.name, time.perf_counter() - start, f'download status {resp.status}'
+    return image.name, time.perf_counter() - start, None
+
+
+async def run_app(corpus: List[CorpusImage], args: argparse.Namespace) -> Dict:
+    from main import create_app
+    app = create_app()
+    server = TestServer(app)
+    await server.start_server()
+    base_url = str(server.make_url('')).rstrip('/')
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def limited(session: ClientSession, image: CorpusImage) -> Timing:
+        async with slots:
+            return await e2e_request(session, base_url, image, args.width)
+
+    try:
+        async with ClientSession() as session:
+            # warm up: starts pool workers
+            await asyncio.gather(*(limited(session, corpus[0]) for _ in range(args.workers)))
+            start = time.perf_counter()
+            timings = await asyncio.gather(*(
+                limited(session, image) for image in corpus for _ in range(args.repeats)
+            ))
+            wall_time = time.perf_counter() - start
+        peak_rss = get_pool_peak_rss(app.process_pool)
+    finally:
+        await server.close()
+    return summarize(list(timings), wall_time, peak_rss)
+
+
+def run_e2e(corpus: List[CorpusImage], args: argparse.Namespace) -> Dict:
+    with tempfile.TemporaryDirectory() as images_dir:
+        configure_app(args, images_dir)
+        CONFIG['file_storage_type'] = 'local'
+        return asyncio.get_event_loop().run_until_complete(run_app(corpus, args))
+
+
+def run_s3(corpus: List[CorpusImage], args: argparse.Namespace) -> Dict:
+    from tests.benchmarks.bench_s3_clients import start_s3_stand_in
+    start_s3_stand_in()
+    with tempfile.TemporaryDirectory() as images_dir:
+        configure_app(args, images_dir)
+        CONFIG['file_storage_type'] = 'aws'
+        CONFIG['amazon'].update({'bucket': S3_BUCKET, 'folder': 'bench', 'store_default': True})
+        client = AmazonFileStorage(images_path=images_dir)._get_client(sync=True)
+        try:
+            client.create_bucket(Bucket=S3_BUCKET)
+        except client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+        return asyncio.get_event_loop().run_until_complete(run_app(corpus, args))
+
+
+RUNNERS = {
+    'resizer': run_resizer,
+    'e2e': run_e2e,
+    's3': run_s3,
+}
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(name: str, result: Dict) -> None:
+    latency = result['latency_ms']
+    rss = [value for value in result['peak_rss_mb'].values() if value]
+    print(f'{name:<8} {result["images"]:>6} {result["errors"]:>6} {result["images_per_sec"]:>9.2f} '
+          f'{latency.get("p50", 0):>9.1f} {latency.get("p95", 0):>9.1f} {latency.get("p99", 0):>9.1f} '
+          f'{max(rss) if rss else 0:>9.1f}')
+    for message in result.get('error_messages', []):
+        print(f'    error: {message}')
+
+
+def run(args: argparse.Namespace) -> None:
+    corpus = get_corpus(args.sizes.split(','))
+    results = {
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'cpus': os.cpu_count(),
+        'params': {
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'repeats': args.repeats,
+            'width': args.width,
+            'filter': CONFIG['resize']['filter'],
+            'draft': CONFIG['resize']['draft'],
+        },
+        'corpus': describe(corpus),
+        'scenarios': {},
+    }
+    print(f'{len(corpus)} images x {args.repeats} repeats, width {args.width}, {args.workers} workers')
+    print(f'{"scenario":<8} {"images":>6} {"errors":>6} {"images/s":>9} {"p50 ms":>9} {"p95 ms":>9} '
+          f'{"p99 ms":>9} {"RSS MB":>9}')
+    for name in args.scenarios.split(','):
+        results['scenarios'][name] = RUNNERS[name](corpus, args)
+        print_result(name, results['scenarios'][name])
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f'{(results["commit"] or "nocommit")[:10]}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved to {path}')
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if {name: info['sha256'] for name, info in old['corpus'].items()} != \
+            {name: info['sha256'] for name, info in new['corpus'].items()}:
+        print('Warning: corpus differs, results are not comparable')
+    print(f'{old["commit"]} -> {new["commit"]}')
+    print(f'{"scenario":<8} {"metric":<10} {"old":>10} {"new":>10} {"change":>8}')
+    for name in new['scenarios']:
+        if name not in old['scenarios']:
+            continue
+        old_result, new_result = old['scenarios'][name], new['scenarios'][name]
+        rows = [('images/s', old_result['images_per_sec'], new_result['images_per_sec'])]
+        rows += [
+            (f'{metric} ms', old_result['latency_ms'].get(metric), new_result['latency_ms'].get(metric))
+            for metric in ('p50', 'p95', 'p99')
+        ]
+        for metric, old_value, new_value in rows:
+            if not old_value or new_value is None:
+                continue
+            print(f'{name:<8} {metric:<10} {old_value:>10.2f} {new_value:>10.2f} {new_value / old_value - 1:>+8.1%}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='resizer,e2e', help=f'comma separated: {", ".join(SCENARIOS)}')
+    parser.add_argument('--sizes', default='small,medium,large', help=f'comma separated: {", ".join(SIZES)}')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=CONFIG['workers'])
+    parser.add_argument('--concurrency', type=int, help='requests at once in e2e, s3. Default - 2 * workers')
+    parser.add_argument('--width', type=int, default=512, help='target width')
+    parser.add_argument('--output', default=RESULTS_DIR, help='dir for JSON results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON results')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    args.concurrency = args.concurrency or 2 * args.workers
+    if 'e2e' in args.scenarios or 's3' in args.scenarios:
+        use_fake_redis()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import pytest
+
+from models.Image import ImageData
+
+JOB = {
+    'id': '1',
+    'status': 'loaded',
+    'default_image_path': '/srv',
+    'file_name': 'a.jpg',
+    'width': 10,
+    'height': 0,
+    'scale': 0,
+}
+
+
+def test_slots():
+    job = ImageData(**JOB)
+    assert not hasattr(job, '__dict__')
+    with pytest.raises(AttributeError):
+        job.unknown = 1
+
+
+def test_to_json_skips_not_set():
+    assert ImageData(**JOB, output={}).to_json() == dict(JOB, output={})
+
+
+def test_from_json():
+    job = ImageData.from_json(dict(JOB, updated_file_path=None, unknown='x'))
+    assert job == ImageData(**JOB)
+
+
+@pytest.mark.parametrize('data', [
+    {name: value for name, value in JOB.items() if name != 'file_name'},
+    dict(JOB, width='10'),
+    dict(JOB, scale=True),
+    dict(JOB, outputs={}),
+])
+def test_from_json_invalid(data):
+    with pytest.raises(ValueError):
+        ImageData.from_json(data)
@@ -0,0 +1,51 @@
+import pytest
+
+from config import CONFIG
+from service.adapters import AdapterBase, AiohttpAdapter
+from tests.service.conftest import TEST_FILE_NAME, IMAGE_BYTES
+
+
+class MockAdapter(AdapterBase):
+
+    def __init__(self):
+        self.chunks = []
+        self.content_length = None
+
+    async def read(self):
+        pass
+
+    async def write(self, body):
+        self.chunks.append(body)
+
+    async def prepare(self, content_length=None, status=200, headers=None):
+        self.content_length = content_length
+
+    def get_header(self, name):
+        return None
+
+
+@pytest.mark.asyncio
+async def test_send_file_chunks(image_in_dir, monkeypatch):
+    monkeypatch.setitem(CONFIG, 'download_chunk_size', 1000)
+    adapter = MockAdapter()
+    await adapter.send_file(f'{image_in_dir}/{TEST_FILE_NAME}')
+    assert adapter.content_length == len(IMAGE_BYTES)
+    assert b''.join(adapter.chunks) == IMAGE_BYTES
+    assert all(len(chunk) == 1000 for chunk in adapter.chunks[:-1])
+
+
+class MockField:
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    async def read_chunk(self):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+@pytest.mark.asyncio
+async def test_read_bytes_read():
+    adapter = AiohttpAdapter(field=MockField([b'abc', b'de']))
+    body = b''.join([chunk async for chunk in adapter.read()])
+    assert body == b'abcde'
+    assert adapter.bytes_read == 5
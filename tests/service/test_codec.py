@@ -0,0 +1,31 @@
+import pytest
+
+from service import codec
+
+DATA = {'id': '1', 'status': 'done', 'file_name': 'фото.jpg', 'outputs': [{'width': 10, 'scale': 0.5}], 'none': None}
+
+
+@pytest.mark.parametrize('name', ['json', 'orjson'])
+def test_round_trip(name):
+    if name == 'orjson' and codec.orjson is None:
+        pytest.skip('orjson is not installed')
+    _, dumps, loads = codec.get_backend(name)
+    assert isinstance(dumps(DATA), bytes)
+    assert loads(dumps(DATA)) == DATA
+    assert loads(dumps(DATA).decode()) == DATA
+
+
+def test_backends_same_output():
+    if codec.orjson is None:
+        pytest.skip('orjson is not installed')
+    # lua status check compares encoded values
+    assert codec.get_backend('json')[1](DATA) == codec.get_backend('orjson')[1](DATA)
+
+
+def test_auto():
+    assert codec.get_backend('auto')[0] == ('orjson' if codec.orjson else 'json')
+
+
+def test_unknown():
+    with pytest.raises(ValueError):
+        codec.get_backend('pickle')
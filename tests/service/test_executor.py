@@ -0,0 +1,31 @@
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import pytest
+
+from service.executor import HybridExecutor, select_executor
+
+
+@pytest.fixture()
+def hybrid():
+    executor = HybridExecutor(ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1), threshold=100)
+    yield executor
+    executor.shutdown()
+
+
+def test_select(hybrid):
+    assert hybrid.select(100) is hybrid.thread_pool
+    assert hybrid.select(101) is hybrid.process_pool
+    # size unknown
+    assert hybrid.select(None) is hybrid.process_pool
+
+
+def test_submit(hybrid):
+    assert hybrid.submit(sum, [1, 2]).result() == 3
+
+
+def test_select_executor(hybrid):
+    pool = ThreadPoolExecutor(max_workers=1)
+    assert select_executor(pool, 10) is pool
+    assert select_executor(None, 10) is None
+    assert select_executor(hybrid, 10) is hybrid.thread_pool
+    pool.shutdown()
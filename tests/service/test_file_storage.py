@@ -1,8 +1,14 @@
+import asyncio
+import hashlib
 import os
+import pickle
 
 import funcy
 import pytest
+from botocore.exceptions import ClientError
 
+from config import CONFIG
+from service import file_storage
 from service.file_storage import ImageNotFoundError, PathNotFoundError, AmazonFileStorage, ConnectionStorageError
 from tests.service.conftest import IMAGE_BYTES, TEST_FILE_NAME
 
@@ -27,8 +33,8 @@ def aws_storage(images_dir, aws_image_in_dir):
 
 class MockAdapter:
 
-    def __init__(self):
-        self.image_b = list(funcy.chunks(10000, IMAGE_BYTES))
+    def __init__(self, chunk_size=10000):
+        self.image_b = list(funcy.chunks(chunk_size, IMAGE_BYTES))
 
     async def read(self):
         while True:
@@ -57,18 +63,50 @@ class AsyncConn:
         pass
 
     async def get_object(self, *args, **kwargs):
+        body = IMAGE_BYTES
+        response = {"ContentLength": len(body), "ETag": '"etag"'}
+        if kwargs.get("Range"):
+            start, end = kwargs["Range"][len("bytes="):].split("-")
+            body = IMAGE_BYTES[int(start):int(end) + 1]
+            response.update({
+                "ContentLength": len(body),
+                "ContentRange": f"bytes {start}-{end}/{len(IMAGE_BYTES)}",
+            })
+
         class Stream:
 
+            def __init__(self):
+                self.body = body
+
             async def __aenter__(self):
                 return self
 
             async def __aexit__(self, exc_type, exc_val, exc_tb):
                 pass
 
-            async def read(self):
-                return IMAGE_BYTES
+            async def read(self, amt=None):
+                chunk, self.body = self.body[:amt], self.body[amt:]
+                return chunk
+
+        response["Body"] = Stream()
+        return response
+
+
+class MockWriteAdapter:
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.chunks = []
+        self.prepared = None
+
+    def get_header(self, name):
+        return self.headers.get(name)
+
+    async def prepare(self, content_length=None, status=200, headers=None):
+        self.prepared = {"content_length": content_length, "status": status, "headers": headers}
 
-        return {"Body": Stream}
+    async def write(self, body):
+        self.chunks.append(body)
 
 
 def mock_get_client(sync=False):
@@ -99,6 +137,40 @@ class TestLocalFileStorage:
         result_path = local_storage.save_result(image, image_name)
         assert os.path.exists(result_path)
 
+    def test_open_default(self, local_storage):
+        assert local_storage.open_default('test.png') == os.path.join(local_storage.images_path, 'test.png')
+
+    def test_open_default_exception(self, local_storage, monkeypatch):
+        full_image_path = "/test/"
+        monkeypatch.setattr(local_storage, "images_path", full_image_path)
+        with pytest.raises(ImageNotFoundError) as exc:
+            local_storage.open_default('test.png')
+        assert exc.value.args[0] == f"Not found {full_image_path}test.png"
+
+    def test_encode_result(self, local_storage):
+        image_name = "encoded.png"
+        result_path = local_storage.encode_result(image_name, lambda f: f.write(IMAGE_BYTES))
+        with open(result_path, 'rb') as f:
+            assert f.read() == IMAGE_BYTES
+
+    def test_encode_result_encoder_exception(self, local_storage):
+        image_name = "encoded_error.png"
+
+        def encoder(f):
+            f.write(IMAGE_BYTES[:10])
+            raise OSError("encoder error")
+
+        with pytest.raises(OSError):
+            local_storage.encode_result(image_name, encoder)
+        assert not os.path.exists(os.path.join(local_storage.images_path, f"resized_{image_name}"))
+
+    def test_encode_result_exception(self, local_storage, monkeypatch):
+        full_image_path = "/test/"
+        monkeypatch.setattr(local_storage, "images_path", full_image_path)
+        with pytest.raises(PathNotFoundError) as exc:
+            local_storage.encode_result("test.png", lambda f: f.write(IMAGE_BYTES))
+        assert exc.value.args[0] == f"Not found {full_image_path}"
+
     def test_save_result_image_exception(self, local_storage, monkeypatch):
         image_name = "test.png"
         image = IMAGE_BYTES
@@ -130,8 +202,9 @@ class TestLocalFileStorage:
         full_path = os.path.join(images_dir, file_name)
         mocker.patch.object(os.path, "join", return_value=full_path)
         adapter = MockAdapter()
-        await local_storage.save_default(file_name, adapter)
+        source_hash = await local_storage.save_default(file_name, adapter)
         assert os.path.exists(os.path.join(images_dir, file_name))
+        assert source_hash == hashlib.sha256(IMAGE_BYTES).hexdigest()
 
     @pytest.mark.asyncio
     async def test_delete_result(self, local_storage, images_dir):
@@ -154,8 +227,44 @@ class TestLocalFileStorage:
         assert exception_msg == excepted_msg
 
 
+class MockSession:
+
+    def create_client(self, *args, **kwargs):
+        return AsyncConn()
+
+
 class TestAmazonFileStorage:
 
+    @pytest.mark.asyncio
+    async def test_connect_disconnect(self, mocker):
+        mocker.patch.object(file_storage, 'get_session', return_value=MockSession())
+        aexit = mocker.spy(AsyncConn, '__aexit__')
+        storage = AmazonFileStorage(images_path="/test/")
+        await storage.connect()
+        assert isinstance(storage._get_client(), AsyncConn)
+        await storage.disconnect()
+        assert aexit.called
+        assert storage.client is None
+
+    def test_get_client_not_connected(self):
+        storage = AmazonFileStorage(images_path="/test/")
+        with pytest.raises(ConnectionStorageError) as exc:
+            storage._get_client()
+        assert exc.value.args[0] == "Connection error for AWS: client is not connected"
+
+    def test_get_client_sync_once(self, monkeypatch):
+        monkeypatch.setattr(file_storage, '_sync_client', None)
+        storage = AmazonFileStorage(images_path="/test/")
+        client = storage._get_client(sync=True)
+        assert storage._get_client(sync=True) is client
+
+    def test_pickle_without_async_client(self):
+        storage = AmazonFileStorage(images_path="/test/")
+        storage.client = AsyncConn()
+        unpickled = pickle.loads(pickle.dumps(storage))
+        assert unpickled.client is None
+        assert unpickled.images_path == "/test/"
+
     def test_get_image(self, aws_storage):
         assert aws_storage.get_default(AWS_TEST_FILE_NAME) == IMAGE_BYTES
 
@@ -175,6 +284,15 @@ class TestAmazonFileStorage:
         result_path = aws_storage.save_result(image, image_name)
         assert result_path == f"{aws_storage.folder}/resized_{image_name}"
 
+    def test_encode_result(self, aws_storage, mocker):
+        conn = SyncConn()
+        put_object = mocker.patch.object(conn, 'put_object')
+        mocker.patch.object(AmazonFileStorage, '_get_client', return_value=conn)
+        image_name = "test.png"
+        result_path = aws_storage.encode_result(image_name, lambda f: f.write(IMAGE_BYTES))
+        assert result_path == f"{aws_storage.folder}/resized_{image_name}"
+        assert put_object.call_args[1]['Body'] == IMAGE_BYTES
+
     def test_save_result_image_exception_connection_storage_error(self, aws_storage, monkeypatch, mocker):
         image_name = "test.png"
         image = IMAGE_BYTES
@@ -208,8 +326,9 @@ class TestAmazonFileStorage:
         full_path = os.path.join(images_dir, file_name)
         mocker.patch.object(os.path, "join", return_value=full_path)
         adapter = MockAdapter()
-        await aws_storage.save_default(file_name, adapter)
+        source_hash = await aws_storage.save_default(file_name, adapter)
         assert os.path.exists(os.path.join(images_dir, file_name))
+        assert source_hash == hashlib.sha256(IMAGE_BYTES).hexdigest()
 
     @pytest.mark.asyncio
     async def test_delete_result(self, aws_storage, images_dir, mocker):
@@ -219,6 +338,42 @@ class TestAmazonFileStorage:
         image_file.write('')
         await aws_storage.delete_result(image_name)
 
+    @pytest.mark.asyncio
+    async def test_write_result(self, aws_storage, mocker, monkeypatch):
+        mocker.patch.object(AmazonFileStorage, '_get_client', return_value=mock_get_client())
+        monkeypatch.setitem(CONFIG, 'download_chunk_size', 1000)
+        adapter = MockWriteAdapter()
+        await aws_storage.write_result("test.png", adapter)
+        assert b"".join(adapter.chunks) == IMAGE_BYTES
+        assert all(len(chunk) == 1000 for chunk in adapter.chunks[:-1])
+        assert adapter.prepared == {
+            "content_length": len(IMAGE_BYTES),
+            "status": 200,
+            "headers": {"Accept-Ranges": "bytes", "ETag": '"etag"'},
+        }
+
+    @pytest.mark.asyncio
+    async def test_write_result_range(self, aws_storage, mocker):
+        mocker.patch.object(AmazonFileStorage, '_get_client', return_value=mock_get_client())
+        get_object = mocker.spy(AsyncConn, 'get_object')
+        adapter = MockWriteAdapter(headers={"Range": "bytes=10-99"})
+        await aws_storage.write_result("test.png", adapter)
+        assert get_object.call_args[1]["Range"] == "bytes=10-99"
+        assert b"".join(adapter.chunks) == IMAGE_BYTES[10:100]
+        assert adapter.prepared["status"] == 206
+        assert adapter.prepared["content_length"] == 90
+        assert adapter.prepared["headers"]["Content-Range"] == f"bytes 10-99/{len(IMAGE_BYTES)}"
+
+    @pytest.mark.asyncio
+    async def test_write_result_invalid_range(self, aws_storage, mocker):
+        mocker.patch.object(AmazonFileStorage, '_get_client', return_value=mock_get_client())
+        error = ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+        mocker.patch.object(AsyncConn, 'get_object', side_effect=error)
+        adapter = MockWriteAdapter(headers={"Range": "bytes=100000-"})
+        await aws_storage.write_result("test.png", adapter)
+        assert adapter.prepared["status"] == 416
+        assert not adapter.chunks
+
     @pytest.mark.asyncio
     async def test_delete_result_image_exception(self, aws_storage, mocker):
         mocker.patch.object(AmazonFileStorage, '_get_client', return_value=mock_get_client())
@@ -229,3 +384,121 @@ class TestAmazonFileStorage:
         exception_msg = exc.value.args[0]
         excepted_msg = "Connection error for AWS: "
         assert exception_msg == excepted_msg
+
+
+class MockS3:
+    # sync and async S3 client in one, objects stored in dict
+
+    def __init__(self):
+        self.objects = {}
+        self.parts = {}
+        self.aborted = None
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        body = self.objects[Key]
+
+        class Body:
+
+            def read(self):
+                return body
+
+            def iter_chunks(self, chunk_size):
+                return funcy.chunks(chunk_size, body)
+
+        return {"Body": Body()}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    async def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    async def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload_id"}
+
+    async def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts[PartNumber] = Body
+        return {"ETag": f"etag_{PartNumber}"}
+
+    async def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.objects[Key] = b"".join(self.parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    async def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.parts = {}
+        self.aborted = UploadId
+
+
+class TestAmazonFileStorageStoreDefault:
+
+    @pytest.fixture()
+    def s3(self, mocker):
+        s3 = MockS3()
+        mocker.patch.object(AmazonFileStorage, '_get_client', return_value=s3)
+        return s3
+
+    @pytest.fixture()
+    def storage(self):
+        storage = AmazonFileStorage(images_path="/test/")
+        storage.store_default = True
+        return storage
+
+    @pytest.mark.asyncio
+    async def test_save_default(self, storage, s3):
+        source_hash = await storage.save_default("default.png", MockAdapter())
+        assert s3.objects[f"{storage.folder}/default/default.png"] == IMAGE_BYTES
+        assert not s3.parts
+        assert source_hash == hashlib.sha256(IMAGE_BYTES).hexdigest()
+
+    @pytest.mark.asyncio
+    async def test_save_default_multipart(self, storage, s3, monkeypatch):
+        monkeypatch.setitem(CONFIG['amazon'], 'multipart_part_size', 1500)
+        source_hash = await storage.save_default("default.png", MockAdapter(chunk_size=1000))
+        assert s3.objects[f"{storage.folder}/default/default.png"] == IMAGE_BYTES
+        assert [len(part) for part in s3.parts.values()] == [2000, 2000, len(IMAGE_BYTES) - 4000]
+        assert source_hash == hashlib.sha256(IMAGE_BYTES).hexdigest()
+
+    @pytest.mark.asyncio
+    async def test_save_default_exception(self, storage, s3, mocker):
+        mocker.patch.object(MockS3, 'put_object', side_effect=ConnectionError)
+        with pytest.raises(ConnectionStorageError):
+            await storage.save_default("default.png", MockAdapter())
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('error', [ValueError('broken multipart'), asyncio.CancelledError()])
+    async def test_save_default_multipart_aborted(self, storage, s3, monkeypatch, error):
+        monkeypatch.setitem(CONFIG['amazon'], 'multipart_part_size', 1500)
+
+        class BrokenAdapter(MockAdapter):
+
+            async def read(self):
+                async for chunk in super().read():
+                    yield chunk
+                    if len(s3.parts) == 2:
+                        raise error
+
+        with pytest.raises(type(error)):
+            await storage.save_default("default.png", BrokenAdapter(chunk_size=1000))
+        assert s3.aborted == "upload_id"
+        assert not s3.parts
+        assert not s3.objects
+
+    def test_open_default(self, storage, s3):
+        s3.objects[f"{storage.folder}/default/test.png"] = IMAGE_BYTES
+        image_file = storage.open_default("test.png")
+        assert image_file.read() == IMAGE_BYTES
+
+    def test_open_default_exception(self, storage, s3):
+        with pytest.raises(ImageNotFoundError) as exc:
+            storage.open_default("test.png")
+        assert exc.value.args[0] == f"Not found {storage.folder}/default/test.png"
+
+    def test_get_default(self, storage, s3):
+        s3.objects[f"{storage.folder}/default/test.png"] = IMAGE_BYTES
+        assert storage.get_default("test.png") == IMAGE_BYTES
+
+    def test_delete_default(self, storage, s3):
+        s3.objects[f"{storage.folder}/default/test.png"] = IMAGE_BYTES
+        storage.delete_default("test.png")
+        assert not s3.objects
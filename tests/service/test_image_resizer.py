@@ -1,10 +1,13 @@
 import io
 import os
+from contextlib import nullcontext
 
 import pytest
 from PIL import Image
 
+from config import CONFIG
 from service import ImageResizer, LocalFileStorage
+from service.image_resizer import get_save_params, get_output_name, get_output_format, convert_for_format
 from service.file_storage import ImageNotFoundError, PathNotFoundError
 from tests.service.conftest import TEST_FILE_NAME, IMAGE_BYTES
 
@@ -22,16 +25,25 @@ def pillow_image():
     return image
 
 
-def test__get_image(image_resizer, mocker):
-    mocker.patch.object(LocalFileStorage, 'get_default', return_value=IMAGE_BYTES)
-    result = image_resizer._get_image()
-    assert result == Image.open(io.BytesIO(IMAGE_BYTES))
+def test__open_image(image_resizer, mocker):
+    source = io.BytesIO(IMAGE_BYTES)
+    mocker.patch.object(LocalFileStorage, 'open_default', return_value=source)
+    with image_resizer._open_image() as result:
+        assert result == Image.open(io.BytesIO(IMAGE_BYTES))
+    assert source.closed
 
 
-def test__get_image_exception(image_resizer, monkeypatch):
+def test__open_image_path(image_resizer):
+    with image_resizer._open_image() as result:
+        result.load()
+    assert result.size == (54, 54)
+
+
+def test__open_image_exception(image_resizer, monkeypatch):
     monkeypatch.setattr(image_resizer, "image_name", "not_valid.png")
     with pytest.raises(ImageNotFoundError):
-        image_resizer._get_image()
+        with image_resizer._open_image():
+            pass
 
 
 def test__save_image(image_resizer, images_dir, pillow_image):
@@ -93,12 +105,48 @@ def test_resize_image_scale(image_resizer, monkeypatch, pillow_image):
     assert resized_image.height == 27
 
 
+@pytest.fixture()
+def jpeg_image():
+    bytes_data = io.BytesIO()
+    Image.new('RGB', (800, 600), color=(200, 10, 10)).save(bytes_data, format='JPEG')
+    image = Image.open(bytes_data)
+    return image
+
+
+def test_resize_image_draft(image_resizer, monkeypatch, jpeg_image):
+    monkeypatch.setattr(image_resizer, "width", 100)
+    monkeypatch.setattr(image_resizer, "draft", True)
+    resized_image = image_resizer._resize_image(jpeg_image)
+    assert resized_image.size == (100, 75)
+    # decoded at 1/8 scale
+    assert jpeg_image.size == (100, 75)
+
+
+def test_resize_image_draft_scale(image_resizer, monkeypatch, jpeg_image):
+    monkeypatch.setattr(image_resizer, "scale", 3)
+    monkeypatch.setattr(image_resizer, "draft", True)
+    resized_image = image_resizer._resize_image(jpeg_image)
+    assert resized_image.size == (266, 200)
+    # decoded at 1/2 scale
+    assert jpeg_image.size == (400, 300)
+
+
+def test_resize_image_draft_disabled(image_resizer, monkeypatch, jpeg_image):
+    monkeypatch.setattr(image_resizer, "width", 100)
+    monkeypatch.setattr(image_resizer, "draft", False)
+    resized_image = image_resizer._resize_image(jpeg_image)
+    assert resized_image.size == (100, 75)
+    assert jpeg_image.size == (800, 600)
+
+
 def test_resize_image(image_resizer, images_dir, mocker):
-    mocker.patch.object(LocalFileStorage, 'get_default', return_value=IMAGE_BYTES)
+    source = io.BytesIO(IMAGE_BYTES)
+    mocker.patch.object(LocalFileStorage, 'open_default', return_value=source)
     resized_path = f"{images_dir}/resized_{TEST_FILE_NAME}"
     result, err = image_resizer.resize_img(TEST_FILE_NAME, 10, None, None)
     assert not err
     assert os.path.exists(resized_path)
+    assert source.closed
 
 
 def test_resize_image_exception_default_image_not_found(image_resizer, local_storage):
@@ -110,7 +158,7 @@ def test_resize_image_exception_default_image_not_found(image_resizer, local_sto
 
 def test_resize_image_exception_not_found_delete_not_found_save(image_resizer, pillow_image, local_storage, monkeypatch,
                                                                 mocker):
-    mocker.patch.object(ImageResizer, '_get_image', return_value=pillow_image)
+    mocker.patch.object(ImageResizer, '_open_image', return_value=nullcontext(pillow_image))
     monkeypatch.setattr(local_storage, "images_path", "/test/")
     result, err = image_resizer.resize_img(TEST_FILE_NAME, 10, None, None)
     assert not result
@@ -120,7 +168,7 @@ def test_resize_image_exception_not_found_delete_not_found_save(image_resizer, p
 def test_resize_image_exception_not_found_delete(image_resizer, pillow_image, images_dir, local_storage, monkeypatch,
                                                  mocker):
     success_path = f"{images_dir}/resized_{TEST_FILE_NAME}"
-    mocker.patch.object(ImageResizer, '_get_image', return_value=pillow_image)
+    mocker.patch.object(ImageResizer, '_open_image', return_value=nullcontext(pillow_image))
     mocker.patch.object(ImageResizer, '_save_image', return_value=success_path)
     monkeypatch.setattr(local_storage, "images_path", "/test/")
     result, err = image_resizer.resize_img(TEST_FILE_NAME, 10, None, None)
@@ -129,9 +177,183 @@ def test_resize_image_exception_not_found_delete(image_resizer, pillow_image, im
 
 
 def test_resize_image_exception_not_found_save(image_resizer, pillow_image, local_storage, monkeypatch, mocker):
-    mocker.patch.object(ImageResizer, '_get_image', return_value=pillow_image)
+    mocker.patch.object(ImageResizer, '_open_image', return_value=nullcontext(pillow_image))
     mocker.patch.object(ImageResizer, '_delete_default_image', return_value=None)
     monkeypatch.setattr(local_storage, "images_path", "/test/")
     result, err = image_resizer.resize_img(TEST_FILE_NAME, 10, None, None)
     assert not result
     assert err == f"Save new img err: Not found /test/"
+
+
+@pytest.mark.parametrize('output_format', ['png', 'webp'])
+def test_resize_image_cmyk(local_storage, images_dir, output_format):
+    resizer = ImageResizer(file_storage=local_storage)
+    Image.new('CMYK', (40, 20), (0, 255, 255, 0)).save(os.path.join(images_dir, 'cmyk.jpg'), format='JPEG')
+    result, err = resizer.resize_img('cmyk.jpg', 10, 0, 0, output={'format': output_format})
+    assert err is None
+    image = Image.open(result)
+    assert (image.format, image.mode, image.size) == (output_format.upper(), 'RGB', (10, 5))
+
+
+@pytest.mark.parametrize('mode, format_image, converted', [
+    ('CMYK', 'PNG', 'RGB'),
+    ('CMYK', 'JPEG', 'CMYK'),
+    ('RGBA', 'JPEG', 'RGB'),
+    ('LA', 'WEBP', 'RGBA'),
+    ('LA', 'PNG', 'LA'),
+    ('P', 'AVIF', 'RGB'),
+    ('L', 'WEBP', 'RGB'),
+])
+def test_convert_for_format(mode, format_image, converted):
+    assert convert_for_format(Image.new(mode, (2, 2)), format_image).mode == converted
+
+
+def test_resize_bytes(local_storage, images_dir):
+    resizer = ImageResizer(file_storage=local_storage)
+    files_before = sorted(os.listdir(images_dir))
+    result, error = resizer.resize_bytes(IMAGE_BYTES, TEST_FILE_NAME, 0, 0, 2)
+    assert error is None
+    image = Image.open(io.BytesIO(result))
+    assert image.format == 'PNG'
+    assert image.size == (27, 27)
+    assert sorted(os.listdir(images_dir)) == files_before
+
+
+def test_resize_bytes_exception_not_image(local_storage):
+    resizer = ImageResizer(file_storage=local_storage)
+    result, error = resizer.resize_bytes(b'not image', TEST_FILE_NAME, 0, 0, 2)
+    assert result is None
+    assert error.startswith("Resize img err")
+
+
+def test_resize_many(local_storage, images_dir, mocker, monkeypatch):
+    resizer = ImageResizer(file_storage=local_storage)
+    monkeypatch.setattr(resizer, 'draft', True)
+    source = io.BytesIO(IMAGE_BYTES)
+    mocker.patch.object(LocalFileStorage, 'open_default', return_value=source)
+    delete_default = mocker.patch.object(LocalFileStorage, 'delete_default')
+    resize_from = mocker.spy(resizer, '_resize_from')
+    results = resizer.resize_many(TEST_FILE_NAME, [(10, 0, 0), (0, 0, 2), (20, 20, 0)])
+    # source closed after decode, outputs resized from loaded image
+    assert source.closed
+    assert [err for _, err in results] == [None, None, None]
+    assert [path for path, _ in results] == [
+        f"{images_dir}/resized_{index}_{TEST_FILE_NAME}" for index in range(3)
+    ]
+    assert [Image.open(path).size for path, _ in results] == [(10, 10), (27, 27), (20, 20)]
+    # largest first, next from previous output
+    sources = [call.args[0].size for call in resize_from.call_args_list]
+    assert sources == [(54, 54), (27, 27), (20, 20)]
+    delete_default.assert_called_once_with(TEST_FILE_NAME)
+
+
+def test_resize_many_exception_default_image_not_found(local_storage):
+    resizer = ImageResizer(file_storage=local_storage)
+    results = resizer.resize_many('exc.png', [(10, 0, 0), (0, 0, 2)])
+    assert [path for path, _ in results] == [None, None]
+    assert all('Not found' in err for _, err in results)
+
+
+def test_resize_image_exception_not_image(local_storage, images_dir):
+    resizer = ImageResizer(file_storage=local_storage)
+    images_dir.join('broken.png').write_binary(IMAGE_BYTES[:100])
+    result, err = resizer.resize_img('broken.png', 10, 0, 0)
+    assert result is None
+    assert err.startswith("Resize img err")
+    # broken upload can't be resized later too
+    assert not os.path.exists(os.path.join(images_dir, 'broken.png'))
+
+
+def test_resize_many_exception_not_image(local_storage, images_dir):
+    resizer = ImageResizer(file_storage=local_storage)
+    images_dir.join('broken.png').write_binary(b'not image')
+    results = resizer.resize_many('broken.png', [(10, 0, 0), (0, 0, 2)])
+    assert [path for path, _ in results] == [None, None]
+    assert all(err.startswith("Resize img err") for _, err in results)
+    assert not os.path.exists(os.path.join(images_dir, 'broken.png'))
+
+
+@pytest.mark.parametrize('format_image, output, params', [
+    ('JPEG', {'quality': 70, 'progressive': True, 'optimize': True, 'compress_level': 9},
+     {'quality': 70, 'progressive': True, 'optimize': True}),
+    ('PNG', {'quality': 70, 'optimize': True, 'compress_level': 9}, {'optimize': True, 'compress_level': 9}),
+    ('WEBP', {'quality': 70, 'speed': 10}, {'quality': 70, 'method': 0}),
+    ('WEBP', {'speed': 0}, {'method': 6}),
+    ('AVIF', {'quality': 50, 'speed': 8}, {'quality': 50, 'speed': 8}),
+    ('PNG', None, {}),
+])
+def test_get_save_params(format_image, output, params):
+    assert get_save_params(format_image, output) == params
+
+
+def test_get_output_name():
+    assert get_output_name('1.5-a.b.png') == '1.5-a.b.png'
+    assert get_output_name('1.5-a.b.png', {'format': 'webp'}) == '1.5-a.b.webp'
+    assert get_output_format('a.jpg') == 'JPEG'
+    assert get_output_format('a.jpg', {'format': 'png'}) == 'PNG'
+
+
+def test_resize_bytes_output_format(local_storage):
+    resizer = ImageResizer(file_storage=local_storage)
+    result, error = resizer.resize_bytes(
+        IMAGE_BYTES, TEST_FILE_NAME, 0, 0, 2, {'format': 'jpeg', 'quality': 50, 'progressive': True},
+    )
+    assert error is None
+    image = Image.open(io.BytesIO(result))
+    # alpha dropped for JPEG
+    assert image.format == 'JPEG'
+    assert image.mode == 'RGB'
+    assert image.info.get('progressive')
+
+
+def test_resize_image_output_format(image_resizer, images_dir, mocker):
+    mocker.patch.object(LocalFileStorage, 'open_default', return_value=io.BytesIO(IMAGE_BYTES))
+    mocker.patch.object(LocalFileStorage, 'delete_default')
+    result, err = image_resizer.resize_img(TEST_FILE_NAME, 10, None, None, {'format': 'webp'})
+    assert not err
+    assert result == f"{images_dir}/resized_test.webp"
+    assert Image.open(result).format == 'WEBP'
+
+
+@pytest.mark.parametrize('resample, new_size, result', [
+    (None, (100, 100), (Image.LANCZOS, 2.0)),
+    (None, (600, 600), (Image.BICUBIC, None)),
+    ({'filter': 'nearest'}, (100, 100), (Image.NEAREST, 2.0)),
+    ({'filter': 'bilinear', 'reducing_gap': 0}, (100, 100), (Image.BILINEAR, None)),
+    ({'reducing_gap': 3.0}, (100, 100), (Image.LANCZOS, 3.0)),
+])
+def test_get_resample(image_resizer, monkeypatch, resample, new_size, result):
+    monkeypatch.setattr(image_resizer, "resample", resample)
+    monkeypatch.setitem(CONFIG['resize'], 'filter', 'auto')
+    monkeypatch.setitem(CONFIG['resize'], 'reducing_gap', 2.0)
+    assert image_resizer._get_resample((1000, 1000), new_size) == result
+
+
+def test_get_resample_server_default(image_resizer, monkeypatch):
+    monkeypatch.setattr(image_resizer, "resample", None)
+    monkeypatch.setitem(CONFIG['resize'], 'filter', 'box')
+    monkeypatch.setitem(CONFIG['resize'], 'reducing_gap', 0)
+    assert image_resizer._get_resample((1000, 1000), (900, 900)) == (Image.BOX, None)
+
+
+def test_resize_image_filter(image_resizer, monkeypatch, mocker, pillow_image):
+    monkeypatch.setattr(image_resizer, "width", 10)
+    monkeypatch.setattr(image_resizer, "resample", {'filter': 'hamming', 'reducing_gap': 1.5})
+    resize = mocker.spy(pillow_image, 'resize')
+    assert image_resizer._resize_image(pillow_image).size == (10, 10)
+    resize.assert_called_once_with((10, 10), Image.HAMMING, reducing_gap=1.5)
+
+
+def test_resize_image_timings(image_resizer, images_dir, mocker):
+    mocker.patch.object(LocalFileStorage, 'open_default', return_value=io.BytesIO(IMAGE_BYTES))
+    mocker.patch.object(LocalFileStorage, 'delete_default')
+    result, err = image_resizer.resize_img(TEST_FILE_NAME, 10, None, None)
+    assert not err
+    assert set(image_resizer.timings) == {'storage_load', 'decode', 'resize', 'encode', 'storage_save'}
+    assert all(seconds >= 0 for seconds in image_resizer.timings.values())
+    assert image_resizer.error_types == []
+
+
+def test_resize_image_error_types(image_resizer, local_storage):
+    result, err = image_resizer.resize_img('exc.png', 10, None, None)
+    assert image_resizer.error_types == ['ImageNotFoundError']
@@ -0,0 +1,237 @@
+import asyncio
+
+import pytest
+
+from service import RedisJobQueue
+from service.job_queue import QueueFullError, Job
+
+
+class MockTransaction:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    async def execute(self):
+        return [await getattr(self.pool, name)(*args) for name, args in self.commands]
+
+
+class MockStreamPool:
+    # single consumer group over one stream, enough for queue logic
+
+    def __init__(self):
+        self.streams = {}
+        self.pending = {}
+        self.deliveries = {}
+        self.idle = {}
+        self.last_id = 0
+        self.read_id = 0
+
+    async def xgroup_create(self, stream, group, latest_id='0', mkstream=False):
+        self.streams.setdefault(stream, {})
+
+    async def xadd(self, stream, fields):
+        self.last_id += 1
+        message_id = f'{self.last_id}-0'.encode()
+        self.streams.setdefault(stream, {})[message_id] = {k.encode(): v.encode() for k, v in fields.items()}
+        return message_id
+
+    async def xlen(self, stream):
+        return len(self.streams.get(stream, {}))
+
+    async def xread_group(self, group, consumer, streams, timeout=0, count=None, latest_ids=None):
+        stream = streams[0]
+        for message_id, fields in self.streams.get(stream, {}).items():
+            if int(message_id.split(b'-')[0]) > self.read_id:
+                self.read_id = int(message_id.split(b'-')[0])
+                self.pending[message_id] = consumer
+                self.deliveries[message_id] = 1
+                self.idle[message_id] = 0
+                return [(stream.encode(), message_id, fields)]
+        await asyncio.sleep(0)
+        return []
+
+    async def xpending(self, stream, group, start, stop, count):
+        return [
+            [message_id, consumer.encode(), self.idle[message_id], self.deliveries[message_id]]
+            for message_id, consumer in self.pending.items()
+        ]
+
+    async def xclaim(self, stream, group, consumer, min_idle_time, message_id):
+        if self.idle[message_id] < min_idle_time:
+            return []
+        self.pending[message_id] = consumer
+        self.deliveries[message_id] += 1
+        self.idle[message_id] = 0
+        return [[message_id, self.streams[stream][message_id]]]
+
+    async def xack(self, stream, group, message_id):
+        message_id = message_id.encode() if isinstance(message_id, str) else message_id
+        self.pending.pop(message_id, None)
+
+    async def xdel(self, stream, message_id):
+        message_id = message_id.encode() if isinstance(message_id, str) else message_id
+        self.streams[stream].pop(message_id, None)
+
+    def multi_exec(self):
+        return MockTransaction(self)
+
+    async def execute(self, command, stream, group, consumer, min_idle_time, message_id, *args):
+        self.idle[message_id.encode()] = 0
+
+
+def get_queue(pool, **kwargs):
+    params = {
+        'stream': 'jobs',
+        'group': 'workers',
+        'max_size': 2,
+        'visibility_timeout': 10,
+        'max_retries': 2,
+        'consumer': 'test',
+    }
+    params.update(kwargs)
+    return RedisJobQueue(pool, **params)
+
+
+@pytest.mark.asyncio
+async def test_put_get_ack():
+    pool = MockStreamPool()
+    queue = get_queue(pool)
+    await queue.create_group()
+    await queue.put('job_1')
+    assert await queue.depth() == 1
+    job = await queue.get()
+    assert job.job_id == 'job_1'
+    assert job.message_id == '1-0'
+    await queue.ack(job)
+    assert await queue.depth() == 0
+    assert not pool.pending
+
+
+@pytest.mark.asyncio
+async def test_put_exception_queue_full():
+    queue = get_queue(MockStreamPool(), max_size=1)
+    await queue.put('job_1')
+    assert await queue.is_full()
+    with pytest.raises(QueueFullError) as exc:
+        await queue.put('job_2')
+    assert exc.value.args[0] == "Queue is full: 1 jobs in queue"
+
+
+@pytest.mark.asyncio
+async def test_get_redelivers_stale_job():
+    pool = MockStreamPool()
+    queue = get_queue(pool)
+    await queue.put('job_1')
+    await queue.get()
+    # worker died, job idle longer than visibility_timeout
+    pool.idle[b'1-0'] = 11000
+    queue._reclaim_time = 0.0
+    job = await queue.get()
+    assert job.job_id == 'job_1'
+    assert pool.deliveries[b'1-0'] == 2
+
+
+@pytest.mark.asyncio
+async def test_fail_puts_job_again():
+    pool = MockStreamPool()
+    queue = get_queue(pool, max_retries=3)
+    await queue.put('job_1')
+    job = await queue.get()
+    await queue.fail(job)
+    # old entry removed, new one read at once without visibility_timeout
+    assert list(pool.streams['jobs']) == [b'2-0']
+    assert not pool.pending
+    job = await queue.get()
+    assert (job.job_id, job.message_id, job.attempts) == ('job_1', '2-0', 1)
+
+
+@pytest.mark.asyncio
+async def test_fail_dead_letters_job():
+    pool = MockStreamPool()
+    dead = []
+
+    async def on_dead_letter(job_id):
+        dead.append(job_id)
+
+    queue = get_queue(pool, max_retries=2, on_dead_letter=on_dead_letter)
+    await queue.put('job_1')
+    await queue.fail(await queue.get())
+    await queue.fail(await queue.get())
+    assert dead == ['job_1']
+    assert not pool.streams['jobs']
+    assert list(pool.streams['jobs:dead'].values())[0] == {b'job_id': b'job_1', b'deliveries': b'2'}
+
+
+@pytest.mark.asyncio
+async def test_get_dead_letters_stale_job_after_fail():
+    pool = MockStreamPool()
+    dead = []
+
+    async def on_dead_letter(job_id):
+        dead.append(job_id)
+
+    queue = get_queue(pool, max_retries=2, on_dead_letter=on_dead_letter)
+    queue.block_timeout = 1
+    await queue.put('job_1')
+    await queue.fail(await queue.get())
+    await queue.get()
+    # failed attempt and stale delivery
+    pool.idle[b'2-0'] = 11000
+    queue._reclaim_time = 0.0
+    await queue.put('job_2')
+    assert (await queue.get()).job_id == 'job_2'
+    assert dead == ['job_1']
+
+
+@pytest.mark.asyncio
+async def test_get_dead_letters_job():
+    pool = MockStreamPool()
+    dead = []
+
+    async def on_dead_letter(job_id):
+        dead.append(job_id)
+
+    queue = get_queue(pool, max_retries=1, on_dead_letter=on_dead_letter)
+    queue.block_timeout = 1
+    await queue.put('job_1')
+    await queue.get()
+    pool.idle[b'1-0'] = 11000
+    queue._reclaim_time = 0.0
+    await queue.put('job_2')
+    job = await queue.get()
+    assert job.job_id == 'job_2'
+    assert dead == ['job_1']
+    assert list(pool.streams['jobs:dead'].values())[0][b'job_id'] == b'job_1'
+    assert b'1-0' not in pool.streams['jobs']
+
+
+@pytest.mark.asyncio
+async def test_touch():
+    pool = MockStreamPool()
+    queue = get_queue(pool)
+    await queue.put('job_1')
+    job = await queue.get()
+    pool.idle[b'1-0'] = 5000
+    await queue.touch(job)
+    assert pool.idle[b'1-0'] == 0
+    assert pool.deliveries[b'1-0'] == 1
+
+
+@pytest.mark.asyncio
+async def test_scheduler_heartbeat(mocker):
+    from service import ResizeScheduler
+    queue = get_queue(MockStreamPool())
+    queue.heartbeat_interval = 0.01
+    touch = mocker.patch.object(queue, 'touch')
+    scheduler = ResizeScheduler(queue, max_in_flight=1)
+
+    async def handler(file_id):
+        await asyncio.sleep(0.05)
+
+    await scheduler._run(handler, Job(job_id='job_1', put_time=0.0, message_id='1-0'))
+    assert touch.call_count >= 2
+    assert await queue.depth() == 0
@@ -0,0 +1,88 @@
+import pytest
+
+from service.metrics import MetricsRegistry, Counter, Gauge, Histogram, run_timed
+
+
+@pytest.fixture()
+def registry():
+    return MetricsRegistry()
+
+
+class MockResizer:
+
+    def __init__(self):
+        self.timings = {}
+        self.error_types = []
+
+    def resize(self, value):
+        self.timings = {'decode': 0.5, 'resize': 0.25}
+        self.error_types = ['PathNotFoundError']
+        return value * 2
+
+
+def test_counter(registry):
+    counter = Counter('jobs_total', 'Jobs', ['status'], registry=registry)
+    counter.inc('done')
+    counter.inc('done', amount=2)
+    counter.inc('error')
+    assert counter.get('done') == 3
+    assert registry.render() == (
+        '# HELP jobs_total Jobs\n'
+        '# TYPE jobs_total counter\n'
+        'jobs_total{status="done"} 3.0\n'
+        'jobs_total{status="error"} 1.0\n'
+    )
+
+
+def test_counter_errors(registry):
+    counter = Counter('jobs_total', 'Jobs', ['status'], registry=registry)
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc('done', amount=-1)
+    with pytest.raises(ValueError):
+        Counter('jobs_total', 'Jobs', registry=registry)
+
+
+def test_gauge(registry):
+    gauge = Gauge('depth', 'Depth', registry=registry)
+    gauge.set(5)
+    gauge.inc()
+    gauge.dec(amount=2)
+    assert gauge.get() == 4
+    assert registry.render().endswith('depth 4.0\n')
+
+
+def test_histogram(registry):
+    histogram = Histogram('stage_seconds', 'Stage', ['stage'], buckets=(0.1, 1.0), registry=registry)
+    histogram.observe(0.05, 'decode')
+    histogram.observe(0.5, 'decode')
+    histogram.observe(5, 'decode')
+    with histogram.time('resize'):
+        pass
+    assert histogram.get('decode') == (3, 5.55)
+    assert histogram.get('resize')[0] == 1
+    lines = registry.render().splitlines()
+    assert lines[1] == '# TYPE stage_seconds histogram'
+    assert lines[2:7] == [
+        'stage_seconds_bucket{stage="decode",le="0.1"} 1',
+        'stage_seconds_bucket{stage="decode",le="1.0"} 2',
+        'stage_seconds_bucket{stage="decode",le="+Inf"} 3',
+        'stage_seconds_sum{stage="decode"} 5.55',
+        'stage_seconds_count{stage="decode"} 3',
+    ]
+
+
+def test_label_escape(registry):
+    counter = Counter('errors_total', 'Errors', ['type'], registry=registry)
+    counter.inc('a"b\\')
+    assert 'errors_total{type="a\\"b\\\\"} 1.0' in registry.render()
+
+
+def test_run_timed():
+    result, timings, error_types = run_timed(0.0, MockResizer(), 'resize', 2)
+    assert result == 4
+    assert timings['decode'] == 0.5
+    assert timings['pool_wait'] > 0
+    assert error_types == ['PathNotFoundError']
+
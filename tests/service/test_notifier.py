@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+import aioredis
+import pytest
+
+from service import StatusNotifier
+
+
+class MockPubPool:
+
+    def __init__(self, error=None):
+        self.published = []
+        self.error = error
+
+    async def publish(self, channel, data):
+        if self.error:
+            raise self.error
+        self.published.append((channel, json.loads(data)))
+        return 1
+
+
+class MockChannel:
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    async def wait_message(self):
+        return bool(self.messages)
+
+    async def get(self):
+        return self.messages.pop(0)
+
+
+@pytest.mark.asyncio
+async def test_publish():
+    pool = MockPubPool()
+    notifier = StatusNotifier(pool, 'status')
+    await notifier.publish('1', 'done')
+    assert pool.published == [('status', {'id': '1', 'status': 'done'})]
+
+
+@pytest.mark.asyncio
+async def test_publish_error_not_raised():
+    notifier = StatusNotifier(MockPubPool(error=aioredis.RedisError('down')), 'status')
+    await notifier.publish('1', 'done')
+
+
+@pytest.mark.asyncio
+async def test_listen_fans_out():
+    notifier = StatusNotifier(None, 'status')
+    first = notifier.subscribe('1')
+    second = notifier.subscribe('1')
+    other = notifier.subscribe('2')
+    await notifier.subscription.listen(MockChannel([
+        b'{"id": "1", "status": "resizing"}',
+        b'wrong',
+        b'{"id": "1", "status": "done"}',
+    ]))
+    for queue in (first, second):
+        assert [queue.get_nowait(), queue.get_nowait()] == ['resizing', 'done']
+    assert other.empty()
+
+
+@pytest.mark.asyncio
+async def test_subscription_lost_wakes_waiters():
+    notifier = StatusNotifier(None, 'status')
+    first = notifier.subscribe('1')
+    second = notifier.subscribe('2')
+    notifier._on_lost()
+    # waiters read status from repository
+    assert await notifier.wait(first, 1) is None
+    assert await notifier.wait(second, 1) is None
+    assert first.empty() and second.empty()
+
+
+@pytest.mark.asyncio
+async def test_wait():
+    notifier = StatusNotifier(None, 'status')
+    queue = notifier.subscribe('1')
+    assert await notifier.wait(queue, 0.01) is None
+    asyncio.get_event_loop().call_soon(notifier._dispatch, {'id': '1', 'status': 'done'})
+    assert await notifier.wait(queue, 1) == 'done'
+
+
+def test_unsubscribe():
+    notifier = StatusNotifier(None, 'status')
+    queue = notifier.subscribe('1')
+    notifier.unsubscribe('1', queue)
+    notifier.unsubscribe('1', queue)
+    assert notifier._waiters == {}
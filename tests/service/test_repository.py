@@ -1,20 +1,94 @@
 import json
 
+import aioredis
+import fakeredis.aioredis
 import pytest
 
 from service import RedisRepository
+from service.repository import UPDATE_SCRIPT, UPDATE_SCRIPT_SHA
+
+
+class MockTransaction:
+
+    def __init__(self):
+        self.commands = []
+
+    def delete(self, key):
+        self.commands.append(('delete', key))
+
+    def hmset_dict(self, key, data):
+        self.commands.append(('hmset_dict', key, data))
+
+    def expire(self, key, exp_val):
+        self.commands.append(('expire', key, exp_val))
+
+    async def execute(self):
+        return [1] * len(self.commands)
+
+
+class MockPipeline:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def hmget(self, key, *fields):
+        self.commands.append(('hmget', key, *fields))
+
+    def hgetall(self, key):
+        self.commands.append(('hgetall', key))
+
+    async def execute(self, return_exceptions=False):
+        self.conn.pipelines.append(self.commands)
+        replies = []
+        for name, *args in self.commands:
+            try:
+                replies.append(await getattr(self.conn, name)(*args))
+            except aioredis.ReplyError as e:
+                replies.append(e)
+        return replies
 
 
 class MockRedisConn:
+    # hashes and strings by key
+
+    def __init__(self):
+        self.transactions = []
+        self.pipelines = []
+        self.hashes = {}
+        self.strings = {}
+
+    def multi_exec(self):
+        transaction = MockTransaction()
+        self.transactions.append(transaction)
+        return transaction
+
+    def _hash(self, key):
+        if key in self.strings:
+            raise aioredis.ReplyError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return self.hashes.get(key, {})
+
+    async def hgetall(self, key):
+        return dict(self._hash(key))
+
+    async def hmget(self, key, *fields):
+        data = self._hash(key)
+        return [data.get(name.encode()) for name in fields]
+
+    def pipeline(self):
+        return MockPipeline(self)
+
+    async def eval(self, script, keys=None, args=None):
+        return 1
 
-    async def set(self, key, data):
+    async def evalsha(self, digest, keys=None, args=None):
         return 1
 
     async def get(self, key):
-        return b'{"test":"1"}'
+        return self.strings.get(key)
 
-    async def expire(self, key, exp_val):
-        pass
+    async def ttl(self, key):
+        return 30
 
     async def exists(self, key):
         if key == 'exist':
@@ -25,58 +99,195 @@ class MockRedisConn:
         return 1
 
 
-@pytest.fixture(scope='module')
+@pytest.fixture
 def redis_repo():
     repo = RedisRepository()
     repo.pool = MockRedisConn()
     return repo
 
 
-@pytest.mark.asyncio
-async def test__convert_key_str(redis_repo):
+def test__convert_key_str(redis_repo):
     key = "tra"
-    assert await redis_repo._convert_key(key) == key
+    assert redis_repo._convert_key(key) == key
 
 
-@pytest.mark.asyncio
-async def test__convert_key_bytes(redis_repo):
+def test__convert_key_bytes(redis_repo):
     key = b"tra"
-    assert await redis_repo._convert_key(key) == "tra"
+    assert redis_repo._convert_key(key) == "tra"
 
 
-@pytest.mark.asyncio
-async def test__convert_key_int(redis_repo):
+def test__convert_key_int(redis_repo):
     key = 1
-    assert await redis_repo._convert_key(key) == 1
+    assert redis_repo._convert_key(key) == 1
 
 
-@pytest.mark.asyncio
-async def test__convert_data_set(redis_repo):
+def test__convert_data_set(redis_repo):
     data = {"test": "1"}
-    result = await redis_repo._convert_data(data, action_type='set')
-    assert result == json.dumps(data)
+    result = redis_repo._convert_data(data, action_type='set')
+    assert json.loads(result) == data
 
 
-@pytest.mark.asyncio
-async def test__convert_data_get(redis_repo):
+def test__convert_data_get(redis_repo):
     data = b'{"test": "1"}'
-    result = await redis_repo._convert_data(data, action_type='get')
+    result = redis_repo._convert_data(data, action_type='get')
     assert result == {"test": "1"}
 
 
 @pytest.mark.asyncio
-async def test_insert(redis_repo, mocker):
-    assert await redis_repo.insert("test", {"data": True}) == 1
+async def test_insert(redis_repo):
+    data = {'id': '1', 'status': 'loaded', 'width': 10, 'output': {}, 'updated_file_path': None, 'files': ['1']}
+    assert await redis_repo.insert("test", data)
+    transaction, = redis_repo.pool.transactions
+    assert transaction.commands == [
+        ('delete', 'test'),
+        ('hmset_dict', 'test', {'v': b'2', 'i': b'1', 's': b'loaded', 'w': b'10', 'o': b'{}', 'files': b'["1"]'}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_insert_wrong_type(redis_repo):
+    with pytest.raises(ValueError):
+        await redis_repo.insert("test", {'id': '1', 'width': '10'})
+    assert not redis_repo.pool.transactions
+
+
+@pytest.mark.asyncio
+async def test_insert_expire(redis_repo):
+    assert await redis_repo.insert("test", {"data": True}, expire=30)
+    transaction, = redis_repo.pool.transactions
+    assert transaction.commands[-1] == ('expire', 'test', 30)
+
+
+@pytest.mark.asyncio
+async def test_insert_save_timeout(redis_repo):
+    redis_repo.save_timeout = '2'
+    assert await redis_repo.insert("test", {"data": True})
+    transaction, = redis_repo.pool.transactions
+    assert transaction.commands[-1] == ('expire', 'test', 120)
+
+
+@pytest.mark.asyncio
+async def test_update(redis_repo, mocker):
+    eval_script = mocker.patch.object(MockRedisConn, 'evalsha', return_value=1)
+    assert await redis_repo.update("test", {"status": "error", "updated_file_path": None})
+    eval_script.assert_called_once_with(UPDATE_SCRIPT_SHA, keys=['test'], args=[0, 1, 'u', 's', b'error'])
+
+
+@pytest.mark.asyncio
+async def test_update_script_not_loaded(redis_repo, mocker):
+    mocker.patch.object(MockRedisConn, 'evalsha', side_effect=aioredis.ReplyError('NOSCRIPT No matching script'))
+    eval_script = mocker.patch.object(MockRedisConn, 'eval', return_value=1)
+    assert await redis_repo.update("test", {"status": "error"})
+    eval_script.assert_called_once_with(UPDATE_SCRIPT, keys=['test'], args=[0, 0, 's', b'error'])
+
+
+@pytest.mark.asyncio
+async def test_update_script_error(redis_repo, mocker):
+    mocker.patch.object(MockRedisConn, 'evalsha', side_effect=aioredis.ReplyError('ERR script failed'))
+    with pytest.raises(aioredis.ReplyError):
+        await redis_repo.update("test", {"status": "error"})
+
+
+@pytest.mark.asyncio
+async def test_update_status_from(redis_repo, mocker):
+    eval_script = mocker.patch.object(MockRedisConn, 'evalsha', return_value=0)
+    assert not await redis_repo.update("test", {"status": "resizing"}, status_from=('loaded', 'resizing'))
+    eval_script.assert_called_once_with(
+        UPDATE_SCRIPT_SHA,
+        keys=['test'],
+        args=[2, b'loaded', b'resizing', 0, 's', b'resizing'],
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_legacy(redis_repo, mocker):
+    mocker.patch.object(MockRedisConn, 'evalsha', return_value=-1)
+    redis_repo.pool.strings['test'] = b'{"status": "loaded", "test": "1", "updated_file_path": null}'
+    assert await redis_repo.update("test", {"status": "resizing"}, status_from=('loaded',))
+    transaction, = redis_repo.pool.transactions
+    assert transaction.commands == [
+        ('delete', 'test'),
+        ('hmset_dict', 'test', {'v': b'2', 's': b'resizing', 'test': b'"1"'}),
+        ('expire', 'test', 30),
+    ]
 
 
 @pytest.mark.asyncio
-async def test_update(redis_repo):
-    assert await redis_repo.update("test", {"data": True}) == 1
+async def test_update_v1(redis_repo, mocker):
+    mocker.patch.object(MockRedisConn, 'evalsha', return_value=-1)
+    redis_repo.pool.hashes['test'] = {b'id': b'"test"', b'status': b'"loaded"', b'width': b'5'}
+    assert await redis_repo.update("test", {"status": "resizing"}, status_from=('loaded',))
+    transaction, = redis_repo.pool.transactions
+    assert transaction.commands[1] == ('hmset_dict', 'test', {'v': b'2', 'i': b'test', 's': b'resizing', 'w': b'5'})
+
+
+@pytest.mark.asyncio
+async def test_update_legacy_status_not_expected(redis_repo, mocker):
+    mocker.patch.object(MockRedisConn, 'evalsha', return_value=-1)
+    redis_repo.pool.strings['test'] = b'{"status": "done"}'
+    assert not await redis_repo.update("test", {"status": "resizing"}, status_from=('loaded',))
+    assert not redis_repo.pool.transactions
+
+
+@pytest.mark.asyncio
+async def test_update_script():
+    # script run by redis, lua from fakeredis
+    redis_repo = RedisRepository()
+    redis_repo.pool = await fakeredis.aioredis.create_redis_pool()
+    pool = redis_repo.pool
+    await redis_repo.insert("test", {"id": "test", "status": "loaded", "updated_file_path": "a.png"})
+    assert not await redis_repo.update("test", {"status": "done"}, status_from=('resizing',))
+    assert (await redis_repo.get("test"))['status'] == 'loaded'
+    assert await redis_repo.update("test", {"status": "done", "updated_file_path": None}, status_from=('loaded',))
+    assert await redis_repo.get("test") == {'id': 'test', 'status': 'done'}
+    assert await pool.evalsha(UPDATE_SCRIPT_SHA, keys=['missing'], args=[0, 0]) == 0
+    await pool.set('legacy', '{"status": "loaded"}')
+    await pool.hmset_dict('v1', {'status': '"loaded"'})
+    for key in ('legacy', 'v1'):
+        assert await pool.evalsha(UPDATE_SCRIPT_SHA, keys=[key], args=[0, 0, 's', 'done']) == -1
+    assert await pool.get('legacy') == b'{"status": "loaded"}'
+    assert await pool.hgetall('v1') == {b'status': b'"loaded"'}
+    pool.close()
+    await pool.wait_closed()
 
 
 @pytest.mark.asyncio
 async def test_get(redis_repo):
+    redis_repo.pool.hashes['test'] = {b'v': b'2', b'i': b'test', b's': b'done', b'w': b'10', b'files': b'["1"]'}
+    assert await redis_repo.get("test") == {'id': 'test', 'status': 'done', 'width': 10, 'files': ['1']}
+
+
+@pytest.mark.asyncio
+async def test_get_fields(redis_repo):
+    redis_repo.pool.hashes['test'] = {b'v': b'2', b'i': b'test', b's': b'done'}
+    assert await redis_repo.get("test", fields=('status', 'width')) == {'status': 'done'}
+
+
+@pytest.mark.asyncio
+async def test_get_newer_version(redis_repo):
+    redis_repo.pool.hashes['test'] = {b'v': b'3', b's': b'done'}
+    with pytest.raises(ValueError):
+        await redis_repo.get("test")
+
+
+@pytest.mark.asyncio
+async def test_get_not_found(redis_repo):
+    assert await redis_repo.get("test") is None
+    assert await redis_repo.get("test", fields=('status',)) is None
+
+
+@pytest.mark.asyncio
+async def test_get_v1(redis_repo):
+    redis_repo.pool.hashes['test'] = {b'id': b'"test"', b'status': b'"done"', b'outputs': b'[]'}
+    assert await redis_repo.get("test") == {'id': 'test', 'status': 'done', 'outputs': []}
+    assert await redis_repo.get("test", fields=('status', 'width')) == {'status': 'done'}
+
+
+@pytest.mark.asyncio
+async def test_get_legacy(redis_repo):
+    redis_repo.pool.strings['test'] = b'{"test":"1"}'
     assert await redis_repo.get("test") == {"test": "1"}
+    assert await redis_repo.get("test", fields=('test', 'status')) == {"test": "1"}
 
 
 @pytest.mark.asyncio
@@ -87,3 +298,28 @@ async def test_is_exist(redis_repo):
 @pytest.mark.asyncio
 async def test_delete(redis_repo):
     assert await redis_repo.delete("exist") == 1
+
+
+@pytest.mark.asyncio
+async def test_get_many(redis_repo):
+    redis_repo.pool.hashes['1'] = {b'v': b'2', b's': b'done'}
+    redis_repo.pool.hashes['v1'] = {b'status': b'"loaded"'}
+    redis_repo.pool.strings['3'] = b'{"status": "error", "test": "1"}'
+    result = await redis_repo.get_many(['1', b'2', '3', 'v1'], fields=('status',))
+    assert result == [{'status': 'done'}, None, {'status': 'error'}, {'status': 'loaded'}]
+    first, second = redis_repo.pool.pipelines
+    assert first == [('hmget', key, 's', 'v') for key in ('1', '2', '3', 'v1')]
+    # not found and version 1 read again by long names
+    assert second == [('hmget', '2', 'status'), ('hmget', 'v1', 'status')]
+
+
+@pytest.mark.asyncio
+async def test_get_many_all_fields(redis_repo):
+    redis_repo.pool.hashes['1'] = {b'v': b'2', b's': b'done'}
+    assert await redis_repo.get_many(['1', '2']) == [{'status': 'done'}, None]
+    assert redis_repo.pool.pipelines == [[('hgetall', '1'), ('hgetall', '2')]]
+
+
+@pytest.mark.asyncio
+async def test_get_many_empty(redis_repo):
+    assert await redis_repo.get_many([]) == []
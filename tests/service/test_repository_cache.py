@@ -0,0 +1,219 @@
+import aioredis
+import pytest
+
+from service import CachedRepository
+
+
+class MockPool:
+
+    def __init__(self, error=None):
+        self.published = []
+        self.error = error
+
+    async def publish(self, channel, message):
+        if self.error:
+            raise self.error
+        self.published.append((channel, message))
+        return 1
+
+
+class MockRepo:
+
+    def __init__(self):
+        self.data = {}
+        self.reads = 0
+        self.pool = MockPool()
+
+    async def get(self, key, fields=None):
+        self.reads += 1
+        data = self.data.get(key)
+        if data and fields:
+            return {name: data[name] for name in fields if name in data}
+        return data
+
+    async def insert(self, key, data, expire=None):
+        self.data[key] = dict(data)
+        return True
+
+    async def update(self, key, data, status_from=None):
+        if key not in self.data:
+            return False
+        self.data[key].update(data)
+        return True
+
+    async def delete(self, key):
+        return self.data.pop(key, None) is not None
+
+
+class MockChannel:
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    async def wait_message(self):
+        return bool(self.messages)
+
+    async def get(self):
+        return self.messages.pop(0)
+
+
+@pytest.fixture
+def repo():
+    repo = MockRepo()
+    repo.data['done'] = {'id': 'done', 'status': 'done', 'updated_file_path': 'a.jpg'}
+    repo.data['resizing'] = {'id': 'resizing', 'status': 'resizing'}
+    return repo
+
+
+@pytest.fixture
+def cached(repo):
+    cached = CachedRepository(repo, channel='changes', ttl=60, max_entries=2)
+    cached.subscription.subscribed = True
+    return cached
+
+
+@pytest.mark.asyncio
+async def test_get_finished_cached(cached, repo):
+    assert await cached.get('done') == repo.data['done']
+    assert await cached.get(b'done') == repo.data['done']
+    assert await cached.get('done', fields=('id', 'status')) == {'id': 'done', 'status': 'done'}
+    assert repo.reads == 1
+
+
+@pytest.mark.asyncio
+async def test_get_not_finished_not_cached(cached, repo):
+    await cached.get('resizing')
+    await cached.get('resizing')
+    await cached.get('missing')
+    assert repo.reads == 3
+
+
+@pytest.mark.asyncio
+async def test_get_copy(cached):
+    data = await cached.get('done')
+    data['status'] = 'changed'
+    assert (await cached.get('done'))['status'] == 'done'
+
+
+@pytest.mark.asyncio
+async def test_get_fields_then_full(cached, repo):
+    await cached.get('done', fields=('id', 'status'))
+    await cached.get('done', fields=('status',))
+    assert repo.reads == 1
+    assert await cached.get('done') == repo.data['done']
+    assert repo.reads == 2
+    await cached.get('done', fields=('updated_file_path', 'output'))
+    assert repo.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_get_expired(cached, repo):
+    cached.ttl = 0
+    await cached.get('done')
+    await cached.get('done')
+    assert repo.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_lru(cached, repo):
+    for key in ('first', 'second', 'third'):
+        repo.data[key] = {'status': 'error'}
+    await cached.get('first')
+    await cached.get('second')
+    await cached.get('first')
+    await cached.get('third')
+    assert list(cached._entries) == ['first', 'third']
+
+
+@pytest.mark.asyncio
+async def test_delete_published(cached, repo):
+    await cached.get('done')
+    assert await cached.delete('done')
+    assert await cached.get('done') is None
+    assert repo.pool.published == [('changes', 'done')]
+
+
+@pytest.mark.asyncio
+async def test_update_finished_published(cached, repo):
+    await cached.get('done')
+    await cached.update('done', {'status': 'done', 'updated_file_path': 'b.jpg'})
+    assert (await cached.get('done'))['updated_file_path'] == 'b.jpg'
+    assert repo.pool.published == [('changes', 'done')]
+
+
+@pytest.mark.asyncio
+async def test_update_not_finished_not_published(cached, repo):
+    await cached.update('resizing', {'status': 'resizing'}, status_from=('loaded',))
+    await cached.insert('new', {'id': 'new', 'status': 'loaded'})
+    assert repo.pool.published == []
+
+
+@pytest.mark.asyncio
+async def test_publish_error_not_raised(cached, repo):
+    repo.pool.error = aioredis.RedisError('down')
+    assert await cached.delete('done')
+
+
+@pytest.mark.asyncio
+async def test_listen_drops_key(cached):
+    await cached.get('done')
+    await cached.subscription.listen(MockChannel([b'done', b'other']))
+    assert not cached._entries
+
+
+@pytest.mark.asyncio
+async def test_subscription_lost(cached, repo):
+    await cached.get('done')
+    cached.subscription.subscribed = False
+    cached._on_lost()
+    assert not cached._entries
+    # invalidations can't be received, every read goes to repository
+    await cached.get('done')
+    await cached.get('done')
+    assert repo.reads == 3
+    cached.subscription.subscribed = True
+    await cached.get('done')
+    await cached.get('done')
+    assert repo.reads == 4
+
+
+@pytest.mark.asyncio
+async def test_subscription_lost_while_reading_not_cached(cached, repo):
+    get = repo.get
+
+    async def get_and_lose(key, fields=None):
+        data = await get(key, fields)
+        cached._on_lost()
+        return data
+
+    repo.get = get_and_lose
+    await cached.get('done')
+    assert not cached._entries
+
+
+@pytest.mark.asyncio
+async def test_changed_while_reading_not_cached(cached, repo):
+    get = repo.get
+
+    async def get_and_change(key, fields=None):
+        data = await get(key, fields)
+        cached._drop(key)
+        return data
+
+    repo.get = get_and_change
+    await cached.get('done')
+    assert not cached._entries
+
+
+@pytest.mark.asyncio
+async def test_get_many(cached, repo):
+    await cached.get('done')
+
+    async def get_many(keys, fields=None):
+        assert keys == ['resizing', 'missing']
+        return [await repo.get(key, fields) for key in keys]
+
+    repo.get_many = get_many
+    result = await cached.get_many(['done', b'resizing', 'missing'], fields=('status',))
+    assert result == [{'status': 'done'}, {'status': 'resizing'}, None]
+    assert list(cached._entries) == ['done']
@@ -0,0 +1,136 @@
+import itertools
+
+import pytest
+
+from config import CONFIG
+from service import ResultCache
+from tests.service.test_job_queue import MockTransaction
+
+
+class MockSortedSetPool:
+    # one sorted set, scores by call order: access time of same second can't be compared
+
+    def __init__(self):
+        self.members = {}
+        self.clock = itertools.count()
+
+    def multi_exec(self):
+        return MockTransaction(self)
+
+    async def zadd(self, key, score, member):
+        self.members[member] = next(self.clock)
+        return 1
+
+    async def zcard(self, key):
+        return len(self.members)
+
+    async def zrem(self, key, member):
+        return int(self.members.pop(member, None) is not None)
+
+    async def zpopmin(self, key, count):
+        popped = sorted(self.members, key=self.members.get)[:count]
+        result = []
+        for member in popped:
+            result += [member.encode(), self.members.pop(member)]
+        return result
+
+
+class MockRepo:
+
+    def __init__(self):
+        self.data = {}
+        self.expire = {}
+        self.pool = MockSortedSetPool()
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def insert(self, key, data, expire=None):
+        self.data[key] = data
+        self.expire[key] = expire
+        return 1
+
+    async def delete(self, key):
+        if isinstance(key, bytes):
+            key = key.decode()
+        return self.data.pop(key, None) is not None
+
+
+@pytest.fixture()
+def result_cache():
+    return ResultCache(MockRepo(), ttl=60, max_entries=2)
+
+
+def test_make_key():
+    assert ResultCache.make_key("abc", 10, None, 0) == "result_cache:abc:10:0:0"
+
+
+def test_make_key_output():
+    key = ResultCache.make_key("abc", 10, None, 0, {'quality': 80, 'format': 'webp'})
+    assert key == "result_cache:abc:10:0:0:format=webp,quality=80"
+    assert ResultCache.make_key("abc", 10, None, 0, {}) == ResultCache.make_key("abc", 10, None, 0, None)
+
+
+def test_make_result_key(monkeypatch):
+    key = ResultCache.make_result_key("abc", "a.png", 10, 0, 0)
+    assert key != ResultCache.make_result_key("abc", "a.jpg", 10, 0, 0)
+    assert key == ResultCache.make_result_key("abc", "b.png", 10, 0, 0, {'format': 'png'}, {'filter': 'auto'})
+    monkeypatch.setitem(CONFIG['resize'], 'filter', 'bicubic')
+    assert key != ResultCache.make_result_key("abc", "a.png", 10, 0, 0)
+    monkeypatch.setitem(CONFIG['resize'], 'filter', 'auto')
+    monkeypatch.setitem(CONFIG['resize'], 'draft', not CONFIG['resize']['draft'])
+    assert key != ResultCache.make_result_key("abc", "a.png", 10, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_get_miss(result_cache):
+    assert await result_cache.get("not_exist") is None
+
+
+@pytest.mark.asyncio
+async def test_set_get(result_cache):
+    await result_cache.set("key", "/test/resized_test.png")
+    assert await result_cache.get("key") == "/test/resized_test.png"
+    assert result_cache.repository.expire["key"] == 60
+
+
+@pytest.mark.asyncio
+async def test_set_evict_lru(result_cache):
+    await result_cache.set("key_1", "path_1")
+    await result_cache.set("key_2", "path_2")
+    # key_1 now most recently used
+    await result_cache.get("key_1")
+    await result_cache.set("key_3", "path_3")
+    assert await result_cache.get("key_2") is None
+    assert await result_cache.get("key_1") == "path_1"
+    assert await result_cache.get("key_3") == "path_3"
+    assert list(result_cache.pool.members) == ["key_1", "key_3"]
+
+
+@pytest.mark.asyncio
+async def test_lru_shared_by_nodes(result_cache):
+    # other node with same repository sees entries used here
+    other_node = ResultCache(result_cache.repository, ttl=60, max_entries=2)
+    await result_cache.set("key_1", "path_1")
+    await other_node.set("key_2", "path_2")
+    await result_cache.get("key_1")
+    await other_node.set("key_3", "path_3")
+    assert await result_cache.get("key_2") is None
+    assert sorted(result_cache.repository.data) == ["key_1", "key_3"]
+
+
+@pytest.mark.asyncio
+async def test_get_expired_removed_from_lru(result_cache):
+    await result_cache.set("key", "path")
+    # expired in repository
+    del result_cache.repository.data["key"]
+    assert await result_cache.get("key") is None
+    assert not result_cache.pool.members
+
+
+@pytest.mark.asyncio
+async def test_delete(result_cache):
+    await result_cache.set("key", "path")
+    await result_cache.delete("key")
+    assert await result_cache.get("key") is None
+    assert not result_cache.pool.members
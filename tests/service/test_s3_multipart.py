@@ -0,0 +1,87 @@
+import pytest
+
+from service.s3_multipart import MultipartWriter
+
+
+class MockS3Client:
+
+    def __init__(self, fail_part=None):
+        self.objects = {}
+        self.parts = {}
+        self.aborted = False
+        self.fail_part = fail_part
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload_id"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise ConnectionError("part error")
+        self.parts[PartNumber] = Body
+        return {"ETag": f"etag_{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        assert [part["ETag"] for part in MultipartUpload["Parts"]] == [f"etag_{n}" for n in numbers]
+        self.objects[Key] = b"".join(self.parts[number] for number in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+
+def make_writer(client, threshold=20, part_size=10):
+    return MultipartWriter(
+        client=client,
+        bucket="bucket",
+        key="key",
+        threshold=threshold,
+        part_size=part_size,
+        concurrency=2,
+    )
+
+
+def test_write_below_threshold():
+    client = MockS3Client()
+    writer = make_writer(client)
+    writer.write(b"a" * 15)
+    writer.close()
+    assert client.objects["key"] == b"a" * 15
+    assert not client.parts
+
+
+def test_write_multipart():
+    client = MockS3Client()
+    writer = make_writer(client)
+    data = bytes(range(100)) * 3
+    for i in range(0, len(data), 7):
+        writer.write(data[i:i + 7])
+    assert writer.tell() == len(data)
+    writer.close()
+    assert client.objects["key"] == data
+    assert len(client.parts) == 30
+    assert all(len(part) == 10 for part in client.parts.values())
+
+
+def test_write_multipart_part_error():
+    client = MockS3Client(fail_part=2)
+    writer = make_writer(client)
+    writer.write(b"a" * 25)
+    with pytest.raises(ConnectionError):
+        writer.close()
+    assert client.aborted
+    assert "key" not in client.objects
+
+
+def test_abort():
+    client = MockS3Client()
+    writer = make_writer(client)
+    writer.write(b"a" * 25)
+    writer.abort()
+    assert client.aborted
+    assert writer.closed
+    # closed writer is not completed
+    writer.close()
+    assert "key" not in client.objects
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from service import ResizeScheduler, LocalJobQueue
+from service.job_queue import QueueFullError
+
+
+@pytest.mark.asyncio
+async def test_put():
+    scheduler = ResizeScheduler(LocalJobQueue(max_size=2), max_in_flight=1)
+    await scheduler.put("test")
+    assert await scheduler.job_queue.depth() == 1
+    assert not await scheduler.is_full()
+
+
+@pytest.mark.asyncio
+async def test_put_exception_queue_full():
+    scheduler = ResizeScheduler(LocalJobQueue(max_size=1), max_in_flight=1)
+    await scheduler.put("test")
+    assert await scheduler.is_full()
+    with pytest.raises(QueueFullError) as exc:
+        await scheduler.put("test_2")
+    assert exc.value.args[0] == "Queue is full: 1 jobs waiting"
+
+
+@pytest.mark.asyncio
+async def test_listen_max_in_flight():
+    scheduler = ResizeScheduler(LocalJobQueue(max_size=10), max_in_flight=2)
+    release = asyncio.Event()
+    started = []
+
+    async def handler(file_id):
+        started.append(file_id)
+        await release.wait()
+
+    for file_id in ("1", "2", "3"):
+        await scheduler.put(file_id)
+    listener = asyncio.ensure_future(scheduler.listen(handler))
+    await asyncio.sleep(0.01)
+    assert started == ["1", "2"]
+    assert scheduler.in_flight == 2
+    assert await scheduler.job_queue.depth() == 1
+    release.set()
+    await asyncio.sleep(0.01)
+    assert started == ["1", "2", "3"]
+    assert scheduler.in_flight == 0
+    listener.cancel()
+
+
+@pytest.mark.asyncio
+async def test_listen_handler_exception():
+    scheduler = ResizeScheduler(LocalJobQueue(max_size=10), max_in_flight=1)
+
+    async def handler(file_id):
+        raise ValueError(file_id)
+
+    await scheduler.put("1")
+    await scheduler.put("2")
+    listener = asyncio.ensure_future(scheduler.listen(handler))
+    await asyncio.sleep(0.01)
+    assert scheduler.processed == 2
+    assert scheduler.in_flight == 0
+    listener.cancel()
+
+
+@pytest.mark.asyncio
+async def test_listen_ack_and_fail(mocker):
+    job_queue = LocalJobQueue(max_size=10)
+    ack = mocker.patch.object(job_queue, "ack")
+    fail = mocker.patch.object(job_queue, "fail")
+    scheduler = ResizeScheduler(job_queue, max_in_flight=1)
+
+    async def handler(file_id):
+        if file_id == "bad":
+            raise ValueError(file_id)
+
+    await scheduler.put("good")
+    await scheduler.put("bad")
+    listener = asyncio.ensure_future(scheduler.listen(handler))
+    await asyncio.sleep(0.01)
+    assert ack.call_args[0][0].job_id == "good"
+    assert fail.call_args[0][0].job_id == "bad"
+    listener.cancel()
+
+
+@pytest.mark.asyncio
+async def test_stats():
+    scheduler = ResizeScheduler(LocalJobQueue(max_size=5), max_in_flight=3)
+    await scheduler.put("1")
+    stats = await scheduler.stats()
+    assert stats['depth'] == 1
+    assert stats['max_size'] == 5
+    assert stats['in_flight'] == 0
+    assert stats['max_in_flight'] == 3
+    assert stats['wait_time_avg'] == 0.0
@@ -0,0 +1,87 @@
+import asyncio
+from multiprocessing.shared_memory import SharedMemory
+
+import pytest
+
+from service.shared_memory import SharedBufferPool, attach
+
+
+@pytest.fixture()
+def buffers():
+    # opened in test, needs event loop
+    buffers = SharedBufferPool(2, 1024)
+    yield buffers
+    buffers.close()
+
+
+@pytest.mark.asyncio
+async def test_acquire_release(buffers):
+    await buffers.open()
+    first = await buffers.acquire()
+    second = await buffers.acquire()
+    assert first.name != second.name
+    assert first.size >= 1024
+    assert buffers.free_count() == 0
+    buffers.release(first)
+    # second release is no-op
+    buffers.release(first)
+    assert buffers.free_count() == 1
+    assert await buffers.acquire() is first
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits(buffers):
+    await buffers.open()
+    segments = [await buffers.acquire(), await buffers.acquire()]
+    waiter = asyncio.ensure_future(buffers.acquire())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    buffers.release(segments[0])
+    assert await waiter is segments[0]
+
+
+@pytest.mark.asyncio
+async def test_hold(buffers):
+    await buffers.open()
+    segment = await buffers.acquire()
+    future = asyncio.get_event_loop().create_future()
+    buffers.hold(segment, future)
+    buffers.release(segment)
+    assert buffers.free_count() == 1
+    future.set_result(None)
+    await asyncio.sleep(0)
+    assert buffers.free_count() == 2
+
+
+@pytest.mark.asyncio
+async def test_attach(buffers):
+    await buffers.open()
+    segment = await buffers.acquire()
+    # thread worker in same process uses segment of pool
+    assert attach(segment.name) is segment
+
+
+def test_attach_not_tracked(mocker):
+    segment = SharedMemory(create=True, size=1024)
+    try:
+        segment.buf[:4] = b'test'
+        register = mocker.patch('multiprocessing.resource_tracker.register')
+        attached = attach(segment.name)
+        assert bytes(attached.buf[:4]) == b'test'
+        assert attach(segment.name) is attached
+        assert not register.called
+        attached.close()
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+@pytest.mark.asyncio
+async def test_close():
+    buffers = SharedBufferPool(1, 1024)
+    await buffers.open()
+    segment = await buffers.acquire()
+    name = segment.name
+    buffers.close()
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=name)
@@ -0,0 +1,104 @@
+import asyncio
+
+import aioredis
+import pytest
+
+from service.subscription import Subscription
+
+
+class MockChannel:
+
+    def __init__(self, messages, error=None):
+        self.messages = list(messages)
+        self.error = error
+
+    async def wait_message(self):
+        if not self.messages and self.error:
+            raise self.error
+        return bool(self.messages)
+
+    async def get(self):
+        return self.messages.pop(0)
+
+
+class MockSubscriber:
+
+    def __init__(self, channels):
+        self.channels = list(channels)
+        self.closed = False
+
+    async def subscribe(self, name):
+        if not self.channels:
+            # subscription never restored
+            await asyncio.get_event_loop().create_future()
+        return [self.channels.pop(0)]
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    sleep = asyncio.sleep
+    delays = []
+
+    async def no_sleep(delay):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', no_sleep)
+    return delays
+
+
+@pytest.fixture
+def events():
+    return []
+
+
+@pytest.fixture
+def subscription(events):
+    return Subscription('changes', events.append, lambda: events.append('lost'))
+
+
+@pytest.mark.asyncio
+async def test_subscribe_backoff(subscription, delays, mocker):
+    channel = MockChannel([])
+    mocker.patch.object(aioredis, 'create_redis', side_effect=[
+        OSError('refused'), OSError('refused'), OSError('refused'), MockSubscriber([channel]),
+    ])
+    assert await subscription._subscribe() is channel
+    assert subscription.subscribed
+    assert delays == [1, 2, 4]
+
+
+@pytest.mark.asyncio
+async def test_resubscribe(subscription, events, mocker):
+    # first connection closed with channel, second one loses only channel
+    subscription.subscriber = MockSubscriber([])
+    subscription.subscriber.closed = True
+    subscriber = MockSubscriber([
+        MockChannel([b'second'], error=aioredis.ChannelClosedError()),
+        MockChannel([b'third']),
+    ])
+    create_redis = mocker.patch.object(aioredis, 'create_redis', return_value=subscriber)
+    subscription.subscribed = True
+    listener = asyncio.get_event_loop().create_task(subscription._keep_listening(MockChannel([b'first'])))
+    while len(events) < 6:
+        await asyncio.sleep(0)
+    listener.cancel()
+    assert events == [b'first', 'lost', b'second', 'lost', b'third', 'lost']
+    assert create_redis.call_count == 1
+    assert not subscription.subscribed
+
+
+@pytest.mark.asyncio
+async def test_disconnect(subscription):
+    subscriber = MockSubscriber([MockChannel([])])
+    subscription.subscriber = subscriber
+    subscription.subscribed = True
+    await subscription.disconnect()
+    assert subscriber.closed
+    assert not subscription.subscribed
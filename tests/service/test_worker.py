@@ -0,0 +1,126 @@
+import asyncio
+import io
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import pytest
+from PIL import Image
+
+from service import ImageResizer
+from service.metrics import STAGE_SECONDS, ERRORS, POOL_TASKS
+from service.executor import HybridExecutor
+from service.shared_memory import SharedBufferPool
+from service.worker import init_worker, get_resizer, run_job, run_in_pool, preload_formats, run_shared_job, \
+    run_shared_in_pool
+from tests.service.conftest import TEST_FILE_NAME, IMAGE_BYTES
+
+
+@pytest.fixture()
+def pool(local_storage):
+    pool = ThreadPoolExecutor(max_workers=1, initializer=init_worker, initargs=(local_storage, ['PNG']))
+    yield pool
+    pool.shutdown()
+
+
+def test_get_resizer_not_initialized():
+    # new thread has no worker state
+    errors = []
+
+    def get():
+        try:
+            get_resizer()
+        except RuntimeError as e:
+            errors.append(e)
+    thread = threading.Thread(target=get)
+    thread.start()
+    thread.join()
+    assert errors
+
+
+def test_init_worker(local_storage, mocker):
+    init_storage = mocker.patch.object(local_storage, 'init_worker')
+    init_worker(local_storage, ['PNG'])
+    resizer = get_resizer()
+    assert isinstance(resizer, ImageResizer)
+    assert resizer.file_storage is local_storage
+    assert init_storage.called
+    # same resizer for next jobs
+    assert get_resizer() is resizer
+
+
+def test_preload_formats_unknown(caplog):
+    preload_formats(['PNG', 'NOT_FORMAT'])
+    assert 'Can not preload NOT_FORMAT' in caplog.text
+
+
+def test_run_job(local_storage):
+    init_worker(local_storage)
+    (result, error), timings, error_types = run_job(0.0, 'resize_bytes', IMAGE_BYTES, TEST_FILE_NAME, 10, 0, 0)
+    assert error is None
+    assert result
+    assert {'decode', 'resize', 'encode', 'pool_wait'} <= set(timings)
+    assert error_types == []
+
+
+@pytest.mark.asyncio
+async def test_run_in_pool(pool):
+    resize_before = STAGE_SECONDS.get('resize')[0]
+    errors_before = ERRORS.get('UnidentifiedImageError')
+    result, error = await run_in_pool(pool, 'resize_bytes', IMAGE_BYTES, TEST_FILE_NAME, 10, 0, 0)
+    assert error is None
+    result, error = await run_in_pool(pool, 'resize_bytes', b'not image', TEST_FILE_NAME, 10, 0, 0)
+    assert error
+    assert STAGE_SECONDS.get('resize')[0] == resize_before + 1
+    assert ERRORS.get('UnidentifiedImageError') == errors_before + 1
+    assert POOL_TASKS.get() == 0
+
+
+@pytest.mark.asyncio
+async def test_run_shared_in_pool(pool):
+    buffers = SharedBufferPool(1, 2 * len(IMAGE_BYTES))
+    await buffers.open()
+    try:
+        segment = await buffers.acquire()
+        segment.buf[:len(IMAGE_BYTES)] = IMAGE_BYTES
+        result, error = await run_shared_in_pool(pool, buffers, segment, len(IMAGE_BYTES), TEST_FILE_NAME, 10, 0, 0)
+        assert error is None
+        assert Image.open(io.BytesIO(result)).size == (10, 10)
+        # released after job
+        await asyncio.sleep(0)
+        assert buffers.free_count() == 1
+    finally:
+        buffers.close()
+
+
+def test_run_shared_job_result_not_fit(local_storage):
+    init_worker(local_storage)
+    segment = SharedMemory(create=True, size=len(IMAGE_BYTES))
+    try:
+        segment.buf[:len(IMAGE_BYTES)] = IMAGE_BYTES
+        (result, error), timings, error_types = run_shared_job(
+            0.0, segment.name, len(IMAGE_BYTES), TEST_FILE_NAME, 10, 0, 0,
+        )
+        assert error is None
+        assert isinstance(result, bytes)
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+@pytest.mark.asyncio
+async def test_run_in_pool_hybrid(pool, local_storage, mocker):
+    # second thread pool stands for process pool
+    process_pool = ThreadPoolExecutor(max_workers=1, initializer=init_worker, initargs=(local_storage,))
+    hybrid = HybridExecutor(process_pool, pool, threshold=len(IMAGE_BYTES))
+    thread_submit = mocker.spy(pool, 'submit')
+    process_submit = mocker.spy(process_pool, 'submit')
+    args = ('resize_bytes', IMAGE_BYTES, TEST_FILE_NAME, 10, 0, 0)
+    result, error = await run_in_pool(hybrid, *args, size=len(IMAGE_BYTES))
+    assert error is None
+    assert thread_submit.call_count == 1
+    await run_in_pool(hybrid, *args, size=len(IMAGE_BYTES) + 1)
+    await run_in_pool(hybrid, *args)
+    assert thread_submit.call_count == 1
+    assert process_submit.call_count == 2
+    process_pool.shutdown()
@@ -0,0 +1,143 @@
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import pytest
+from aiohttp import web
+
+from main import resize_task, mark_failed
+from service import LocalFileStorage, ResultCache, ImageResizer
+from service.metrics import ERRORS
+from service.worker import init_worker
+from tests.service.conftest import IMAGE_BYTES
+from tests.service.test_result_cache import MockSortedSetPool
+from tests.views.test_views import MemoryRepo
+
+
+class MockNotifier:
+
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, file_id, status):
+        self.published.append((file_id, status))
+
+
+@pytest.fixture()
+def app(tmpdir):
+    files_storage = LocalFileStorage(images_path=str(tmpdir))
+    app = web.Application()
+    app.files_storage = files_storage
+    app.repository = MemoryRepo()
+    app.repository.pool = MockSortedSetPool()
+    app.notifier = MockNotifier()
+    app.result_cache = None
+    app.process_pool = ThreadPoolExecutor(max_workers=1, initializer=init_worker, initargs=(files_storage,))
+    yield app
+    app.process_pool.shutdown()
+
+
+def get_job(file_id, file_name, **fields):
+    return dict({
+        'id': file_id,
+        'status': 'loaded',
+        'default_image_path': file_name,
+        'file_name': file_name,
+        'width': 10,
+        'height': 0,
+        'scale': 0,
+    }, **fields)
+
+
+@pytest.mark.asyncio
+async def test_resize_task_not_image(app, tmpdir):
+    tmpdir.join('broken.png').write_binary(b'not image')
+    await app.repository.insert('job', get_job('job', 'broken.png'))
+    await resize_task(app, 'job')
+    assert app.repository.data['job']['status'] == 'error'
+    assert app.notifier.published == [('job', 'resizing'), ('job', 'error')]
+    assert not tmpdir.join('broken.png').exists()
+
+
+@pytest.mark.asyncio
+async def test_resize_task(app, tmpdir):
+    tmpdir.join('test.png').write_binary(IMAGE_BYTES)
+    await app.repository.insert('job', get_job('job', 'test.png'))
+    await resize_task(app, 'job')
+    job = app.repository.data['job']
+    assert job['status'] == 'done'
+    assert job['updated_file_path'] == str(tmpdir.join('resized_test.png'))
+    assert not tmpdir.join('test.png').exists()
+
+
+@pytest.mark.asyncio
+async def test_resize_task_cache_hit(app, tmpdir, mocker):
+    app.result_cache = ResultCache(app.repository, ttl=60, max_entries=10)
+    cache_key = app.result_cache.make_result_key('hash', 'test.png', 10, 0, 0)
+    await app.result_cache.set(cache_key, 'cached.png')
+    tmpdir.join('test.png').write_binary(IMAGE_BYTES)
+    await app.repository.insert('job', get_job('job', 'test.png', source_hash='hash'))
+    resize_img = mocker.spy(ImageResizer, 'resize_img')
+    await resize_task(app, 'job')
+    job = app.repository.data['job']
+    assert (job['status'], job['updated_file_path']) == ('done', 'cached.png')
+    assert app.notifier.published == [('job', 'done')]
+    assert not resize_img.called
+    assert not tmpdir.join('test.png').exists()
+
+
+@pytest.mark.asyncio
+async def test_resize_task_finished_skipped(app, tmpdir, mocker):
+    # job redelivered after other worker finished it
+    tmpdir.join('test.png').write_binary(IMAGE_BYTES)
+    await app.repository.insert('job', get_job('job', 'test.png', status='done', updated_file_path='done.png'))
+    resize_img = mocker.spy(ImageResizer, 'resize_img')
+    await resize_task(app, 'job')
+    assert app.repository.data['job']['updated_file_path'] == 'done.png'
+    assert app.notifier.published == []
+    assert not resize_img.called
+
+
+@pytest.mark.asyncio
+async def test_resize_batch_task_partial(app, tmpdir, mocker):
+    resize_from = ImageResizer._resize_from
+
+    def resize_or_fail(resizer, image, new_size):
+        if new_size == (5, 5):
+            raise ValueError('broken')
+        return resize_from(resizer, image, new_size)
+
+    mocker.patch.object(ImageResizer, '_resize_from', resize_or_fail)
+    tmpdir.join('test.png').write_binary(IMAGE_BYTES)
+    outputs = [
+        {'width': 10, 'height': 0, 'scale': 0, 'status': 'loaded', 'updated_file_path': None},
+        {'width': 5, 'height': 0, 'scale': 0, 'status': 'loaded', 'updated_file_path': None},
+    ]
+    await app.repository.insert('batch-0', get_job('batch-0', 'test.png', batch_id='batch', outputs=outputs))
+    await resize_task(app, 'batch-0')
+    job = app.repository.data['batch-0']
+    assert job['status'] == 'done'
+    assert [(output['status'], output['updated_file_path']) for output in job['outputs']] == [
+        ('done', str(tmpdir.join('resized_0_test.png'))),
+        ('error', None),
+    ]
+    assert app.notifier.published == [('batch-0', 'resizing'), ('batch-0', 'done')]
+
+
+@pytest.mark.asyncio
+async def test_mark_failed(app):
+    outputs = [{'width': 10, 'height': 0, 'scale': 0, 'status': 'resizing', 'updated_file_path': None}]
+    await app.repository.insert('job', get_job('job', 'test.png', status='resizing', outputs=outputs))
+    dead_letters = ERRORS.get('dead_letter')
+    await mark_failed(app, 'job')
+    job = app.repository.data['job']
+    assert job['status'] == 'error'
+    assert job['outputs'][0]['status'] == 'error'
+    assert app.notifier.published == [('job', 'error')]
+    assert ERRORS.get('dead_letter') == dead_letters + 1
+
+
+@pytest.mark.asyncio
+async def test_mark_failed_finished_not_changed(app):
+    await app.repository.insert('job', get_job('job', 'test.png', status='done', updated_file_path='done.png'))
+    await mark_failed(app, 'job')
+    assert app.repository.data['job']['status'] == 'done'
+    assert app.notifier.published == []
@@ -1,23 +1,34 @@
 import asyncio
+import io
+import json
 import os
 import uuid
+from functools import partial
+from concurrent.futures.thread import ThreadPoolExecutor
 
 import funcy
 import pytest
-from aiofile import AIOFile, LineReader
-from aiohttp import web
+from PIL import Image
+from aiohttp import web, FormData
 from aiohttp.web_request import Request
 from aiohttp_apispec import setup_aiohttp_apispec, validation_middleware
 
 from config import CONFIG
+from service import ResizeScheduler, LocalJobQueue, StatusNotifier, ResultCache, ImageResizer
 from service.file_storage import ImageNotFoundError, PathNotFoundError
 from tests.service.conftest import TEST_FILE_NAME, IMAGE_BYTES
-from views import load_image, get_image, check_status
+from tests.service.test_result_cache import MockSortedSetPool
+from service.metrics import STAGE_SECONDS, JOBS
+from service.shared_memory import SharedBufferPool
+from service.worker import init_worker
+from views import load_image, get_image, check_status, check_queue, status_events, load_batch, check_batch, \
+    get_batch_image, get_metrics, check_statuses
 
 
 class MockMultipartReader:
 
-    def __init__(self):
+    def __init__(self, file_name=TEST_FILE_NAME):
+        self.file_name = file_name
         self.image_b = list(funcy.chunks(10000, IMAGE_BYTES))
 
     async def read_chunk(self):
@@ -28,24 +39,39 @@ class MockMultipartReader:
         return chunk
 
     async def next(self):
+        file_name = self.file_name
+
         class Field:
             def __init__(self):
-                self.filename = TEST_FILE_NAME
+                self.filename = file_name
 
             async def read(self):
-                return TEST_FILE_NAME.encode(encoding='UTF-8')
+                return file_name.encode(encoding='UTF-8')
         return Field()
 
 
+class MockSyncMultipartReader(MockMultipartReader):
+    # file field readable by chunks, for upload read in request
+
+    async def next(self):
+        field = await super().next()
+        field.read_chunk = self.read_chunk
+        return field
+
+
 class MockFilesStorage:
 
     async def save_default(self, *args, **kwargs):
         pass
 
-    async def write_result(self, file_path, response):
-        async with AIOFile(file_path, 'rb') as f:
-            async for line in LineReader(f):
-                await response.write(line)
+    def delete_default(self, *args, **kwargs):
+        pass
+
+    def init_worker(self):
+        pass
+
+    async def write_result(self, file_path, adapter):
+        await adapter.send_file(file_path)
 
     async def delete_result(self, file_path):
         raise ImageNotFoundError(f"Not found {file_path}")
@@ -56,7 +82,7 @@ class MockRepo:
     async def insert(self, *args, **kwargs):
         pass
 
-    async def get(self, image_id):
+    async def get(self, image_id, fields=None):
         return {
             'id': image_id,
             'status': "done"
@@ -66,6 +92,58 @@ class MockRepo:
         pass
 
 
+class MemoryRepo:
+
+    def __init__(self):
+        self.data = {}
+
+    async def insert(self, key, data, expire=None):
+        self.data[key] = json.loads(json.dumps(data))
+
+    async def update(self, key, data, status_from=None):
+        if key not in self.data or (status_from and self.data[key].get('status') not in status_from):
+            return False
+        self.data[key].update(json.loads(json.dumps(data)))
+        return True
+
+    async def get(self, key, fields=None):
+        data = self.data.get(key)
+        if data and fields:
+            return {name: data[name] for name in fields if name in data} or None
+        return data
+
+    async def get_many(self, keys, fields=None):
+        return [await self.get(key, fields) for key in keys]
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+
+class ReadingFilesStorage(MockFilesStorage):
+
+    def __init__(self):
+        self.saved = {}
+
+    async def save_default(self, filename, adapter):
+        body = b''
+        async for chunk in adapter.read():
+            body += chunk
+        self.saved[filename] = body
+
+
+def get_pool():
+    return ThreadPoolExecutor(max_workers=1, initializer=init_worker, initargs=(MockFilesStorage(),))
+
+
+def get_batch_form(*files):
+    form = FormData()
+    for sizes, name, body in files:
+        if sizes:
+            form.add_field('sizes', sizes)
+        form.add_field('file', body, filename=name, content_type='image/png')
+    return form
+
+
 @pytest.fixture()
 async def aio_client(test_client):
     app = web.Application()
@@ -73,11 +151,22 @@ async def aio_client(test_client):
     app.files_storage = MockFilesStorage()
     app.repository = MockRepo()
     app.middlewares.append(validation_middleware)
-    app.input_images_queue = asyncio.Queue()
+    app.scheduler = ResizeScheduler(LocalJobQueue(max_size=1), max_in_flight=1)
+    app.notifier = StatusNotifier(pool=None, channel='test')
+    app.process_pool = None
+    app.shared_buffers = None
+    app.result_cache = None
     app.add_routes([
         web.post('/api/v1/image', load_image),
         web.get('/api/v1/image/{image_id}', get_image),
         web.get('/api/v1/image/{image_id}/check', check_status),
+        web.post('/api/v1/images/status', check_statuses),
+        web.get('/api/v1/image/{image_id}/events', status_events),
+        web.get('/api/v1/queue', check_queue),
+        web.get('/metrics', get_metrics),
+        web.post('/api/v1/batch', load_batch),
+        web.get('/api/v1/batch/{batch_id}', check_batch),
+        web.get('/api/v1/batch/{batch_id}/{file_index}/{output_index}', get_batch_image),
     ])
     client = await test_client(app)
     return client
@@ -95,6 +184,192 @@ async def test_load_image(aio_client, mocker):
     assert resp_data == {'id': default_uuid[:13], 'status': 'loaded'}
 
 
+async def test_load_image_queue_full(aio_client, mocker):
+    url = "/api/v1/image"
+    params = {'scale': 2}
+    mocker.patch.object(Request, "multipart", side_effect=MockMultipartReader)
+    mocker.patch.object(MockRepo, "delete")
+    mocker.patch.object(MockFilesStorage, "delete_default")
+    first_resp = await aio_client.post(url, params=params)
+    resp = await aio_client.post(url, params=params)
+    assert first_resp.status == 202
+    assert resp.status == 503
+    assert resp.headers['Retry-After'] == str(CONFIG['queue']['retry_after'])
+
+
+async def test_load_image_queue_filled_while_upload(aio_client, mocker):
+    url = "/api/v1/image"
+    params = {'scale': 2}
+    mocker.patch.object(Request, "multipart", side_effect=MockMultipartReader)
+    mocker.patch.object(ResizeScheduler, "is_full", return_value=False)
+    delete_repo = mocker.patch.object(MockRepo, "delete")
+    delete_file = mocker.patch.object(MockFilesStorage, "delete_default")
+    await aio_client.post(url, params=params)
+    resp = await aio_client.post(url, params=params)
+    assert resp.status == 503
+    assert delete_repo.called
+    assert delete_file.called
+
+
+async def test_load_image_sync(aio_client, mocker):
+    url = "/api/v1/image"
+    aio_client.server.app.process_pool = get_pool()
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    save_default = mocker.patch.object(MockFilesStorage, "save_default")
+    insert = mocker.patch.object(MockRepo, "insert")
+    resp = await aio_client.post(url, params={'scale': 2, 'sync': 1})
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == 'image/png'
+    image = Image.open(io.BytesIO(await resp.read()))
+    assert image.size == (27, 27)
+    assert not save_default.called
+    assert not insert.called
+    assert await aio_client.server.app.scheduler.job_queue.depth() == 0
+
+
+async def test_load_image_sync_shared_memory(aio_client, mocker):
+    app = aio_client.server.app
+    app.process_pool = get_pool()
+    app.shared_buffers = SharedBufferPool(1, 2 * len(IMAGE_BYTES))
+    await app.shared_buffers.open()
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    try:
+        resp = await aio_client.post("/api/v1/image", params={'scale': 2, 'sync': 1})
+        assert resp.status == 200
+        assert Image.open(io.BytesIO(await resp.read())).size == (27, 27)
+        assert app.shared_buffers.free_count() == 1
+    finally:
+        app.shared_buffers.close()
+
+
+async def test_load_image_sync_shared_memory_too_large(aio_client, mocker):
+    app = aio_client.server.app
+    app.process_pool = get_pool()
+    app.shared_buffers = SharedBufferPool(1, 100)
+    await app.shared_buffers.open()
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    try:
+        resp = await aio_client.post("/api/v1/image", params={'scale': 2, 'sync': 1})
+        assert resp.status == 413
+        assert app.shared_buffers.free_count() == 1
+    finally:
+        app.shared_buffers.close()
+
+
+async def test_load_image_sync_auto_size(aio_client, mocker, monkeypatch):
+    url = "/api/v1/image"
+    aio_client.server.app.process_pool = get_pool()
+    monkeypatch.setitem(CONFIG['sync'], 'auto_size', 1024 * 1024)
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    resp = await aio_client.post(url, params={'width': 10}, data=IMAGE_BYTES)
+    assert resp.status == 200
+    assert Image.open(io.BytesIO(await resp.read())).size == (10, 10)
+
+
+async def test_load_image_sync_too_large(aio_client, mocker, monkeypatch):
+    url = "/api/v1/image"
+    aio_client.server.app.process_pool = get_pool()
+    monkeypatch.setitem(CONFIG['sync'], 'max_size', 100)
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    resp = await aio_client.post(url, params={'scale': 2, 'sync': 1})
+    assert resp.status == 413
+
+
+async def test_load_image_sync_cache(aio_client, mocker):
+    url = "/api/v1/image"
+    app = aio_client.server.app
+    app.process_pool = get_pool()
+    app.result_cache = ResultCache(MockRepo(), ttl=10, max_entries=10)
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    mocker.patch.object(ResultCache, "get", return_value=None)
+    cache_set = mocker.patch.object(ResultCache, "set")
+    save_result = mocker.patch.object(MockFilesStorage, "save_result", create=True, return_value='resized_path')
+    resp = await aio_client.post(url, params={'scale': 2, 'sync': 1, 'cache': 1})
+    assert resp.status == 200
+    assert save_result.called
+    assert cache_set.call_args[0][1] == 'resized_path'
+
+
+async def test_load_image_sync_cache_hit(aio_client, image_in_dir, mocker):
+    url = "/api/v1/image"
+    app = aio_client.server.app
+    app.process_pool = get_pool()
+    app.result_cache = ResultCache(MockRepo(), ttl=10, max_entries=10)
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    mocker.patch.object(ResultCache, "get", return_value=os.path.join(image_in_dir, TEST_FILE_NAME))
+    resize = mocker.patch.object(ImageResizer, "resize_bytes")
+    resp = await aio_client.post(url, params={'scale': 2, 'sync': 1, 'cache': 1})
+    assert resp.status == 200
+    assert await resp.read() == IMAGE_BYTES
+    assert not resize.called
+
+
+async def test_load_image_sync_cache_by_format(aio_client, tmp_path, mocker):
+    # same bytes as png and jpg are different results
+    url = "/api/v1/image"
+    app = aio_client.server.app
+    app.process_pool = get_pool()
+    repository = MemoryRepo()
+    repository.pool = MockSortedSetPool()
+    app.result_cache = ResultCache(repository, ttl=10, max_entries=10)
+
+    def save_result(image, image_name):
+        path = tmp_path / image_name
+        path.write_bytes(image)
+        return str(path)
+    mocker.patch.object(MockFilesStorage, "save_result", create=True, side_effect=save_result)
+    results = []
+    for name in ('test.png', 'test.jpg', 'test.png'):
+        mocker.patch.object(Request, "multipart", side_effect=partial(MockSyncMultipartReader, name))
+        resp = await aio_client.post(url, params={'scale': 2, 'sync': 1, 'cache': 1})
+        assert resp.status == 200
+        results.append(Image.open(io.BytesIO(await resp.read())).format)
+    assert results == ['PNG', 'JPEG', 'PNG']
+    assert len(app.result_cache.repository.data) == 2
+
+
+async def test_load_image_sync_not_available(aio_client, mocker):
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    resp = await aio_client.post("/api/v1/image", params={'scale': 2, 'sync': 1})
+    assert resp.status == 400
+
+
+async def test_check_queue(aio_client, mocker):
+    mocker.patch.object(Request, "multipart", side_effect=MockMultipartReader)
+    await aio_client.post("/api/v1/image", params={'scale': 2})
+    resp = await aio_client.get("/api/v1/queue")
+    resp_data = await resp.json()
+    assert resp.status == 200
+    assert resp_data['depth'] == 1
+    assert resp_data['max_size'] == 1
+    assert resp_data['in_flight'] == 0
+
+
+async def test_get_metrics(aio_client, mocker):
+    mocker.patch.object(Request, "multipart", side_effect=MockMultipartReader)
+    await aio_client.post("/api/v1/image", params={'scale': 2})
+    resp = await aio_client.get("/metrics")
+    text = await resp.text()
+    assert resp.status == 200
+    assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert 'resize_queue_depth 1.0' in text
+    assert 'resize_jobs_in_flight 0' in text
+    assert 'resize_pool_utilization 0.0' in text
+    assert 'resize_stage_seconds_count{stage="upload"}' in text
+
+
+async def test_load_image_sync_metrics(aio_client, mocker):
+    aio_client.server.app.process_pool = get_pool()
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    done_before = JOBS.get('done')
+    resize_before = STAGE_SECONDS.get('resize')[0]
+    resp = await aio_client.post("/api/v1/image", params={'scale': 2, 'sync': 1})
+    assert resp.status == 200
+    assert JOBS.get('done') == done_before + 1
+    assert STAGE_SECONDS.get('resize')[0] == resize_before + 1
+    assert STAGE_SECONDS.get('pool_wait')[0] >= 1
+
+
 async def test_load_empty(aio_client, mocker):
     default_uuid = '01ec3385-47fa-4df8-b10f-86b6cfe6ecc5'
     url = "/api/v1/image"
@@ -151,6 +426,141 @@ async def test_check_status_not_found_id(aio_client, mocker):
     assert resp.status == 404
 
 
+async def test_check_status_wait_notified(aio_client, mocker):
+    image_id = "01ec3385-47"
+    url = f"/api/v1/image/{image_id}/check"
+    mocker.patch.object(MockRepo, "get", return_value={'id': image_id, 'status': "resizing"})
+    notifier = aio_client.server.app.notifier
+
+    async def notify():
+        while image_id not in notifier._waiters:
+            await asyncio.sleep(0.01)
+        notifier._dispatch({'id': image_id, 'status': "done"})
+
+    asyncio.ensure_future(notify())
+    resp = await aio_client.get(url, params={'wait': 5})
+    assert resp.status == 200
+    assert await resp.json() == {'id': image_id, 'status': "done"}
+    assert not notifier._waiters
+
+
+async def test_check_status_wait_timeout(aio_client, mocker):
+    image_id = "01ec3385-47"
+    url = f"/api/v1/image/{image_id}/check"
+    mocker.patch.object(MockRepo, "get", return_value={'id': image_id, 'status': "resizing"})
+    resp = await aio_client.get(url, params={'wait': 0.05})
+    assert resp.status == 200
+    assert await resp.json() == {'id': image_id, 'status': "resizing"}
+
+
+async def test_check_status_wait_subscription_lost(aio_client):
+    image_id = "01ec3385-47"
+    url = f"/api/v1/image/{image_id}/check"
+    app = aio_client.server.app
+    app.repository = MemoryRepo()
+    await app.repository.insert(image_id, {'id': image_id, 'status': "resizing"})
+
+    async def lose_subscription():
+        while image_id not in app.notifier._waiters:
+            await asyncio.sleep(0.01)
+        # done published while subscription was lost
+        await app.repository.update(image_id, {'status': "done"})
+        app.notifier._on_lost()
+
+    asyncio.ensure_future(lose_subscription())
+    resp = await aio_client.get(url, params={'wait': 5})
+    assert await resp.json() == {'id': image_id, 'status': "done"}
+
+
+async def test_check_status_wait_error_param(aio_client):
+    url = "/api/v1/image/01ec3385-47/check"
+    resp = await aio_client.get(url, params={'wait': 'long'})
+    assert resp.status == 400
+
+
+async def test_check_statuses(aio_client):
+    app = aio_client.server.app
+    app.repository = MemoryRepo()
+    await app.repository.insert('1', {'id': '1', 'status': 'done'})
+    await app.repository.insert('2', {'id': '2', 'status': 'resizing'})
+    resp = await aio_client.post("/api/v1/images/status", json={'ids': ['1', '2', '3', '1']})
+    assert resp.status == 200
+    assert await resp.json() == {'images': [
+        {'id': '1', 'status': 'done'},
+        {'id': '2', 'status': 'resizing'},
+        {'id': '3', 'status': 'not_found'},
+    ]}
+
+
+async def test_check_statuses_validation(aio_client):
+    resp = await aio_client.post("/api/v1/images/status", json={'ids': []})
+    assert resp.status == 422
+    resp = await aio_client.post("/api/v1/images/status", json={})
+    assert resp.status == 422
+
+
+async def test_check_statuses_too_many(aio_client, monkeypatch):
+    monkeypatch.setitem(CONFIG['status'], 'max_ids', 2)
+    resp = await aio_client.post("/api/v1/images/status", json={'ids': ['1', '2', '3']})
+    assert resp.status == 400
+
+
+async def test_status_events(aio_client, mocker):
+    image_id = "01ec3385-47"
+    url = f"/api/v1/image/{image_id}/events"
+    mocker.patch.object(MockRepo, "get", return_value={'id': image_id, 'status': "loaded"})
+    notifier = aio_client.server.app.notifier
+
+    async def notify():
+        while image_id not in notifier._waiters:
+            await asyncio.sleep(0.01)
+        notifier._dispatch({'id': image_id, 'status': "resizing"})
+        notifier._dispatch({'id': image_id, 'status': "done"})
+
+    asyncio.ensure_future(notify())
+    resp = await aio_client.get(url)
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == 'text/event-stream'
+    body = await resp.text()
+    events = [json.loads(line[len('data: '):]) for line in body.split('\n') if line.startswith('data: ')]
+    assert events == [
+        {'id': image_id, 'status': "loaded"},
+        {'id': image_id, 'status': "resizing"},
+        {'id': image_id, 'status': "done"},
+    ]
+    assert not notifier._waiters
+
+
+async def test_status_events_subscription_lost(aio_client):
+    image_id = "01ec3385-47"
+    url = f"/api/v1/image/{image_id}/events"
+    app = aio_client.server.app
+    app.repository = MemoryRepo()
+    await app.repository.insert(image_id, {'id': image_id, 'status': "resizing"})
+
+    async def lose_subscription():
+        while image_id not in app.notifier._waiters:
+            await asyncio.sleep(0.01)
+        app.notifier._on_lost()
+        await asyncio.sleep(0.01)
+        await app.repository.update(image_id, {'status': "done"})
+        app.notifier._on_lost()
+
+    asyncio.ensure_future(lose_subscription())
+    resp = await aio_client.get(url)
+    body = await resp.text()
+    events = [json.loads(line[len('data: '):]) for line in body.split('\n') if line.startswith('data: ')]
+    assert events == [{'id': image_id, 'status': "resizing"}, {'id': image_id, 'status': "done"}]
+    assert ': keepalive' in body
+
+
+async def test_status_events_not_found_id(aio_client, mocker):
+    url = "/api/v1/image/01ec3385-47/events"
+    mocker.patch.object(MockRepo, "get", return_value=None)
+    resp = await aio_client.get(url)
+    assert resp.status == 404
+
+
 async def test_get_image_not_found(aio_client, mocker):
     image_id = "01ec3385-47"
     url = f"/api/v1/image/{image_id}"
@@ -190,6 +600,54 @@ async def test_get_image(aio_client, image_in_dir, mocker):
         buffer += data
     assert resp.status == 200
     assert buffer == IMAGE_BYTES
+    assert resp.headers['Content-Length'] == str(len(IMAGE_BYTES))
+    assert resp.headers['Content-Disposition'] == f'attachment; filename="{TEST_FILE_NAME}"'
+
+
+async def test_get_image_range(aio_client, image_in_dir, mocker, monkeypatch):
+    image_id = "01ec3385-47"
+    url = f"/api/v1/image/{image_id}"
+    status_data = {
+        'id': image_id,
+        'status': "done",
+        'updated_file_path': os.path.join(image_in_dir, TEST_FILE_NAME),
+        'file_name': TEST_FILE_NAME,
+    }
+    monkeypatch.setitem(CONFIG, 'clear', True)
+    mocker.patch.object(MockRepo, "get", return_value=status_data)
+    delete_result = mocker.patch.object(MockFilesStorage, "delete_result")
+    resp = await aio_client.get(url, headers={'Range': 'bytes=10-99'})
+    buffer = await resp.read()
+    assert resp.status == 206
+    assert buffer == IMAGE_BYTES[10:100]
+    assert not delete_result.called
+
+
+async def test_get_image_clear(aio_client, tmp_path, mocker, monkeypatch, caplog):
+    # file deleted after it was sent, aiohttp must not send response again
+    image_id = "01ec3385-47"
+    file_path = tmp_path / TEST_FILE_NAME
+    file_path.write_bytes(IMAGE_BYTES)
+    status_data = {
+        'id': image_id,
+        'status': "done",
+        'updated_file_path': str(file_path),
+        'file_name': TEST_FILE_NAME,
+    }
+    monkeypatch.setitem(CONFIG, 'clear', True)
+    mocker.patch.object(MockRepo, "get", return_value=status_data)
+    mocker.patch.object(MockFilesStorage, "delete_result", side_effect=lambda path: os.remove(path))
+    resp = await aio_client.get(f"/api/v1/image/{image_id}")
+    assert resp.status == 200
+    assert await resp.read() == IMAGE_BYTES
+    # client gets file before handler deletes it
+    for _ in range(100):
+        if not file_path.exists():
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.01)
+    assert not file_path.exists()
+    assert not [record for record in caplog.records if record.name == 'aiohttp.server']
 
 
 async def test_get_image_path_not_found_error(aio_client, image_in_dir, mocker):
@@ -229,3 +687,126 @@ async def test_get_image_delete_error(aio_client, image_in_dir, mocker, monkeypa
         buffer += data
     assert resp.status == 200
     assert buffer == IMAGE_BYTES
+
+
+async def test_load_batch(aio_client):
+    app = aio_client.server.app
+    app.repository = MemoryRepo()
+    app.files_storage = ReadingFilesStorage()
+    app.scheduler = ResizeScheduler(LocalJobQueue(max_size=10), max_in_flight=1)
+    form = get_batch_form(('100x,s2', 'a.png', IMAGE_BYTES), (None, 'b.png', b'second'))
+    resp = await aio_client.post("/api/v1/batch", params={'sizes': 'x10'}, data=form)
+    assert resp.status == 202
+    resp_data = await resp.json()
+    batch_id = resp_data['id']
+    assert resp_data['images'] == [
+        {'id': f'{batch_id}-0', 'status': 'loaded'},
+        {'id': f'{batch_id}-1', 'status': 'loaded'},
+    ]
+    assert sorted(app.files_storage.saved.values()) == sorted([IMAGE_BYTES, b'second'])
+    first = app.repository.data[f'{batch_id}-0']
+    assert [(o['width'], o['height'], o['scale']) for o in first['outputs']] == [(100, 0, 0), (0, 0, 2)]
+    second = app.repository.data[f'{batch_id}-1']
+    assert [(o['width'], o['height'], o['scale']) for o in second['outputs']] == [(0, 10, 0)]
+    assert (first['source_size'], second['source_size']) == (len(IMAGE_BYTES), len(b'second'))
+    assert await app.scheduler.job_queue.depth() == 2
+
+
+async def test_load_batch_no_sizes(aio_client, mocker):
+    app = aio_client.server.app
+    app.files_storage = ReadingFilesStorage()
+    delete_default = mocker.patch.object(ReadingFilesStorage, "delete_default")
+    form = get_batch_form(('s2', 'a.png', IMAGE_BYTES), (None, 'b.png', IMAGE_BYTES))
+    resp = await aio_client.post("/api/v1/batch", data=form)
+    assert resp.status == 400
+    # first file already saved
+    assert delete_default.call_count == 1
+
+
+async def test_load_batch_error_sizes(aio_client):
+    form = get_batch_form(('0x0', 'a.png', IMAGE_BYTES))
+    resp = await aio_client.post("/api/v1/batch", data=form)
+    assert resp.status == 422
+
+
+async def test_load_batch_queue_filled_while_upload(aio_client, mocker):
+    app = aio_client.server.app
+    app.repository = MemoryRepo()
+    mocker.patch.object(ResizeScheduler, "is_full", return_value=False)
+    delete_default = mocker.patch.object(MockFilesStorage, "delete_default")
+    form = get_batch_form(('s2', 'a.png', IMAGE_BYTES), ('s2', 'b.png', IMAGE_BYTES))
+    resp = await aio_client.post("/api/v1/batch", data=form)
+    resp_data = await resp.json()
+    assert resp.status == 202
+    assert [image['status'] for image in resp_data['images']] == ['loaded', 'error']
+    assert delete_default.call_count == 1
+
+
+async def test_check_batch(aio_client):
+    app = aio_client.server.app
+    app.repository = MemoryRepo()
+    await app.repository.insert('batch', {'id': 'batch', 'files': ['batch-0', 'batch-1']})
+    await app.repository.insert('batch-0', {'status': 'done', 'outputs': [
+        {'width': 10, 'height': 0, 'scale': 0, 'status': 'done', 'updated_file_path': 'p'},
+        {'width': 0, 'height': 0, 'scale': 2, 'status': 'error', 'updated_file_path': None},
+    ]})
+    await app.repository.insert('batch-1', {'status': 'resizing', 'outputs': [
+        {'width': 10, 'height': 0, 'scale': 0, 'status': 'resizing', 'updated_file_path': None},
+    ]})
+    resp = await aio_client.get("/api/v1/batch/batch")
+    resp_data = await resp.json()
+    assert resp.status == 200
+    assert resp_data['status'] == 'resizing'
+    assert [output['status'] for output in resp_data['images'][0]['outputs']] == ['done', 'error']
+    app.repository.data['batch-1']['outputs'][0]['status'] = 'done'
+    resp = await aio_client.get("/api/v1/batch/batch")
+    assert (await resp.json())['status'] == 'partial'
+
+
+async def test_check_batch_not_found(aio_client):
+    aio_client.server.app.repository = MemoryRepo()
+    resp = await aio_client.get("/api/v1/batch/batch")
+    assert resp.status == 404
+
+
+async def test_get_batch_image(aio_client, image_in_dir):
+    app = aio_client.server.app
+    app.repository = MemoryRepo()
+    await app.repository.insert('batch-0', {'file_name': TEST_FILE_NAME, 'outputs': [
+        {'width': 10, 'height': 0, 'scale': 0, 'status': 'resizing', 'updated_file_path': None},
+        {'width': 0, 'height': 0, 'scale': 2, 'status': 'done',
+         'updated_file_path': os.path.join(image_in_dir, TEST_FILE_NAME)},
+    ]})
+    resp = await aio_client.get("/api/v1/batch/batch/0/0")
+    assert await resp.json() == {'id': 'batch-0', 'status': 'resizing'}
+    for output_index in ('2', '-1', '+1', '0_1', 'a'):
+        resp = await aio_client.get(f"/api/v1/batch/batch/0/{output_index}")
+        assert resp.status == 404
+    resp = await aio_client.get("/api/v1/batch/batch/1/0")
+    assert resp.status == 404
+    resp = await aio_client.get("/api/v1/batch/batch/0/1")
+    assert resp.status == 200
+    assert await resp.read() == IMAGE_BYTES
+
+
+async def test_load_image_sync_output_format(aio_client, mocker):
+    aio_client.server.app.process_pool = get_pool()
+    mocker.patch.object(Request, "multipart", side_effect=MockSyncMultipartReader)
+    params = {'scale': 2, 'sync': 1, 'format': 'webp', 'quality': 60, 'speed': 10}
+    resp = await aio_client.post("/api/v1/image", params=params)
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == 'image/webp'
+    assert Image.open(io.BytesIO(await resp.read())).format == 'WEBP'
+
+
+async def test_load_image_error_output_format(aio_client, mocker):
+    mocker.patch.object(Request, "multipart", side_effect=MockMultipartReader)
+    resp = await aio_client.post("/api/v1/image", params={'scale': 2, 'format': 'gif'})
+    assert resp.status == 422
+
+
+@pytest.mark.parametrize('params', [{'filter': 'cubic'}, {'reducing_gap': 0.5}, {'reducing_gap': -1}])
+async def test_load_image_error_resample(aio_client, mocker, params):
+    mocker.patch.object(Request, "multipart", side_effect=MockMultipartReader)
+    resp = await aio_client.post("/api/v1/image", params=dict(params, scale=2))
+    assert resp.status == 422
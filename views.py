@@ -1,24 +1,157 @@
+import asyncio
+import datetime
+import hashlib
 import logging
 import uuid
-import datetime
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
 from aiohttp import web
 from aiohttp.web_request import Request
 from aiohttp.web_response import json_response, StreamResponse
 from aiohttp_apispec import request_schema
+from PIL import Image
+from marshmallow import ValidationError
 
-from serializer import ImageSchema
+from serializer import ImageSchema, StatusRequestSchema, parse_sizes, parse_output, parse_resample
 from models.Image import ImageData
 from config import CONFIG
 from service import AiohttpAdapter
+from service.adapters import AdapterBase
+from service.codec import dumps
+from service.image_resizer import get_output_format, get_output_name
 from service.file_storage import ImageNotFoundError, ConnectionStorageError, PathNotFoundError
+from service.job_queue import QueueFullError
+from service.metrics import REGISTRY, CONTENT_TYPE, STAGE_SECONDS, JOBS, ERRORS, QUEUE_DEPTH, IN_FLIGHT, POOL_TASKS, \
+    POOL_UTILIZATION
+from service.notifier import FINAL_STATUSES
+from service.worker import run_in_pool, run_shared_in_pool
 
 logger = logging.getLogger('app_logger')
 
+# job fields read by status checks, rest of record stays in redis
+STATUS_FIELDS = ('id', 'status')
+
+
+def _queue_full_error() -> web.HTTPServiceUnavailable:
+    ERRORS.inc('queue_full')
+    return web.HTTPServiceUnavailable(
+        headers={'Retry-After': str(CONFIG['queue']['retry_after'])},
+    )
+
+
+def _is_sync(request: Request) -> bool:
+    sync = request.query.get('sync', '').lower() in ('1', 'true')
+    if getattr(request.app, 'process_pool', None) is None:
+        # api node, no workers for resize in request
+        if sync:
+            raise web.HTTPBadRequest(text='sync mode is not available on this node')
+        return False
+    if sync:
+        return True
+    auto_size = CONFIG['sync']['auto_size']
+    return bool(auto_size and request.content_length and request.content_length <= auto_size)
+
+
+async def _read_upload(adapter: AdapterBase) -> bytes:
+    max_size = CONFIG['sync']['max_size']
+    body = bytearray()
+    with STAGE_SECONDS.time('upload'):
+        async for chunk in adapter.read():
+            body += chunk
+            if len(body) > max_size:
+                raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=len(body))
+    return bytes(body)
+
+
+async def _read_upload_shared(adapter: AdapterBase, segment: Any) -> int:
+    # upload written straight to shared memory segment, worker reads it from there
+    max_size = min(CONFIG['sync']['max_size'], segment.size)
+    size = 0
+    with STAGE_SECONDS.time('upload'):
+        async for chunk in adapter.read():
+            if size + len(chunk) > max_size:
+                raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size + len(chunk))
+            segment.buf[size:size + len(chunk)] = chunk
+            size += len(chunk)
+    return size
+
+
+async def _resize_sync(request: Request, filename: str, adapter: AdapterBase) -> StreamResponse:
+    # resize in same request, nothing stored in repository and files storage without ?cache
+    buffers = request.app.shared_buffers
+    if buffers is None:
+        body = await _read_upload(adapter)
+        resize = partial(run_in_pool, request.app.process_pool, 'resize_bytes', body, size=len(body))
+        return await _resize_upload(request, filename, body, resize)
+    segment = await buffers.acquire()
+    try:
+        size = await _read_upload_shared(adapter, segment)
+        resize = partial(run_shared_in_pool, request.app.process_pool, buffers, segment, size)
+        with segment.buf[:size] as body:
+            return await _resize_upload(request, filename, body, resize)
+    finally:
+        # if job is still running segment is released when it finished
+        buffers.release(segment)
+
+
+async def _resize_upload(
+        request: Request,
+        filename: str,
+        body: Union[bytes, memoryview],
+        resize: Callable[..., Awaitable[Tuple[Optional[bytes], Optional[str]]]],
+) -> StreamResponse:
+    loop = asyncio.get_event_loop()
+    width = int(request.query.get('width', 0))
+    height = int(request.query.get('height', 0))
+    scale = int(request.query.get('scale', 0))
+    output = parse_output(request.query)
+    resample = parse_resample(request.query)
+    result_cache = request.app.result_cache
+    cache_key = None
+    if result_cache and request.query.get('cache', '').lower() in ('1', 'true'):
+        cache_key = result_cache.make_result_key(
+            hashlib.sha256(body).hexdigest(), filename, width, height, scale, output, resample,
+        )
+        cached_path = await result_cache.get(cache_key)
+        if cached_path:
+            adapter = AiohttpAdapter(request=request)
+            try:
+                with STAGE_SECONDS.time('download'):
+                    await request.app.files_storage.write_result(cached_path, adapter)
+                return adapter.response
+            except (ConnectionStorageError, PathNotFoundError) as e:
+                logger.error(e)
+                ERRORS.inc(type(e).__name__)
+                if adapter.response is not None and adapter.response.prepared:
+                    adapter.response.force_close()
+                    return adapter.response
+    result, error = await resize(filename, width, height, scale, output, resample)
+    if error:
+        logger.error(error)
+        JOBS.inc('error')
+        raise web.HTTPBadRequest(text='Can not resize image')
+    JOBS.inc('done')
+    if cache_key:
+        try:
+            file_path = await loop.run_in_executor(
+                None, request.app.files_storage.save_result, result, get_output_name(filename, output),
+            )
+            await result_cache.set(cache_key, file_path)
+        except (PathNotFoundError, ConnectionStorageError) as e:
+            logger.error(e)
+            ERRORS.inc(type(e).__name__)
+    content_type = Image.MIME.get(get_output_format(filename, output), 'application/octet-stream')
+    return web.Response(body=result, content_type=content_type)
+
 
 @request_schema(ImageSchema(), locations=['query'])
-async def load_image(request: Request) -> json_response:
+async def load_image(request: Request) -> StreamResponse:
     # todo think about validate file and fields
+    sync = _is_sync(request)
+    if not sync and await request.app.scheduler.is_full():
+        # reject before upload streaming, don't waste disk and time
+        raise _queue_full_error()
     reader = await request.multipart()
     file_name_field = await reader.next()
     file_name = await file_name_field.read()
@@ -26,7 +159,16 @@ async def load_image(request: Request) -> json_response:
     adapter = AiohttpAdapter(request=request)
     current_timestamp = datetime.datetime.now().timestamp()
     filename = f'{current_timestamp}-{decoded_file_name}'
-    await request.app.files_storage.save_default(filename, adapter)
+    if sync:
+        return await _resize_sync(request, filename, adapter)
+    try:
+        with STAGE_SECONDS.time('upload'):
+            source_hash = await request.app.files_storage.save_default(filename, adapter)
+            source_size = adapter.bytes_read
+    except ConnectionStorageError as e:
+        logger.error(e)
+        ERRORS.inc(type(e).__name__)
+        raise web.HTTPServiceUnavailable()
     file_id = str(uuid.uuid4())[:13]
     file_data = ImageData(
         id=file_id,
@@ -36,22 +178,160 @@ async def load_image(request: Request) -> json_response:
         width=int(request.query.get('width', 0)),
         height=int(request.query.get('height', 0)),
         scale=int(request.query.get('scale', 0)),
+        source_hash=source_hash,
+        source_size=source_size,
+        output=parse_output(request.query),
+        resample=parse_resample(request.query),
     )
     await request.app.repository.insert(file_id, file_data.to_json())
-    await request.app.input_images_queue.put(file_id)
-    return web.json_response(data={"id": file_id, "status": "loaded"}, status=202)
+    try:
+        await request.app.scheduler.put(file_id)
+    except QueueFullError as e:
+        # queue filled up while file was uploading
+        logger.warning(e)
+        await request.app.repository.delete(file_id)
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, request.app.files_storage.delete_default, filename)
+        except (ImageNotFoundError, PathNotFoundError, ConnectionStorageError) as e:
+            logger.error(e)
+        raise _queue_full_error()
+    return _json_response({"id": file_id, "status": "loaded"}, status=202)
+
+
+def _json_response(data: Any, status: int = 200) -> web.Response:
+    # body encoded by service codec, orjson if installed
+    return web.Response(body=dumps(data), status=status, content_type='application/json', charset='utf-8')
+
+
+def _get_wait(request: Request) -> float:
+    try:
+        wait = float(request.query.get('wait', 0))
+    except ValueError:
+        raise web.HTTPBadRequest(text='wait must be number of secs')
+    return min(max(wait, 0.0), CONFIG['notify']['max_wait'])
+
+
+async def _read_status(request: Request, image_id: str) -> Optional[str]:
+    # not notified in time or notifications lost
+    file_data = await request.app.repository.get(image_id, fields=STATUS_FIELDS)
+    return file_data.get('status') if file_data else None
 
 
 async def check_status(request: Request) -> json_response:
     image_id = request.match_info.get('image_id')
-    file_data = await request.app.repository.get(image_id)
-    if not file_data:
-        raise web.HTTPNotFound()
+    # ?wait=N - long polling, response sent when status changed or after N secs
+    wait = _get_wait(request)
+    notifier = request.app.notifier
+    queue = notifier.subscribe(image_id)
+    try:
+        file_data = await request.app.repository.get(image_id, fields=STATUS_FIELDS)
+        if not file_data:
+            raise web.HTTPNotFound()
+        status = file_data.get('status')
+        if wait and status not in FINAL_STATUSES:
+            status = await notifier.wait(queue, wait) or await _read_status(request, image_id) or status
+    finally:
+        notifier.unsubscribe(image_id, queue)
     data = {
         'id': file_data.get('id'),
-        'status': file_data.get('status')
+        'status': status
     }
-    return web.json_response(data=data, status=200)
+    return _json_response(data, status=200)
+
+
+@request_schema(StatusRequestSchema())
+async def check_statuses(request: Request) -> json_response:
+    # many jobs in one request and one repository round trip, same id given twice answered once
+    image_ids = list(dict.fromkeys(request['data']['ids']))
+    if len(image_ids) > CONFIG['status']['max_ids']:
+        raise web.HTTPBadRequest(text=f"Max {CONFIG['status']['max_ids']} ids")
+    records = await request.app.repository.get_many(image_ids, fields=STATUS_FIELDS)
+    images = [
+        {'id': image_id, 'status': file_data.get('status') if file_data else 'not_found'}
+        for image_id, file_data in zip(image_ids, records)
+    ]
+    return _json_response({'images': images}, status=200)
+
+
+async def _send_event(response: StreamResponse, image_id: str, status: str) -> None:
+    await response.write(b'event: status\ndata: ' + dumps({'id': image_id, 'status': status}) + b'\n\n')
+
+
+async def status_events(request: Request) -> StreamResponse:
+    # server-sent events, every status change until image is done or failed
+    image_id = request.match_info.get('image_id')
+    notifier = request.app.notifier
+    queue = notifier.subscribe(image_id)
+    try:
+        file_data = await request.app.repository.get(image_id, fields=STATUS_FIELDS)
+        if not file_data:
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        await response.prepare(request)
+        status = file_data.get('status')
+        await _send_event(response, image_id, status)
+        while status not in FINAL_STATUSES:
+            new_status = await notifier.wait(queue, CONFIG['notify']['keepalive'])
+            if new_status is None:
+                new_status = await _read_status(request, image_id) or status
+            if new_status == status:
+                # keep connection open through proxies
+                await response.write(b': keepalive\n\n')
+                continue
+            status = new_status
+            await _send_event(response, image_id, status)
+        await response.write_eof()
+    finally:
+        notifier.unsubscribe(image_id, queue)
+    return response
+
+
+async def check_queue(request: Request) -> json_response:
+    return _json_response(await request.app.scheduler.stats(), status=200)
+
+
+async def get_metrics(request: Request) -> web.Response:
+    # Prometheus text format, gauges updated on scrape
+    scheduler = request.app.scheduler
+    QUEUE_DEPTH.set(await scheduler.job_queue.depth())
+    IN_FLIGHT.set(scheduler.in_flight)
+    workers = 0
+    if getattr(request.app, 'process_pool', None) is not None:
+        workers = CONFIG['workers']
+        if CONFIG['executor']['backend'] == 'hybrid':
+            workers += CONFIG['executor']['threads']
+    POOL_UTILIZATION.set(min(POOL_TASKS.get(), workers) / workers if workers else 0.0)
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def _write_result(request: Request, file_path: str, file_name: str) -> Tuple[StreamResponse, bool]:
+    # response and True if whole image sent
+    adapter = AiohttpAdapter(
+        request=request,
+        headers={'Content-Disposition': f'attachment; filename="{file_name}"'},
+    )
+    try:
+        with STAGE_SECONDS.time('download'):
+            await request.app.files_storage.write_result(file_path, adapter)
+    except (ConnectionStorageError, PathNotFoundError) as e:
+        logger.error(e)
+        ERRORS.inc(type(e).__name__)
+        await adapter.prepare()
+        adapter.response.force_close()
+        return adapter.response, False
+    # keep image if client loaded only part of it (Range request)
+    return adapter.response, adapter.response.status == 200
+
+
+async def _delete_result(request: Request, file_path: str) -> None:
+    try:
+        await request.app.files_storage.delete_result(file_path)
+    except ImageNotFoundError as e:
+        logger.error(e)
 
 
 async def get_image(request: Request) -> StreamResponse:
@@ -64,23 +344,182 @@ async def get_image(request: Request) -> StreamResponse:
             'id': file_data.get('id'),
             'status': file_data.get('status')
         }
-        return web.json_response(data=data, status=200)
-    response = web.StreamResponse()
-    response.headers['Content-Disposition'] = f'attachment; filename="{file_data.get("file_name")}"'
-    await response.prepare(request)
+        return _json_response(data, status=200)
     file_path = file_data.get('updated_file_path')
-    adapter = AiohttpAdapter(response=response)
+    file_name = get_output_name(file_data.get('file_name'), file_data.get('output'))
+    response, sent = await _write_result(request, file_path, file_name)
+    if CONFIG.get('clear') and sent:
+        await _delete_result(request, file_path)
+        await request.app.repository.delete(image_id)
+    return response
+
+
+async def _delete_defaults(request: Request, filenames: List[str]) -> None:
+    loop = asyncio.get_event_loop()
+    for filename in filenames:
+        try:
+            await loop.run_in_executor(None, request.app.files_storage.delete_default, filename)
+        except (ImageNotFoundError, PathNotFoundError, ConnectionStorageError) as e:
+            logger.error(e)
+
+
+def _validation_error(e: ValidationError) -> web.HTTPUnprocessableEntity:
+    return web.HTTPUnprocessableEntity(body=dumps(e.messages), content_type='application/json')
+
+
+async def _save_batch_files(request: Request, batch_id: str, filenames: List[str]) -> List[ImageData]:
+    # saves every file of multipart body, names of saved files appended to filenames.
+    # Text field "sizes" sets target sizes for next file, default is ?sizes
     try:
-        await request.app.files_storage.write_result(file_path, adapter)
-    except (ConnectionStorageError, PathNotFoundError) as e:
-        logger.error(e)
-        response.force_close()
-        return response
-    response.force_close()
-    if CONFIG.get('clear'):
+        default_sizes = parse_sizes(request.query['sizes']) if 'sizes' in request.query else None
+        output = parse_output(request.query)
+        resample = parse_resample(request.query)
+    except ValidationError as e:
+        raise _validation_error(e)
+    sizes = default_sizes
+    files = []
+    reader = await request.multipart()
+    current_timestamp = datetime.datetime.now().timestamp()
+    while True:
+        field = await reader.next()
+        if field is None:
+            break
+        if field.filename is None:
+            if field.name == 'sizes':
+                try:
+                    sizes = parse_sizes(await field.text())
+                except ValidationError as e:
+                    raise _validation_error(e)
+            else:
+                await field.release()
+            continue
+        if not sizes:
+            raise web.HTTPBadRequest(text=f'No sizes for file {field.filename}')
+        if len(files) >= CONFIG['batch']['max_files']:
+            raise web.HTTPBadRequest(text=f"Max {CONFIG['batch']['max_files']} files in batch")
+        if len(sizes) > CONFIG['batch']['max_sizes']:
+            raise web.HTTPBadRequest(text=f"Max {CONFIG['batch']['max_sizes']} sizes per file")
+        filename = f'{current_timestamp}-{len(files)}-{field.filename}'
+        filenames.append(filename)
+        adapter = AiohttpAdapter(request=request, field=field)
         try:
-            await request.app.files_storage.delete_result(file_path)
-        except ImageNotFoundError as e:
+            with STAGE_SECONDS.time('upload'):
+                source_hash = await request.app.files_storage.save_default(filename, adapter)
+        except ConnectionStorageError as e:
             logger.error(e)
-        await request.app.repository.delete(image_id)
+            ERRORS.inc(type(e).__name__)
+            raise web.HTTPServiceUnavailable()
+        files.append(ImageData(
+            id=f'{batch_id}-{len(files)}',
+            status='loaded',
+            default_image_path=CONFIG['files_path'],
+            file_name=filename,
+            width=0,
+            height=0,
+            scale=0,
+            source_hash=source_hash,
+            source_size=adapter.bytes_read,
+            batch_id=batch_id,
+            output=output,
+            resample=resample,
+            outputs=[dict(size, status='loaded', updated_file_path=None) for size in sizes],
+        ))
+        sizes = default_sizes
+    if not files:
+        raise web.HTTPBadRequest(text='No files')
+    return files
+
+
+async def load_batch(request: Request) -> json_response:
+    # many files, many sizes per file. Every file is one job, decoded once for all its sizes
+    if await request.app.scheduler.is_full():
+        raise _queue_full_error()
+    batch_id = str(uuid.uuid4())[:13]
+    filenames = []
+    try:
+        files = await _save_batch_files(request, batch_id, filenames)
+    except web.HTTPException:
+        await _delete_defaults(request, filenames)
+        raise
+    repository = request.app.repository
+    for file_data in files:
+        await repository.insert(file_data.id, file_data.to_json())
+    await repository.insert(batch_id, {'id': batch_id, 'files': [file_data.id for file_data in files]})
+    images = []
+    for file_data in files:
+        try:
+            await request.app.scheduler.put(file_data.id)
+        except QueueFullError as e:
+            # queue filled up while files were uploading, rest of files not resized
+            logger.warning(e)
+            file_data.status = 'error'
+            for output in file_data.outputs:
+                output['status'] = 'error'
+            await repository.update(file_data.id, file_data.to_json())
+            await _delete_defaults(request, [file_data.file_name])
+        images.append({'id': file_data.id, 'status': file_data.status})
+    return _json_response({"id": batch_id, "status": "loaded", "images": images}, status=202)
+
+
+def _batch_status(statuses: List[str]) -> str:
+    if all(status == 'done' for status in statuses):
+        return 'done'
+    if all(status == 'error' for status in statuses):
+        return 'error'
+    if all(status in FINAL_STATUSES for status in statuses):
+        # some outputs done, some failed
+        return 'partial'
+    if all(status == 'loaded' for status in statuses):
+        return 'loaded'
+    return 'resizing'
+
+
+async def check_batch(request: Request) -> json_response:
+    batch_id = request.match_info.get('batch_id')
+    batch = await request.app.repository.get(batch_id)
+    if not batch or 'files' not in batch:
+        raise web.HTTPNotFound()
+    images = []
+    statuses = []
+    records = await request.app.repository.get_many(batch['files'], fields=('status', 'outputs'))
+    for file_id, file_data in zip(batch['files'], records):
+        file_data = file_data or {'status': 'error', 'outputs': []}
+        outputs = [
+            {
+                'width': output['width'],
+                'height': output['height'],
+                'scale': output['scale'],
+                'status': output['status'],
+            }
+            for output in file_data.get('outputs') or []
+        ]
+        statuses.extend(output['status'] for output in outputs)
+        images.append({'id': file_id, 'status': file_data.get('status'), 'outputs': outputs})
+    data = {
+        'id': batch_id,
+        'status': _batch_status(statuses or ['error']),
+        'images': images,
+    }
+    return _json_response(data, status=200)
+
+
+def _get_output(file_data: Optional[Dict], output_index: str) -> Dict:
+    # only 0 <= index < outputs, int() accepts -1, +1 and 1_0 too
+    outputs = (file_data or {}).get('outputs') or []
+    if not output_index.isdecimal() or int(output_index) >= len(outputs):
+        raise web.HTTPNotFound()
+    return outputs[int(output_index)]
+
+
+async def get_batch_image(request: Request) -> StreamResponse:
+    file_id = f"{request.match_info.get('batch_id')}-{request.match_info.get('file_index')}"
+    file_data = await request.app.repository.get(file_id)
+    output = _get_output(file_data, request.match_info.get('output_index'))
+    if output['status'] != 'done':
+        return _json_response({'id': file_id, 'status': output['status']}, status=200)
+    file_path = output['updated_file_path']
+    file_name = get_output_name(file_data.get('file_name'), file_data.get('output'))
+    response, sent = await _write_result(request, file_path, file_name)
+    if CONFIG.get('clear') and sent:
+        await _delete_result(request, file_path)
     return response